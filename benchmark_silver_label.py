@@ -0,0 +1,220 @@
+import argparse
+import json
+import subprocess
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from create_silver_label import EventDeduplicationDataFrame
+from near_duplicates import near_duplicate_groups, collapse_near_duplicates
+from profiling import StageProfiler
+
+
+SCALES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+EVENT_TYPES = ["tropical_storm", "flood", "earthquake", "wildfire"]
+EVENT_NAMES = {"tropical_storm": "Hurricane", "flood": "Floods", "earthquake": "Earthquake", "wildfire": "Wildfire"}
+EVENT_KEYWORDS = {"hurricane": "tropical_storm", "storm": "tropical_storm", "floods": "flood", "flooding": "flood",
+                  "earthquake": "earthquake", "quake": "earthquake", "wildfire": "wildfire", "blaze": "wildfire"}
+TEMPLATES = ["{event} {name} hits {place}, {number} dead",
+             "{place}: {event} {name} leaves {number} homeless",
+             "{event} {name} batters {place} as {number} flee",
+             "Live updates: {event} {name} in {place}, {number} evacuated",
+             "{number} missing after {event} {name} strikes {place}",
+             "{place} declares emergency over {event} {name} with {number} affected",
+             "Rescue teams reach {number} trapped in {place} after {event} {name}",
+             "Aid for {number} families arrives in {place} after {event} {name}"]
+BACKGROUND_WORDS = ["election", "market", "football", "minister", "budget", "court", "festival", "company",
+                    "shares", "police", "school", "health", "music", "energy", "prices", "talks", "summit", "report"]
+DOMAINS = ["Reuters", "AP News", "BBC", "Al Jazeera", "The Guardian", "CNN", "Times of India", "ABC News"]
+SYLLABLES = ["ka", "lo", "mi", "ra", "to", "ne", "su", "va", "ri", "do", "pe", "la", "zu", "ko", "ma", "ti"]
+
+
+def random_names(rng, n, n_syllables=3):
+    syllables = rng.choice(SYLLABLES, size=(n, n_syllables))
+    return pd.Series(["".join(s) for s in syllables]).str.capitalize().values
+
+
+def generate_synthetic_news(n_titles: int, seed: int = 0, titles_per_event: int = 100, background_ratio: float = 0.3,
+                            date_outlier_ratio: float = 0.05, stick_ratio: float = 0.3, duplicate_ratio: float = 0.05):
+    """
+    Synthetic crawl with the columns of aggregated_news_all_events.csv plus ground-truth entities:
+    events (named storms, floods, ...) reported by titles from a few templates, published within days of
+    the event (some far off), background titles without event, '| Site' suffixes and exact duplicates.
+    """
+    rng = np.random.default_rng(seed)
+    n_background = int(n_titles * background_ratio)
+    n_event_titles = n_titles - n_background
+    n_events = max(n_event_titles // titles_per_event, 1)
+
+    event_types = rng.choice(EVENT_TYPES, size=n_events)
+    event_names = random_names(rng, n_events)
+    event_places = random_names(rng, n_events, n_syllables=2)
+    event_days = rng.integers(0, 3 * 365, size=n_events)
+
+    event = rng.integers(0, n_events, size=n_event_titles)
+    templates = rng.choice(TEMPLATES, size=n_event_titles)
+    event_titles = [template.format(event=EVENT_NAMES[event_type], name=name, place=place, number=number)
+                    for template, event_type, name, place, number in
+                    zip(templates, event_types[event], event_names[event], event_places[event],
+                        rng.integers(2, 5000, size=n_event_titles))]
+    day_offsets = np.abs(rng.normal(0, 1.5, size=n_event_titles)).round()
+    far_off = rng.random(n_event_titles) < date_outlier_ratio
+    day_offsets[far_off] = rng.integers(30, 200, size=far_off.sum())
+    entities = [str({"entity_type": {name: "EVENT", place: "GPE"}, "linked_entitiy": {}})
+                for name, place in zip(event_names[event], event_places[event])]
+
+    background_words = rng.choice(BACKGROUND_WORDS, size=(n_background, 5))
+    background_places = random_names(rng, n_background, n_syllables=2)
+    background_titles = [f"{place} {' '.join(words)}" for place, words in zip(background_places, background_words)]
+    background_entities = [str({"entity_type": {place: "GPE"}, "linked_entitiy": {}}) for place in background_places]
+
+    df = pd.DataFrame({"title": event_titles + background_titles,
+                       "day": np.concatenate([event_days[event] + day_offsets, rng.integers(0, 3 * 365, n_background)]),
+                       "entities": entities + background_entities,
+                       "true_event": np.concatenate([event, np.full(n_background, -1)])})
+    df["domain"] = rng.choice(DOMAINS, size=len(df))
+    with_stick = rng.random(len(df)) < stick_ratio
+    df.loc[with_stick, "title"] = df.loc[with_stick, "title"] + " | " + df.loc[with_stick, "domain"]
+    df["url"] = "https://" + df["domain"].str.replace(" ", "").str.lower() + ".com/news/" + np.arange(len(df)).astype(str)
+
+    duplicates = df.sample(frac=duplicate_ratio, random_state=seed)
+    df = pd.concat([df, duplicates], ignore_index=True).sample(frac=1, random_state=seed).reset_index(drop=True)
+    start_dates = pd.Timestamp("2020-01-01") + pd.to_timedelta(df.pop("day"), unit="D")
+    df["start_date"] = start_dates.dt.strftime("%Y-%m-%d")
+    df["end_date"] = (start_dates + pd.Timedelta(days=7)).dt.strftime("%Y-%m-%d")
+    return df
+
+
+class StubEventDeduplicationDataFrame(EventDeduplicationDataFrame):
+    """
+    EventDeduplicationDataFrame with the remote event detector and the sentence encoder replaced by
+    cheap deterministic stand-ins: a keyword rule and tf-idf weighted random word vectors.
+    """
+    def __init__(self, csv_path: str, root, embedding_dim: int = 384):
+        super().__init__(csv_path)
+        self.root = Path(root)
+        self.cache_dir = Path(self.root, "stage_cache")
+        self.embedding_dim = embedding_dim
+
+    def encode_titles(self, titles, batch_size: int = 512):
+        words = pd.Series(titles, dtype=object).str.lower().str.findall(r"[a-z]+")
+        title_index = np.repeat(np.arange(len(words)), words.str.len().values)
+        word_codes, vocabulary = pd.factorize(words.explode().dropna().values)
+        counts = sparse.csr_matrix((np.ones(len(word_codes), dtype=np.float32), (title_index, word_codes)),
+                                   shape=(len(words), len(vocabulary)))
+        idf = np.log(len(words) / np.maximum(np.bincount(counts.indices, minlength=len(vocabulary)), 1))
+        rng = np.random.default_rng(0)
+        word_vectors = rng.normal(size=(len(vocabulary), self.embedding_dim)).astype(np.float32)
+        # squared idf: titles of one event share their rare words (names, places) but not the template
+        return np.asarray(counts.multiply((idf ** 2).astype(np.float32)[None, :]).tocsr() @ word_vectors)
+
+    @staticmethod
+    def run_coypu_ee(message):
+        event_types = []
+        for title in message:
+            matches = [EVENT_KEYWORDS[word] for word in title.lower().split() if word in EVENT_KEYWORDS]
+            event_types.append(matches[0] if matches else "oos")
+        return event_types
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent).stdout.strip()
+    except OSError:
+        return None
+
+
+def run_benchmark(scale: str, bench_dir, seed: int = 0, cluster_cols: list = ("cluster_50_70", "cluster_50_90"),
+                  profile_mode: str = "json", shard_window_days: float = None):
+    bench_dir = Path(bench_dir, scale)
+    bench_dir.mkdir(parents=True, exist_ok=True)
+    csv_path = Path(bench_dir, f"synthetic_news_seed{seed}.csv")
+    if not csv_path.exists():
+        generate_synthetic_news(SCALES[scale], seed=seed).to_csv(csv_path, index=False)
+
+    profiler = StageProfiler(mode=profile_mode, profile_dir=bench_dir)
+    dataset = StubEventDeduplicationDataFrame(csv_path, root=bench_dir)
+    dataset.profiler = profiler
+    dataset.target_df_col = list(cluster_cols) + ["pred_event_type", "entities"]
+    df = dataset.df
+    df["title"] = df["title"].astype(str)
+    df["start_date"] = df["start_date"].astype(str)
+
+    def timed(name, func, *args, **kwargs):
+        with profiler.stage(name, rows_in=len(args[0])) as record:
+            output = func(*args, **kwargs)
+            record["rows_out"] = len(output[0] if isinstance(output, tuple) else output)
+        return output
+
+    df = timed("deduplicate_titles", dataset.deduplicate_titles, df)
+    df = timed("near_duplicates", lambda df: collapse_near_duplicates(
+        df.assign(duplicate_group=near_duplicate_groups(df["title"].values))), df)
+    df = timed("annotate_event_type", dataset.annotate_event_type, df)
+    df = timed("cluster_titles", dataset.cluster_titles, df, shard_window_days=shard_window_days)
+    df, _ = timed("run_temporal_clustering", dataset.run_temporal_clustering, df, forced=True)
+    df, _ = timed("remove_oos_clusters", dataset.remove_oos_clusters, df, forced=True)
+    df = timed("merge_cluster", dataset.merge_cluster, df)
+    profiler.write_report(f"benchmark_report_seed{seed}.json")
+
+    stages = [record for record in profiler.records if "/" not in record["stage"]]
+    return {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": git_commit(),
+            "scale": scale,
+            "n_titles": SCALES[scale],
+            "seed": seed,
+            "cluster_cols": list(cluster_cols),
+            "shard_window_days": shard_window_days,
+            "n_final_titles": len(df),
+            "n_final_clusters": int(df["new_cluster"].nunique()),
+            "total_wall_time_sec": sum(record["wall_time_sec"] for record in stages),
+            "peak_rss_mb": max(record["peak_rss_mb"] for record in stages),
+            "stages": {record["stage"]: {key: record[key] for key in
+                                         ["wall_time_sec", "cpu_time_sec", "peak_rss_mb", "rows_in", "rows_out"]}
+                       for record in profiler.records}}
+
+
+def compare_with_history(result, history_path):
+    """Wall time of every stage relative to the last recorded run of the same scale."""
+    if not history_path.exists():
+        return
+    with open(history_path) as f:
+        previous = [json.loads(line) for line in f if line.strip()]
+    previous = [run for run in previous if run["scale"] == result["scale"] and run["seed"] == result["seed"]
+                and run.get("shard_window_days") == result["shard_window_days"]]
+    if not previous:
+        return
+    previous = previous[-1]
+    print(f"Compared with {previous['timestamp']} (commit {previous['commit']}):")
+    for stage, record in result["stages"].items():
+        if stage in previous["stages"]:
+            before = previous["stages"][stage]["wall_time_sec"]
+            change = (record["wall_time_sec"] - before) / before * 100 if before > 0 else 0
+            print(f"    {stage:<40} {before:>9.2f}s -> {record['wall_time_sec']:>9.2f}s ({change:+.0f}%)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times the silver label denoising steps on a synthetic news corpus")
+    parser.add_argument("--scales", nargs="+", default=["10k"], choices=list(SCALES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cluster-cols", nargs="+", default=["cluster_50_70", "cluster_50_90"])
+    parser.add_argument("--profile", default="json", choices=["json", "cprofile", "pyinstrument"])
+    parser.add_argument("--shard-window-days", type=float, default=None,
+                        help="cluster in overlapping time windows of this many days in parallel")
+    parser.add_argument("--bench-dir", default="./data/benchmark")
+    parser.add_argument("--history", default="./data/benchmark/history.jsonl")
+    args = parser.parse_args()
+
+    history_path = Path(args.history)
+    history_path.parent.mkdir(parents=True, exist_ok=True)
+    for scale in args.scales:
+        result = run_benchmark(scale, args.bench_dir, seed=args.seed, cluster_cols=args.cluster_cols,
+                               profile_mode=args.profile, shard_window_days=args.shard_window_days)
+        compare_with_history(result, history_path)
+        with open(history_path, "a") as f:
+            f.write(json.dumps(result) + "\n")
+        print(f"{scale}: {result['total_wall_time_sec']:.1f}s, {result['peak_rss_mb']:.0f} MB peak rss, "
+              f"{result['n_final_clusters']} clusters")
@@ -0,0 +1,272 @@
+import numpy as np
+import pandas as pd
+
+
+# cluster id of rows which are in no cluster
+NO_CLUSTER = -1
+
+
+def community_labels(n: int, communities):
+    """int32 cluster id of each of the n rows from a list of communities (row indices), NO_CLUSTER elsewhere."""
+    labels = np.full(n, NO_CLUSTER, dtype=np.int32)
+    if len(communities):
+        sizes = [len(community) for community in communities]
+        labels[np.concatenate(communities).astype(np.int64)] = np.repeat(np.arange(len(communities), dtype=np.int32), sizes)
+    return labels
+
+
+def to_cluster_ids(values):
+    """Cluster ids (e.g. floats with NaN read from older csv files) as int32 with the NO_CLUSTER sentinel."""
+    values = pd.to_numeric(pd.Series(values), errors="coerce")
+    return values.fillna(NO_CLUSTER).values.astype(np.int32)
+
+
+def has_cluster(cluster_ids):
+    cluster_ids = np.asarray(cluster_ids, dtype=np.float64)
+    return ~np.isnan(cluster_ids) & (cluster_ids != NO_CLUSTER)
+
+
+def to_datetimes(dates):
+    """datetime64 values of dates given as strings, datetimes or categoricals of either."""
+    dates = pd.to_datetime(pd.Series(dates))
+    if isinstance(dates.dtype, pd.CategoricalDtype):
+        # categorical dates are parsed once per category, but have to be decoded for comparisons
+        dates = dates.astype("datetime64[ns]")
+    return dates.values
+
+
+def to_days(dates):
+    """Publication dates as float days since epoch."""
+    dates = to_datetimes(dates).astype("datetime64[ns]")
+    return dates.astype(np.int64) / (86400 * 1e9)
+
+
+def temporal_dbscan_1d(cluster_ids, days, eps: float = 1, min_samples: int = 3, weights=None):
+    """
+    1-D DBSCAN on the publication dates of every cluster at once.
+    Rows are sorted once by (cluster, date); a row is a core point if at least min_samples rows of
+    its cluster (itself included) lie within eps days, consecutive core points closer than eps form
+    a dense run and non-core rows within eps of a core point join the nearest run, as with
+    sklearn.cluster.DBSCAN(eps=eps, min_samples=min_samples) fitted per cluster.
+    weights are counted instead of rows for min_samples, like the sample_weight of sklearn's DBSCAN.
+
+    Returns the run label of every row (-1 for outliers and rows without a cluster) and the
+    cluster id of every run.
+    """
+    cluster_ids = np.asarray(cluster_ids, dtype=np.float64)
+    days = np.asarray(days, dtype=np.float64)
+    labels = np.full(len(cluster_ids), -1, dtype=np.int64)
+    valid = np.nonzero(has_cluster(cluster_ids))[0]
+    if len(valid) == 0:
+        return labels, np.empty(0, dtype=np.float64)
+
+    order = valid[np.lexsort((days[valid], cluster_ids[valid]))]
+    c = cluster_ids[order]
+    t = days[order] - days[order].min()
+    # cluster rank * offset + date keeps the (cluster, date) order and separates clusters by more than eps
+    cluster_rank = np.concatenate([[0], np.cumsum(c[1:] != c[:-1])])
+    key = cluster_rank * (t.max() + 2 * eps + 1) + t
+
+    weights = np.ones(len(cluster_ids)) if weights is None else np.asarray(weights, dtype=np.float64)
+    cumulative_weights = np.concatenate([[0], np.cumsum(weights[order])])
+    neighbour_counts = cumulative_weights[np.searchsorted(key, key + eps, side="right")] - \
+        cumulative_weights[np.searchsorted(key, key - eps, side="left")]
+    core = neighbour_counts >= min_samples
+
+    # dense runs of core points, split at cluster changes and at gaps larger than eps
+    core_positions = np.nonzero(core)[0]
+    run_starts = np.ones(len(core_positions), dtype=bool)
+    run_starts[1:] = (cluster_rank[core_positions[1:]] != cluster_rank[core_positions[:-1]]) | \
+                     (t[core_positions[1:]] - t[core_positions[:-1]] > eps)
+    sorted_labels = np.full(len(order), -1, dtype=np.int64)
+    sorted_labels[core_positions] = np.cumsum(run_starts) - 1
+
+    # border points join the closest core point of their cluster within eps
+    positions = np.arange(len(order))
+    previous_core = np.maximum.accumulate(np.where(core, positions, -1))
+    next_core = np.minimum.accumulate(np.where(core, positions, len(order))[::-1])[::-1]
+    border = ~core
+    previous_distance = np.full(len(order), np.inf)
+    next_distance = np.full(len(order), np.inf)
+    has_previous = border & (previous_core >= 0)
+    has_previous[has_previous] = cluster_rank[previous_core[has_previous]] == cluster_rank[has_previous]
+    previous_distance[has_previous] = t[has_previous] - t[previous_core[has_previous]]
+    has_next = border & (next_core < len(order))
+    has_next[has_next] = cluster_rank[next_core[has_next]] == cluster_rank[has_next]
+    next_distance[has_next] = t[next_core[has_next]] - t[has_next]
+    use_previous = border & (previous_distance <= eps) & (previous_distance <= next_distance)
+    use_next = border & (next_distance <= eps) & ~use_previous
+    sorted_labels[use_previous] = sorted_labels[previous_core[use_previous]]
+    sorted_labels[use_next] = sorted_labels[next_core[use_next]]
+
+    labels[order] = sorted_labels
+    run_cluster_ids = c[core_positions[run_starts]]
+    return labels, run_cluster_ids
+
+
+def largest_temporal_run(labels, cluster_ids, run_cluster_ids, weights=None):
+    """
+    Keeps the most populated run of every cluster (the earliest one on ties). A cluster is dropped
+    entirely if it has more outliers than members in its largest run.
+    Rows count as often as their weight.
+    Returns a boolean mask over the rows.
+    """
+    cluster_ids = np.asarray(cluster_ids, dtype=np.float64)
+    if len(run_cluster_ids) == 0:
+        return np.zeros(len(labels), dtype=bool)
+    weights = np.ones(len(labels)) if weights is None else np.asarray(weights, dtype=np.float64)
+    run_sizes = np.bincount(labels[labels >= 0], weights=weights[labels >= 0], minlength=len(run_cluster_ids))
+    runs = pd.DataFrame({"cluster": run_cluster_ids, "size": run_sizes})
+    largest_runs = runs.sort_values("size", ascending=False, kind="stable").groupby("cluster").head(1)
+
+    outliers = (labels == -1) & has_cluster(cluster_ids)
+    outlier_counts = pd.Series(weights[outliers]).groupby(cluster_ids[outliers]).sum()
+    largest_runs = largest_runs.loc[
+        largest_runs["size"].values >= outlier_counts.reindex(largest_runs["cluster"].values, fill_value=0).values]
+
+    is_largest_run = np.zeros(len(run_cluster_ids), dtype=bool)
+    is_largest_run[largest_runs.index.values] = True
+    return (labels >= 0) & is_largest_run[np.maximum(labels, 0)]
+
+
+def cluster_statistics(df, clustering_col, event_type_col="pred_event_type", date_col="start_date", weights=None):
+    """
+    Per-cluster statistics from one counting pass over the cluster, event type and date columns:
+    size, first/last publication date, date span in days, number and share of 'oos' predictions
+    and the majority event type ('oos' if no event type was predicted).
+    Also returns the event type distribution (clusters x event types counts).
+    Rows without a cluster (NaN or NO_CLUSTER) are ignored, other rows count as often as their weight.
+    """
+    cluster_codes, clusters = pd.factorize(df[clustering_col], sort=True)
+    is_cluster = ~pd.Index(clusters).isin([NO_CLUSTER, str(NO_CLUSTER)])
+    if not is_cluster.all():
+        recode = np.append(np.where(is_cluster, np.cumsum(is_cluster) - 1, -1), -1)
+        cluster_codes, clusters = recode[cluster_codes], clusters[is_cluster]
+    event_type_codes, event_types = pd.factorize(df[event_type_col], sort=True)
+    dates = to_datetimes(df[date_col].values)
+    weights = np.ones(len(df), dtype=np.int64) if weights is None else np.asarray(weights, dtype=np.int64)
+    valid = cluster_codes >= 0
+    cluster_codes, event_type_codes, dates, weights = \
+        cluster_codes[valid], event_type_codes[valid], dates[valid], weights[valid]
+
+    # missing event types are counted in an extra last column, which is only used for the size
+    event_type_codes = np.where(event_type_codes >= 0, event_type_codes, len(event_types))
+    counts = np.bincount(cluster_codes * (len(event_types) + 1) + event_type_codes, weights=weights,
+                         minlength=len(clusters) * (len(event_types) + 1)).astype(np.int64)
+    counts = counts.reshape(len(clusters), len(event_types) + 1)
+    event_type_distribution = pd.DataFrame(counts[:, :-1], index=pd.Index(clusters, name="cluster"),
+                                           columns=pd.Index(event_types, name="event_type"))
+
+    stats = pd.DataFrame({"size": counts.sum(axis=1)}, index=event_type_distribution.index)
+    stats["oos_count"] = event_type_distribution["oos"].values if "oos" in event_types else 0
+    date_range = pd.Series(dates).groupby(cluster_codes).agg(["min", "max"])
+    stats["first_date"] = date_range["min"].values
+    stats["last_date"] = date_range["max"].values
+    stats["date_span"] = (stats["last_date"] - stats["first_date"]) / np.timedelta64(1, "D")
+    stats["oos_purity"] = stats["oos_count"] / stats["size"]
+    has_event_type = counts[:, :-1].sum(axis=1) > 0
+    majority_event_type = np.full(len(clusters), "oos", dtype=object)
+    if len(event_types):
+        majority_event_type[has_event_type] = np.asarray(event_types, dtype=object)[
+            counts[:, :-1].argmax(axis=1)[has_event_type]]
+    stats["majority_event_type"] = majority_event_type
+    return stats, event_type_distribution
+
+
+def cluster_mask(df, clustering_col, clusters):
+    """Boolean row mask selecting all rows of the given clusters."""
+    return df[clustering_col].isin(clusters).values
+
+
+def sweep_line_pairs(starts, ends, max_gap: float, groups=None):
+    """
+    All pairs of items of the same group whose [start, end] spans are at most max_gap apart.
+    Items are sorted once by (group, start); the partners of an item are the following items
+    starting no later than its end + max_gap, found with one searchsorted.
+    Returns the positions (first, second) of each pair, first being the earlier starting item.
+    """
+    starts = np.asarray(starts, dtype=np.float64)
+    ends = np.asarray(ends, dtype=np.float64)
+    groups = np.zeros(len(starts), dtype=np.int64) if groups is None else np.asarray(groups)
+    if len(starts) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    order = np.lexsort((starts, groups))
+    s = starts[order] - starts.min()
+    e = ends[order] - starts.min()
+    # group rank * offset + date keeps the (group, start) order and separates groups by more than max_gap
+    group_rank = np.concatenate([[0], np.cumsum(groups[order][1:] != groups[order][:-1])])
+    offset = e.max() + max_gap + 1
+    window_end = np.searchsorted(group_rank * offset + s, group_rank * offset + e + max_gap, side="right")
+    window_start = np.arange(len(order)) + 1
+    pair_counts = np.maximum(window_end - window_start, 0)
+
+    first = np.repeat(np.arange(len(order)), pair_counts)
+    partner_offsets = np.arange(pair_counts.sum()) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+    second = window_start[first] + partner_offsets
+    return order[first], order[second]
+
+
+def entity_overlap_pairs(entity_cluster_codes, entities, starts, ends, max_gap: float = 10, min_overlap: float = 0.5):
+    """
+    Candidate cluster pairs for merging: clusters at most max_gap days apart whose entity sets
+    overlap by at least min_overlap, measured as |A & B| / max(|A|, |B|).
+    entity_cluster_codes/entities list every (cluster, entity) once, starts/ends are the date spans
+    (in days) of the clusters, indexed by cluster code.
+    Only temporally near clusters sharing an entity are ever paired: a sweep line runs over the
+    posting list of every entity (inverted index) and the pair hits are the intersection sizes.
+    Returns the cluster codes (a, b) with a < b and their entity overlap.
+    """
+    entity_cluster_codes = np.asarray(entity_cluster_codes, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.float64)
+    ends = np.asarray(ends, dtype=np.float64)
+    entity_codes, _ = pd.factorize(pd.Series(entities, dtype=object))
+    first, second = sweep_line_pairs(starts[entity_cluster_codes], ends[entity_cluster_codes], max_gap,
+                                     groups=entity_codes)
+    a = np.minimum(entity_cluster_codes[first], entity_cluster_codes[second])
+    b = np.maximum(entity_cluster_codes[first], entity_cluster_codes[second])
+    pair_keys, intersection_sizes = np.unique(a * len(starts) + b, return_counts=True)
+    a, b = pair_keys // len(starts), pair_keys % len(starts)
+
+    entity_set_sizes = np.bincount(entity_cluster_codes, minlength=len(starts))
+    overlap = intersection_sizes / np.maximum(entity_set_sizes[a], entity_set_sizes[b])
+    keep = overlap >= min_overlap
+    return a[keep], b[keep], overlap[keep]
+
+
+class DisjointSet(object):
+    """Union-find over the integers 0..n-1; the root of every set is its smallest member."""
+    def __init__(self, n: int):
+        self.parent = np.arange(n)
+
+    def find(self, x):
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    def roots(self):
+        # parents always point to smaller members, so one ascending pass resolves every root
+        roots = self.parent.copy()
+        for x in range(len(roots)):
+            roots[x] = roots[roots[x]]
+        return roots
+
+
+def merge_connected_clusters(cluster_ids, edges_a, edges_b):
+    """
+    Merges clusters along the candidate edges (cluster codes) into connected components.
+    Returns the final cluster id of every cluster in cluster_ids, which is the id of the
+    first cluster of its component.
+    """
+    components = DisjointSet(len(cluster_ids))
+    for a, b in zip(edges_a, edges_b):
+        components.union(a, b)
+    return np.asarray(cluster_ids, dtype=object)[components.roots()]
@@ -1,7 +1,4 @@
 import json
-from collections import Counter
-from datetime import datetime
-from itertools import chain, combinations
 
 import pandas as pd
 import numpy as np
@@ -9,12 +6,21 @@ from tqdm import tqdm
 from pathlib import Path
 import requests
 import time
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import SentenceTransformer
 from json import JSONDecodeError
 import spacy
 from numpy import nan
-from sklearn.cluster import DBSCAN
 from event_data_processing import NaturalDisasterGdelt
+from clustering import temporal_dbscan_1d, largest_temporal_run, to_days, cluster_statistics, cluster_mask, \
+    entity_overlap_pairs, merge_connected_clusters, sweep_line_pairs, community_labels, has_cluster, to_cluster_ids
+from frame_layout import compact_frame
+from near_duplicates import near_duplicate_groups, collapse_near_duplicates, expand_near_duplicates, \
+    minhash_signatures, lsh_near_duplicate_groups
+from similarity import quantize_embeddings, community_detection, date_proximity_kernel, to_day_ordinals, \
+    blocked_cosine_topk
+from stage_cache import Stage, PipelineRunner
+from profiling import StageProfiler
+from sharded_clustering import ShardedClusterer, stitch_shards, time_shards
 import warnings
 from pandas.errors import SettingWithCopyWarning
 
@@ -22,18 +28,21 @@ warnings.simplefilter(action="ignore", category=SettingWithCopyWarning)
 
 
 class EventDeduplicationDataFrame(object):
-    def __init__(self, csv_path: str = None, aggregate_news: bool = False):
+    def __init__(self, csv_path: str = None, aggregate_news: bool = False, save_intermediate_csv: bool = False,
+                 encoder_model: str = "all-MiniLM-L6-v2"):
         self.root = Path("./data/gdelt_crawled/")
+        self.cache_dir = Path(self.root, "stage_cache")
+        self.save_intermediate_csv = save_intermediate_csv
         self.aggregated_news_all_event_path = Path(self.root, "aggregated_news_all_events.csv")
         if not aggregate_news and csv_path is None and not self.aggregated_news_all_event_path.exists():
             aggregate_news = True
         if aggregate_news:
             self.aggregate_news()
-            self.df = pd.read_csv(self.aggregated_news_all_event_path)
+            df = pd.read_csv(self.aggregated_news_all_event_path)
         elif csv_path:
-            self.df = pd.read_csv(csv_path)
+            df = pd.read_csv(csv_path)
         else:
-            self.df = pd.read_csv(self.aggregated_news_all_event_path)
+            df = pd.read_csv(self.aggregated_news_all_event_path)
 
         self.target_df_col = [
             'cluster_20_60', 'cluster_20_70', 'cluster_20_80', 'cluster_20_90',
@@ -45,42 +54,141 @@ class EventDeduplicationDataFrame(object):
             'temporal_cluster_100_60', 'temporal_cluster_100_70', 'temporal_cluster_100_80', 'temporal_cluster_100_90',
             'temporal_cluster_5_60', 'temporal_cluster_5_70', 'temporal_cluster_5_80', 'temporal_cluster_5_90',
             'pred_event_type', 'entities']
+        self.df = compact_frame(df, cluster_cols=[col for col in self.target_df_col if "cluster" in col],
+                                skip_cols=["entities"])
 
-        self.nlp = self.instantiate_spacy()
+        self.nlp = None
+        self.encoder = None
+        self.encoder_model = encoder_model
+        self.profiler = StageProfiler(profile_dir=Path(self.root, "profiles"))
+        self.final_outputs_saved = False
 
-    def instantiate_spacy(self):
-        if 'entities' not in self.df.columns:
-            nlp = spacy.load("en_core_web_md")
-            nlp.add_pipe("entityLinker", last=True)
-        else:
-            nlp = None
+    @staticmethod
+    def instantiate_spacy():
+        nlp = spacy.load("en_core_web_md")
+        nlp.add_pipe("entityLinker", last=True)
         return nlp
 
-    def create_silver_label(self):
+    def create_silver_label(self,
+                            min_samples: int = 3,
+                            eps: float = 1,
+                            max_gap: float = 10,
+                            min_overlap: float = 0.5,
+                            min_entity_count: int = 4,
+                            near_duplicate_threshold: float = 0.8,
+                            shard_window_days: float = None,
+                            shard_overlap_days: float = 7,
+                            precision: str = "float16",
+                            similarity_top_k: int = None):
+        """
+        Runs the de-noising stages through a content-hashed stage cache (see stage_cache.py):
+        a stage is only recomputed if its input, parameters or code changed, e.g. changing
+        min_overlap only re-runs the merge.
+        Near-duplicate titles are collapsed into one representative before annotation and clustering,
+        which count it as often as its multiplicity; the results are mapped back to all titles at the end.
+        With shard_window_days, titles are clustered in overlapping time windows in parallel
+        (see sharded_clustering.py). similarity_top_k bounds the similarities kept per title (see
+        similarity.community_detection), the default keeps all of them and is exact.
+        """
         df = self.df
         df['title'] = df['title'].astype(str)
         df['start_date'] = df['start_date'].astype(str)
-
         print(f"Raw dataset - Number of entires: {len(df)}")
-        df = self.remove_stick_in_title(df)
+
+        stages = [
+            Stage("deduplicated", self.deduplicate_titles, inputs=["raw"],
+                  code=[self.remove_stick_in_title]),
+            Stage("near_duplicate_groups", self.group_near_duplicates, inputs=["deduplicated"],
+                  params={"threshold": near_duplicate_threshold},
+                  code=[near_duplicate_groups, minhash_signatures, lsh_near_duplicate_groups]),
+            Stage("collapsed", collapse_near_duplicates, inputs=["near_duplicate_groups"]),
+            Stage("event_type", self.annotate_event_type, inputs=["collapsed"],
+                  code=[self.run_coypu_ee]),
+            Stage("entities", self.annotate_entity, inputs=["event_type"],
+                  code=[self.get_entity_from_spacy]),
+            Stage("clustered", self.cluster_stage, inputs=["entities"],
+                  params={"encoder_model": self.encoder_model, "precision": precision,
+                          "shard_window_days": shard_window_days, "shard_overlap_days": shard_overlap_days,
+                          "similarity_top_k": similarity_top_k},
+                  code=[self.cluster_titles, self.encode_titles, quantize_embeddings, community_detection,
+                        blocked_cosine_topk, date_proximity_kernel, community_labels, time_shards, stitch_shards]),
+            Stage("temporally_denoised", self.temporal_denoising_stage, inputs=["clustered"],
+                  params={"min_samples": min_samples, "eps": eps},
+                  code=[self.run_temporal_clustering, temporal_dbscan_1d, largest_temporal_run]),
+            Stage("oos_removed", self.oos_removal_stage, inputs=["temporally_denoised"],
+                  code=[self.remove_oos_clusters, cluster_statistics]),
+            Stage("merged", self.merge_stage, inputs=["oos_removed"],
+                  params={"max_gap": max_gap, "min_overlap": min_overlap, "min_entity_count": min_entity_count},
+                  code=[self.merge_cluster, entity_overlap_pairs, sweep_line_pairs, merge_connected_clusters]),
+            Stage("expanded", self.expand_stage, inputs=["merged", "near_duplicate_groups"],
+                  code=[expand_near_duplicates]),
+        ]
+        print(f"Denoising dataset with hierarchical clustering...")
+        self.profiler.reset()
+        runner = PipelineRunner(stages, cache_dir=self.cache_dir, profiler=self.profiler)
+        self.final_outputs_saved = False
+        df = runner.run({"raw": df}, targets=["expanded"])["expanded"]
+        if not self.final_outputs_saved:
+            # a cached expanded stage: the outputs may be those of a run with other parameters
+            self.save_final_outputs(df)
+        print(f"Merged dataset - Number of entires: {len(df)}")
+        self.profiler.write_report()
+        return df
+
+    def deduplicate_titles(self, df):
+        df = self.remove_stick_in_title(df.copy())
         print(f"Stick replaced dataset - Number of entires: {len(df)}")
-        df = df.drop_duplicates(subset='title', keep="last")
+        df = df.drop_duplicates(subset='title', keep="last").reset_index(drop=True)
         print(f"Dropped duplicates dataset - Number of entires: {len(df)}")
-        print(f"Denoising dataset with hierarchical clustering...")
-        print(f"")
-        print("    Annotating event type with a trained event detector on TREC-IS dataset...")
-        df = self.annotate_event_type(df, forced=False)
-        print("    Annotating entities and links to wikidata...")
-        df = self.annotate_entity(df, forced=False)
-        print("    Clustering all news titles with sentence bert...")
-        df = self.cluster_titles(df, forced=True)
+        return df
+
+    @staticmethod
+    def group_near_duplicates(df, threshold=0.8):
+        df = df.assign(duplicate_group=near_duplicate_groups(df["title"].values, threshold=threshold))
+        print(f"Near-duplicate titles collapsed - Number of entires: {df['duplicate_group'].nunique()}")
+        return df
+
+    def expand_stage(self, df, members):
+        # annotations and clusters are those of the representatives, also where the input already had them
+        df = expand_near_duplicates(df, members, derived_cols=self.target_df_col + ["new_cluster"])
+        # the outputs hold every title, not only the representatives the stages before ran on
+        self.save_final_outputs(df)
+        return df
+
+    @staticmethod
+    def get_multiplicity(df):
+        # number of near-duplicate titles a row stands for
+        return df["multiplicity"].values if "multiplicity" in df.columns else None
+
+    def cluster_stage(self, df, encoder_model="all-MiniLM-L6-v2", precision="float16", shard_window_days=None,
+                      shard_overlap_days=7, similarity_top_k=None):
+        if encoder_model != self.encoder_model:
+            self.encoder_model, self.encoder = encoder_model, None
+        return self.cluster_titles(df, precision=precision, shard_window_days=shard_window_days,
+                                   shard_overlap_days=shard_overlap_days, similarity_top_k=similarity_top_k)
+
+    def temporal_denoising_stage(self, df, min_samples=3, eps=1):
         print("    Running temporal 1d DBSCAN to remove similar, but temporally far news titles...")
-        df, df_outliers = self.run_temporal_clustering(df, min_samples=3, eps=1, forced=True)
+        df, _ = self.run_temporal_clustering(df, min_samples=min_samples, eps=eps, forced=True)
         print(f"Temporally valid dataset - Number of entires: {len(df)}")
-        df, df_oos = self.remove_oos_clusters(df, forced=True)
+        return df
+
+    def oos_removal_stage(self, df):
+        df, _ = self.remove_oos_clusters(df, forced=True)
         print(f"OOS removed dataset - Number of entires: {len(df)}")
-        self.clustering_analysis(df, forced=False)
-        self.merge_cluster(df)
+        return df
+
+    def merge_stage(self, df, max_gap=10, min_overlap=0.5, min_entity_count=4):
+        return self.merge_cluster(df, max_gap=max_gap, min_overlap=min_overlap, min_entity_count=min_entity_count)
+
+    def encode_titles(self, titles, batch_size: int = 512):
+        if self.encoder is None:
+            self.encoder = SentenceTransformer(self.encoder_model)
+        return self.encoder.encode(titles, batch_size=batch_size, show_progress_bar=True, convert_to_numpy=True)
+
+    def save_intermediate(self, df, file_name):
+        if self.save_intermediate_csv:
+            df.to_csv(Path(self.root, file_name), index=False)
 
     @staticmethod
     def aggregate_news():
@@ -100,19 +208,23 @@ class EventDeduplicationDataFrame(object):
                 end_index = batch_size * (i + 1)
                 event_types = self.run_coypu_ee(list(df["title"].values[start_index:end_index]))
                 all_event_types.extend(event_types)
-                if i % batch_size == 0:
+                if i % batch_size == 0 and self.save_intermediate_csv:
                     annotated_df = df.loc[:end_index - 1, :]
                     annotated_df.loc[:, ("pred_event_type")] = all_event_types
                     annotated_df.to_csv(Path(self.root, "annotated_event_news_all_events.csv"), index=False)
+            df["pred_event_type"] = all_event_types
             return df
 
     def annotate_entity(self, df, forced=False):
         if not forced and "entities" in df.columns:
             return df
         else:
+            if self.nlp is None:
+                self.nlp = self.instantiate_spacy()
             df["title"] = df['title'].astype(str)
-            df["entities"] = df["title"].map(self.get_entity_from_spacy)
-            df.to_csv(Path(self.root, "annotated_entity_news_all_events.csv"), index=False)
+            # JSON strings, as read from the csvs: dict cells do not survive the parquet stage cache
+            df["entities"] = df["title"].map(lambda title: json.dumps(self.get_entity_from_spacy(title)))
+            self.save_intermediate(df, "annotated_entity_news_all_events.csv")
             self.nlp = None  # save memory
             return df
 
@@ -143,25 +255,36 @@ class EventDeduplicationDataFrame(object):
 
     @staticmethod
     def remove_stick_in_title(df):
-        title_indicese_with_a_stick = [i for i, title in enumerate(df["title"].values) if "|" in title]
-        title_wo_stick = []
-        for title in tqdm(df.loc[title_indicese_with_a_stick, "title"]):
-            title_parts_len = [len(t) for t in title]
-            longest_part_index = title_parts_len.index(max(title_parts_len))
-            title_wo_stick.append(title[longest_part_index])
-        df.loc[title_indicese_with_a_stick, "title"] = title_wo_stick
+        """Keeps the longest "|"-separated part of every title (e.g. drops site names), with whitespace collapsed."""
+        titles = df["title"].astype(str)
+        parts = titles.str.split("|").explode().str.replace(r"\s+", " ", regex=True).str.strip()
+        title_parts = pd.DataFrame({"row": np.repeat(np.arange(len(titles)), titles.str.count(r"\|").values + 1),
+                                    "part": parts.values,
+                                    "length": parts.str.len().values})
+        longest_parts = title_parts.sort_values(["row", "length"], ascending=[True, False], kind="stable") \
+            .drop_duplicates("row")
+        df["title"] = longest_parts["part"].values
         return df
 
-    @staticmethod
-    def combine_columns(row):
-        return str(row['title']) + " (" + row['start_date'] + ")"
-
     def cluster_titles(self,
                        df,
                        batch_size: int = 512,
+                       precision: str = "float16",
+                       similarity_block_size: int = 2048,
+                       similarity_top_k: int = None,
+                       date_weight: float = 0.1,
+                       date_scale: float = 7.0,
+                       shard_window_days: float = None,
+                       shard_overlap_days: float = 7,
+                       n_jobs: int = None,
                        forced=False):
-        model = SentenceTransformer('all-MiniLM-L6-v2')
-        df['temporal_title'] = df.apply(self.combine_columns, axis=1)
+        """
+        cluster_* columns are communities of the title embeddings, temporal_cluster_* columns
+        are communities of the same embeddings where the similarity is mixed with the
+        publication-date proximity (see similarity.date_proximity_kernel).
+        Cluster ids are int32, rows in no community get clustering.NO_CLUSTER (-1).
+        If shard_window_days is given, all parameters are clustered per time window in n_jobs processes.
+        """
         cluster_cols = [col for col in self.target_df_col if "cluster" in col and "temporal" not in col]
         temporal_cluster_cols = [col for col in self.target_df_col if "temporal_cluster" in col]
         clustering_params = [col for col in cluster_cols if col not in df.columns]
@@ -170,117 +293,106 @@ class EventDeduplicationDataFrame(object):
         print("temporal_clustering_params", temporal_clustering_params)
 
         # cluster titles
-        corpus_embeddings = model.encode(df["title"].values, batch_size=batch_size,
-                                         show_progress_bar=True, convert_to_tensor=True)
+        with self.profiler.stage("clustered/encode", rows_in=len(df), dump=False) as record:
+            corpus_embeddings = quantize_embeddings(self.encode_titles(df["title"].values, batch_size=batch_size),
+                                                    precision=precision)
+            record["rows_out"] = len(corpus_embeddings)
+        if shard_window_days is not None:
+            self.cluster_titles_sharded(df, corpus_embeddings, clustering_params, temporal_clustering_params,
+                                        window_days=shard_window_days, overlap_days=shard_overlap_days,
+                                        n_jobs=n_jobs, block_size=similarity_block_size, top_k=similarity_top_k,
+                                        date_weight=date_weight, date_scale=date_scale)
+            clustering_params, temporal_clustering_params = [], []
         for params in tqdm(clustering_params):
             min_community_size = int(params.split("_")[-2])
             threshold = float(params.split("_")[-1])/100
             cluster_col_name = f"cluster_{min_community_size}_{str(threshold * 100)[:2]}"
             start_time = time.time()
             print(f"Start clustering (min_community_size={min_community_size}, threshold={threshold}) ...")
-            clusters = util.community_detection(corpus_embeddings,
-                                                min_community_size=min_community_size,
-                                                threshold=threshold,
-                                                batch_size=5120
-                                                )
+            with self.profiler.stage(f"clustered/{cluster_col_name}", rows_in=len(df), dump=False) as record:
+                clusters = community_detection(corpus_embeddings,
+                                               min_community_size=min_community_size,
+                                               threshold=threshold,
+                                               block_size=similarity_block_size,
+                                               weights=self.get_multiplicity(df),
+                                               top_k=similarity_top_k)
+                df[cluster_col_name] = community_labels(len(df), clusters)
+                record["rows_out"] = int((df[cluster_col_name] >= 0).sum())
             print(f"Clustering (min_community_size={min_community_size}, threshold={threshold}) done after {time.time()-start_time} sec")
 
-            cluster_col = {}
-            for i, cluster in enumerate(clusters):
-                cluster_i_dict = {sent_id: i for sent_id in cluster}
-                cluster_col.update(cluster_i_dict)
-
-            df[cluster_col_name] = df.index.to_series().apply(lambda x: cluster_col.get(x, nan))
-            df.to_csv(Path(self.root, "clustered_news_all_events.csv"), index=False)
-
-        # temporal cluster titles
-        corpus_embeddings = model.encode(df["temporal_title"].values, batch_size=batch_size,
-                                         show_progress_bar=True, convert_to_tensor=True)
-
+        # temporal cluster titles, reusing the title embeddings
+        temporal_kernel = date_proximity_kernel(to_day_ordinals(pd.to_datetime(df["start_date"]).values),
+                                                date_weight=date_weight,
+                                                date_scale=date_scale)
         for params in tqdm(temporal_clustering_params):
             min_community_size = int(params.split("_")[-2])
             threshold = float(params.split("_")[-1]) / 100
-            cluster_col_name = f"cluster_{min_community_size}_{str(threshold * 100)[:2]}"
             start_time = time.time()
             print(f"Start temporal clustering (min_community_size={min_community_size}, threshold={threshold}) ...")
-            clusters = util.community_detection(corpus_embeddings,
-                                                min_community_size=min_community_size,
-                                                threshold=threshold,
-                                                batch_size=5120
-                                                )
+            with self.profiler.stage(f"clustered/{params}", rows_in=len(df), dump=False) as record:
+                clusters = community_detection(corpus_embeddings,
+                                               min_community_size=min_community_size,
+                                               threshold=threshold,
+                                               block_size=similarity_block_size,
+                                               pairwise_kernel=temporal_kernel,
+                                               weights=self.get_multiplicity(df),
+                                               top_k=similarity_top_k)
+                df[params] = community_labels(len(df), clusters)
+                record["rows_out"] = int((df[params] >= 0).sum())
             print(
                 f"Temporal clustering (min_community_size={min_community_size}, threshold={threshold}) done after {time.time() - start_time} sec")
-
-            cluster_col = {}
-            for i, cluster in enumerate(clusters):
-                cluster_i_dict = {sent_id: i for sent_id in cluster}
-                cluster_col.update(cluster_i_dict)
-
-            df[cluster_col_name] = df.index.to_series().apply(lambda x: cluster_col.get(x, nan))
-            df.to_csv(Path(self.root, "clustered_news_all_events.csv"), index=False)
+        self.save_intermediate(df, "clustered_news_all_events.csv")
         return df
 
+    def cluster_titles_sharded(self, df, corpus_embeddings, clustering_params, temporal_clustering_params,
+                               window_days=30, overlap_days=7, n_jobs=None, block_size=2048,
+                               date_weight=0.1, date_scale=7.0, top_k=None):
+        sharded_params = [{"name": params,
+                           "min_community_size": int(params.split("_")[-2]),
+                           "threshold": float(params.split("_")[-1]) / 100,
+                           "temporal": params in temporal_clustering_params}
+                          for params in clustering_params + temporal_clustering_params]
+        clusterer = ShardedClusterer(Path(self.root, "shards"), window_days=window_days, overlap_days=overlap_days,
+                                     n_jobs=n_jobs, block_size=block_size, date_weight=date_weight,
+                                     date_scale=date_scale, top_k=top_k)
+        with self.profiler.stage("clustered/sharded", rows_in=len(df), dump=False) as record:
+            days = to_day_ordinals(pd.to_datetime(df["start_date"]).values)
+            labels = clusterer.fit(corpus_embeddings, days, sharded_params, weights=self.get_multiplicity(df))
+            for params, cluster_ids in labels.items():
+                df[params] = cluster_ids
+            record["rows_out"] = len(df)
+
     def run_temporal_clustering(self, df, min_samples=3, eps=1, clustering_col="cluster_50_90", forced=False):
         if not forced and Path(self.root, "temporally_denoised_news.csv").exists() and Path(self.root, "temporally_noisy_news.csv").exists():
             return df, None
         else:
             df['start_date'] = pd.to_datetime(df['start_date'])
-            df_removed_outliers = []
-            df_outliers = []
-
-            for i, cluster in tqdm(enumerate(df[clustering_col].unique())):
-                if not np.isnan(cluster):
-                    cluster_i = df.loc[df[clustering_col] == cluster]
-                    cluster_i["normalized_date"] = (cluster_i["start_date"].values - min(
-                        cluster_i["start_date"].values)) / np.timedelta64(1, 'D')
-                    clustering = DBSCAN(eps=eps, min_samples=min_samples).fit(np.reshape(cluster_i["normalized_date"].values, (-1, 1)))
-
-                    outlier_indices = np.where(clustering.labels_ == -1)[0]
-                    # outlier_dates = cluster_i["start_date"].values[outlier_indices]
-                    # outlier_title = cluster_i["title"].values[outlier_indices]
-                    # outlier_pred_event_type = cluster_i["pred_event_type"].values[outlier_indices]
-                    outlier_df = cluster_i.iloc[outlier_indices, :]
-                    df_outliers.append(outlier_df)
-
-                    most_populated_cluster = self.most_common(list(clustering.labels_))
-                    if most_populated_cluster != -1:
-                        most_populated_cluster_indices = np.where(clustering.labels_ == most_populated_cluster)[0]
-                        # most_populated_cluster_dates = cluster_i["start_date"].values[most_populated_cluster_indices]
-                        # most_populated_cluster_title = cluster_i["title"].values[most_populated_cluster_indices]
-                        # most_populated_cluster_pred_event_type = cluster_i["pred_event_type"].values[
-                        #     most_populated_cluster_indices]
-                        most_popular_cluster_df = cluster_i.iloc[most_populated_cluster_indices, :]
-                        df_removed_outliers.append(most_popular_cluster_df)
-
-                        # print(
-                        #     f"Cluster {cluster}: \n Outlier dates: {outlier_dates}\n Outlier title: {outlier_title}\n Outlier pred_event_type: {outlier_pred_event_type} \n most popular cluster: {most_populated_cluster}\n most popular cluster dates: {most_populated_cluster_dates}\n most popular cluster title: {most_populated_cluster_title}\n most popular cluster pred_event_type: {most_populated_cluster_pred_event_type}\n\n")
-            df_removed_outliers = pd.concat(df_removed_outliers, ignore_index=True) if df_removed_outliers else None
-            df_outliers = pd.concat(df_outliers, ignore_index=True)
-            df_removed_outliers.to_csv(Path(self.root, "temporally_denoised_news.csv"), index=False)
-            df_outliers.to_csv(Path(self.root, "temporally_noisy_news.csv"), index=False)
+            cluster_ids = df[clustering_col].values.astype(np.float64)
+            labels, run_cluster_ids = temporal_dbscan_1d(cluster_ids, to_days(df['start_date'].values),
+                                                         eps=eps, min_samples=min_samples,
+                                                         weights=self.get_multiplicity(df))
+            most_populated_run = largest_temporal_run(labels, cluster_ids, run_cluster_ids,
+                                                      weights=self.get_multiplicity(df))
+            outliers = (labels == -1) & has_cluster(cluster_ids)
+
+            df_removed_outliers = df.loc[most_populated_run].reset_index(drop=True)
+            df_outliers = df.loc[outliers].reset_index(drop=True)
+            self.save_intermediate(df_removed_outliers, "temporally_denoised_news.csv")
+            self.save_intermediate(df_outliers, "temporally_noisy_news.csv")
             return df_removed_outliers, df_outliers
 
-    @staticmethod
-    def most_common(lst):
-        return max(set(lst), key=lst.count)
-
     def remove_oos_clusters(self, df, clustering_col="cluster_50_90", forced=False):
         if not forced and Path(self.root, "oos_removed_news.csv").exists() and Path(self.root, "oos_news.csv").exists():
-            return df
+            return df, None
         else:
-            df_list = []
-            oos_df_list = []
-            for cluster_id in tqdm(df[clustering_col].unique()):
-                unique_clusters = df.loc[df[clustering_col] == cluster_id, "pred_event_type"].unique()
-                if not (len(unique_clusters) == 1 and unique_clusters[0] == 'oos'):
-                    df_list.append(df.loc[df[clustering_col] == cluster_id])
-                else:
-                    oos_df_list.append(df.loc[df[clustering_col] == cluster_id])
-            oos_removed_df = pd.concat(df_list, ignore_index=True)
-            oos_removed_df.to_csv(Path(self.root, "oos_removed_news.csv"), index=False)
-            if oos_df_list:
-                oos_df = pd.concat(oos_df_list, ignore_index=True)
-                oos_df.to_csv(Path(self.root, "oos_news.csv"), index=False)
+            stats, _ = cluster_statistics(df, clustering_col, weights=self.get_multiplicity(df))
+            oos_clusters = stats.index[stats["oos_purity"] == 1]
+            oos_mask = cluster_mask(df, clustering_col, oos_clusters)
+            oos_removed_df = df.loc[cluster_mask(df, clustering_col, stats.index) & ~oos_mask].reset_index(drop=True)
+            self.save_intermediate(oos_removed_df, "oos_removed_news.csv")
+            if oos_mask.any():
+                oos_df = df.loc[oos_mask].reset_index(drop=True)
+                self.save_intermediate(oos_df, "oos_news.csv")
             else:
                 oos_df = None
             return oos_removed_df, oos_df
@@ -302,143 +414,83 @@ class EventDeduplicationDataFrame(object):
                 dfs_oos_removed.append(oos_removed_df)
                 dfs_oos.append(oos_df)
 
-            final_df = []
-            for cluster in df_outlier_removed[clustering_col[0]].unique():
-                cluster_df = df_outlier_removed.loc[df_outlier_removed['cluster_50_70'] == cluster]
-                try:
-                    most_common_event_type = cluster_df['pred_event_type'].value_counts().index[0]
-                except IndexError:
-                    most_common_event_type = "oos"
-                if most_common_event_type in ["tropical_storm", "flood"]:
-                    final_df.append(cluster_df)
-            final_df = pd.concat(final_df, ignore_index=True) if final_df else None
+            stats, _ = cluster_statistics(df_outlier_removed, clustering_col[0],
+                                          weights=self.get_multiplicity(df_outlier_removed))
+            storm_clusters = stats.index[stats["majority_event_type"].isin(["tropical_storm", "flood"])]
+            final_df = df_outlier_removed.loc[cluster_mask(df_outlier_removed, clustering_col[0], storm_clusters)]
+            final_df = final_df.reset_index(drop=True)
             final_df.to_csv(Path(self.root, "final_df.csv"), index=False)
             print(f"Final df: {len(final_df)}")
             print(f"Unique clusters: {len(final_df[clustering_col[0]].unique())}")
 
-    def merge_cluster(self, df):
-        cluster_linked_entity_maps = {}
-        cluster_entity_maps = {}
-        cluster_event_type_maps = {}
-        cluster_timestamp_map = {}
-        cluster_gpe_maps = {}
-        df["cluster_50_70"] = df["cluster_50_70"].astype("string")
-        for i, cluster in enumerate(df["cluster_50_70"].unique()):
-            cluster_i = df.loc[df["cluster_50_70"] == cluster]
-            linked_entity_mentions = []
-            entity_mentions = []
-            gpe_mentions = []
-            for index, instance in cluster_i.iterrows():
-                entity = instance["entities"]
-                if "\\xa0" in entity:
-                    entity = entity.replace('\\xa0', ' ')
-                entities = json.loads(entity.replace("'", '"'))
-                linked_entity_mentions.extend(list(entities["linked_entitiy"].keys()))
-                entity_mentions.extend(list(entities["entity_type"].keys()))
-                gpe_mentions.extend(
-                    [entity for entity, entity_type in entities["entity_type"].items() if entity_type == "GPE"])
-
-            cluster_linked_entity_maps[cluster] = dict(Counter(linked_entity_mentions))
-            cluster_entity_maps[cluster] = dict(Counter(entity_mentions))
-            cluster_event_type_maps[cluster] = dict(cluster_i["pred_event_type"].value_counts())
-            cluster_timestamp_map[cluster] = dict(cluster_i["start_date"].value_counts())
-            cluster_gpe_maps[cluster] = dict(Counter(gpe_mentions))
-
-        self.filtered_cluster_entity_maps = self.filter_cluster_entity(cluster_entity_maps)
-
+    def merge_cluster(self, df, max_gap=10, min_overlap=0.5, min_entity_count=4):
+        # int32 ids, so that merged components are named after their numerically smallest cluster
+        df["cluster_50_70"] = to_cluster_ids(df["cluster_50_70"])
         df_merged = df
 
-        cluster_id = list(self.filtered_cluster_entity_maps.keys())
-        index_combinations = list(combinations(cluster_id, 2))
-
-        similarities = list(map(self.compare_list_of_strings, index_combinations))
-        similarity_cluster_dict = dict(zip(index_combinations, similarities))
-        temporal_similarity_cluster_dict = {}
-        merged_clusters = []
-        for i, (clusters, value) in enumerate(similarity_cluster_dict.items()):
-            min_1 = datetime.strptime(
-                min(df_merged.loc[df_merged['cluster_50_70'] == clusters[0]]['start_date'].values), "%Y-%m-%d")
-            max_1 = datetime.strptime(
-                max(df_merged.loc[df_merged['cluster_50_70'] == clusters[0]]['start_date'].values), "%Y-%m-%d")
-            min_2 = datetime.strptime(
-                min(df_merged.loc[df_merged['cluster_50_70'] == clusters[1]]['start_date'].values), "%Y-%m-%d")
-            max_2 = datetime.strptime(
-                max(df_merged.loc[df_merged['cluster_50_70'] == clusters[1]]['start_date'].values), "%Y-%m-%d")
-
-            a_within_b = min_2 <= min_1 <= max_2 and min_2 <= max_1 <= max_2
-            b_within_a = min_1 <= min_2 <= max_1 and min_1 <= max_2 <= max_1
-            a_overlaps_b = (min_1 <= min_2 <= max_1 <= max_2) or (min_2 <= min_1 <= max_2 <= max_1)
-            b_overlaps_a = (min_2 <= min_1 <= max_2 <= max_1) or (min_1 <= min_2 <= max_1 <= max_2)
-            if a_within_b or b_within_a or a_overlaps_b or b_overlaps_a:
-                cluster_distance = 0
-            elif max_1 <= min_2:
-                cluster_distance = self.day_difference(max_1, min_2)
-            else:
-                cluster_distance = self.day_difference(min_1, max_2)
-
-            temporal_similarity_cluster_dict[clusters] = cluster_distance
-            if cluster_distance <= 10:
-                if value >= 0.5:
-                    merged_clusters.append(list(clusters))
-
-        cluster_combinations = list(combinations(merged_clusters, 2))
-        updated_clusters = []
-
-        for i, clusters in enumerate(cluster_combinations):
-            if self.cluster_has_overlap(clusters[0], clusters[1]):
-                merge = False
-                merge_index = 0
-                if i == 0:
-                    updated_clusters.append(list(chain(*clusters)))
-                else:
-                    for cluster_pair in clusters:
-                        for c in cluster_pair:
-                            for i, updated_cluster in enumerate(updated_clusters):
-                                if c in updated_cluster:
-                                    merge = True
-                                    merge_index = i
-                    if merge:
-                        updated_clusters[merge_index].extend(list(chain(*clusters)))
-                    else:
-                        updated_clusters.append(list(chain(*clusters)))
-
-        clusters_to_merge = [list(set(c)) for c in updated_clusters]
-        cluster_col = df_merged["cluster_50_70"]
-        for i, cluster in enumerate(clusters_to_merge):
-            cluster_col = cluster_col.replace([str(c) for c in cluster[1:]], str(cluster[0]))
-
-        df_merged["new_cluster"] = cluster_col.values
-        df_merged.to_csv("./data/gdelt_crawled/final_df_v1.csv", index=False)
+        # per-cluster date spans
+        stats, _ = cluster_statistics(df_merged, "cluster_50_70", weights=self.get_multiplicity(df_merged))
+        cluster_id = stats.index
+        first_days = to_days(stats["first_date"].values)
+        last_days = to_days(stats["last_date"].values)
+
+        frequent_entities = self.get_frequent_entities(df_merged, "cluster_50_70", min_entity_count)
+        # rows without a cluster_50_70 cluster (NO_CLUSTER) have no span and are not merged
+        frequent_entities = frequent_entities.loc[cluster_id.get_indexer(frequent_entities["cluster"]) >= 0]
+        cluster_a, cluster_b, _ = entity_overlap_pairs(cluster_id.get_indexer(frequent_entities["cluster"]),
+                                                       frequent_entities["entity"].values,
+                                                       first_days, last_days,
+                                                       max_gap=max_gap, min_overlap=min_overlap)
+        merged_cluster_id = merge_connected_clusters(cluster_id, cluster_a, cluster_b)
+
+        cluster_codes = cluster_id.get_indexer(df_merged["cluster_50_70"])
+        merged_cluster_id = merged_cluster_id.astype(np.int64)
+        df_merged["new_cluster"] = pd.array(np.where(cluster_codes >= 0, merged_cluster_id[np.maximum(cluster_codes, 0)]
+                                                     .astype(str), None), dtype="string")
+        df_merged["cluster_50_70"] = df_merged["cluster_50_70"].astype("string")
+        return df_merged
 
     @staticmethod
-    def filter_cluster_entity(cluster_entity_maps):
-        cluster_entity = {}
-        for c, entities in cluster_entity_maps.items():
-            tmp_dict = {}
-            for entity, count in entities.items():
-                if count > 4:
-                    tmp_dict[entity] = count
-            cluster_entity[c] = tmp_dict
-        return cluster_entity
-
-    def compare_list_of_strings(self, tuple_of_str):
-        list_1 = self.filtered_cluster_entity_maps[tuple_of_str[0]]
-        list_2 = self.filtered_cluster_entity_maps[tuple_of_str[1]]
-        try:
-            return len(set(list_1).intersection(set(list_2))) / max(len(list_1), len(list_2))
-        except ZeroDivisionError:
-            return 0
+    def get_merge_provenance(df):
+        """Number of titles of every cluster_50_70 cluster merged into a new_cluster."""
+        clustered = df.loc[df["new_cluster"].notna(), ["new_cluster", "cluster_50_70"]].astype(np.int64)
+        merge_provenance = clustered.value_counts(sort=False).rename("size").reset_index()
+        return merge_provenance.sort_values(["new_cluster", "cluster_50_70"], ignore_index=True)
 
-    @staticmethod
-    def day_difference(d1, d2):
-        delta = d2 - d1
-        return abs(delta.days)
+    def save_final_outputs(self, df):
+        df.to_csv(Path(self.root, "final_df_v1.csv"), index=False)
+        self.get_merge_provenance(df).to_csv(Path(self.root, "merge_provenance_v1.csv"), index=False)
+        self.final_outputs_saved = True
 
     @staticmethod
-    def cluster_has_overlap(c1, c2):
-        intersection = list(set(c1).intersection(set(c2)))
-        return len(intersection) > 0
+    def get_frequent_entities(df, clustering_col, min_entity_count=4):
+        """
+        (cluster, entity) pairs of entities mentioned more than min_entity_count times in a cluster,
+        a mention in a collapsed title counts as often as its multiplicity.
+        """
+        multiplicity = EventDeduplicationDataFrame.get_multiplicity(df)
+        entity_mentions = pd.DataFrame({"cluster": df[clustering_col].values,
+                                        "entity": df["entities"].map(EventDeduplicationDataFrame.get_entity_mentions).values,
+                                        "count": 1 if multiplicity is None else multiplicity})
+        entity_mentions = entity_mentions.explode("entity").dropna()
+        entity_counts = entity_mentions.groupby(["cluster", "entity"])["count"].sum()
+        return entity_counts[entity_counts > min_entity_count].reset_index()
 
+    @staticmethod
+    def get_entity_mentions(entity):
+        if isinstance(entity, dict):
+            return list(entity["entity_type"].keys())
+        if not isinstance(entity, str):
+            return []
+        try:
+            return list(json.loads(entity)["entity_type"].keys())
+        except JSONDecodeError:
+            pass
+        # the Python repr written by earlier versions
+        if "\\xa0" in entity:
+            entity = entity.replace('\\xa0', ' ')
+        entities = json.loads(entity.replace("'", '"'))
+        return list(entities["entity_type"].keys())
 
 
 if __name__ == "__main__":
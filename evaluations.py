@@ -1,7 +1,10 @@
 import pickle
 
+import numpy as np
 import pandas as pd
 
+from models.SentencePairs import SentencePairs
+
 
 # class EventDurationPredictionDataset(object):
 #     def __init__(self):
@@ -82,15 +85,11 @@ if __name__ == "__main__":
                     # df = get_sentence_indices_in_df(df, label_pkl, prediction_pkl, stratified_sample_indices_path,
                     #                                      sentence_pairs_indices_path, output_path)
                     # print(f"sentence pair df (len: {len(df)}) saved in {output_path}")
-                    df_path = f"./data/{data_type}/{task}/{mode}.csv"
-                    df = pd.read_csv(df_path)
-                    print(f"sentence pair df len: {len(df)})")
-                    print(f"unique sentence_a len: {len(df.sentence_a.value_counts())})")
-                    print(f"unique sentence_b len: {len(df.sentence_b.value_counts())})")
-                    print(f"unique event_a len: {len(df.event_a.value_counts())})")
-                    print(f"unique event_b len: {len(df.event_b.value_counts())})")
-                    print(f"unique time_a len: {len(df.time_a.value_counts())})")
-                    print(f"unique time_b len: {len(df.time_b.value_counts())})")
-                    print(f"unique labels len: {len(df.labels.value_counts())})")
+                    pairs = SentencePairs(f"./data/{data_type}/{task}/{mode}_v3_pairs")
+                    print(f"sentence pair df len: {len(pairs)})")
+                    for side, rows in [("a", pairs.a), ("b", pairs.b)]:
+                        for col in ["sentence", "event", "time"]:
+                            print(f"unique {col}_{side} len: {len(np.unique(pairs.column(col)[rows].astype(str)))})")
+                    print(f"unique labels len: {len(np.unique(pairs.labels))})")
                     print("")
 
@@ -0,0 +1,49 @@
+import pandas as pd
+
+from clustering import to_cluster_ids
+
+try:
+    import pyarrow  # noqa: F401
+    ARROW_STRINGS_AVAILABLE = True
+except ImportError:
+    ARROW_STRINGS_AVAILABLE = False
+
+
+def memory_report(df):
+    """Deep memory usage (MB) and dtype of every column, largest first, with the total as last row."""
+    usage = df.memory_usage(deep=True, index=True) / 2 ** 20
+    report = pd.DataFrame({"dtype": df.dtypes.astype(str).reindex(usage.index).fillna("index"), "MB": usage})
+    report = report.sort_values("MB", ascending=False)
+    report.loc["total"] = ["", usage.sum()]
+    return report
+
+
+def compact_frame(df, cluster_cols: list = (), skip_cols: list = (), max_category_ratio: float = 0.5,
+                  verbose: bool = True):
+    """
+    Compact in-memory layout of the news frame:
+        - cluster columns as int32 with the NO_CLUSTER (-1) sentinel instead of float64 with NaN,
+        - string columns with few distinct values (domains, countries, languages, event types, dates, ...)
+          as categoricals, i.e. one int code per row plus one copy of every distinct string,
+        - the remaining, mostly unique string columns (titles, urls) as arrow strings if pyarrow is installed.
+    skip_cols are left as they are, e.g. serialized columns which are parsed row by row.
+    """
+    before = memory_report(df).loc["total", "MB"]
+    df = df.copy()
+    for col in cluster_cols:
+        if col in df.columns:
+            df[col] = to_cluster_ids(df[col].values)
+
+    for col in df.columns[df.dtypes == object]:
+        values = df[col]
+        if col in skip_cols or pd.api.types.infer_dtype(values, skipna=True) != "string":
+            continue
+        if values.nunique() <= max_category_ratio * len(values):
+            df[col] = values.astype("category")
+        elif ARROW_STRINGS_AVAILABLE:
+            df[col] = values.astype("string[pyarrow]")
+
+    if verbose:
+        after = memory_report(df).loc["total", "MB"]
+        print(f"Frame memory: {before:.1f} MB -> {after:.1f} MB ({len(df)} rows, {len(df.columns)} columns)")
+    return df
@@ -0,0 +1,382 @@
+import argparse
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from clustering import temporal_dbscan_1d, largest_temporal_run, to_days, cluster_statistics, \
+    entity_overlap_pairs, merge_connected_clusters, community_labels, to_cluster_ids, \
+    NO_CLUSTER
+from create_silver_label import EventDeduplicationDataFrame
+from similarity import normalize_embeddings, community_detection
+
+
+CLUSTER_TABLE_KEYS = ["ids", "sums", "counts", "first_days", "last_days", "new_clusters"]
+
+
+class IncrementalSilverLabeler(object):
+    """
+    Keeps a silver-labelled corpus (the output of EventDeduplicationDataFrame.create_silver_label) up to
+    date with newly crawled titles, at a cost proportional to the number of new titles:
+        1. new titles are de-duplicated against the corpus, annotated and embedded,
+        2. assigned to the cluster with the nearest centroid if it is within the clustering threshold,
+        3. unassigned titles are buffered until they form new communities of min_community_size; titles more
+           than max_buffer_days older than the newest buffered title are dropped, as is the oldest beyond
+           max_buffer_size titles, so re-clustering the buffer costs at most the volume of that window,
+        4. temporal DBSCAN and OOS removal are re-run for the changed clusters only,
+        5. changed clusters are merged with temporally near clusters by entity overlap.
+    The state lives in state_dir: the labelled frame and its title embeddings as append-only shards (every
+    update writes its new titles plus the removed rows and merged clusters of older ones, see compact),
+    the cluster table (centroid sums, sizes, date spans and merged cluster of every cluster) and the buffer.
+    The updated silver-labelled csv is written to output_path (default: state_dir/silver_labelled.csv).
+
+    Titles join clusters of clustering_col, the cluster_50_70 communities which create_silver_label merges
+    into new_cluster; its temporal denoising on the finer cluster_50_90 has no incremental counterpart, the
+    changed clusters are denoised on clustering_col instead.
+    """
+    def __init__(self,
+                 state_dir: str = "./data/gdelt_crawled/incremental",
+                 output_path: str = None,
+                 clustering_col: str = "cluster_50_70",
+                 min_community_size: int = 50,
+                 threshold: float = 0.7,
+                 min_samples: int = 3,
+                 eps: float = 1,
+                 max_gap: float = 10,
+                 min_overlap: float = 0.5,
+                 min_entity_count: int = 4,
+                 max_buffer_days: float = 7,
+                 max_buffer_size: int = 20000):
+        self.state_dir = Path(state_dir)
+        self.clustering_col = clustering_col
+        self.min_community_size = min_community_size
+        self.threshold = threshold
+        self.min_samples = min_samples
+        self.eps = eps
+        self.max_gap = max_gap
+        self.min_overlap = min_overlap
+        self.min_entity_count = min_entity_count
+        self.max_buffer_days = max_buffer_days
+        self.max_buffer_size = max_buffer_size
+        self.output_path = Path(output_path) if output_path is not None else Path(self.state_dir, "silver_labelled.csv")
+
+        self.shard_dir = Path(self.state_dir, "shards")
+        self.meta_path = Path(self.state_dir, "state.json")
+        self.buffer_path = Path(self.state_dir, "buffered_news.pkl")
+        self.buffer_embeddings_path = Path(self.state_dir, "buffered_embeddings.npy")
+        self.centroids_path = Path(self.state_dir, "centroids.npz")
+
+    def initialize(self, labelled_csv_path: str):
+        dataset = EventDeduplicationDataFrame(labelled_csv_path)
+        df = dataset.df
+        df[self.clustering_col] = self.cluster_id_strings(df[self.clustering_col])
+        df["new_cluster"] = self.cluster_id_strings(df["new_cluster"])
+        df["start_date"] = pd.to_datetime(df["start_date"])
+        embeddings = normalize_embeddings(dataset.encode_titles(df["title"].values)).astype(np.float16)
+        self.df, self.embeddings = df, embeddings
+        self.buffer, self.buffer_embeddings = df.iloc[:0].copy(), embeddings[:0]
+        self.cluster_table = self.get_cluster_table(df, embeddings)
+        self.next_cluster_id = int(to_cluster_ids(self.cluster_table["ids"]).max(initial=-1)) + 1
+        self.rewrite_state()
+        print(f"Initialized incremental state with {len(df)} titles in {len(self.cluster_table['ids'])} clusters.")
+
+    def update(self, new_csv_path: str):
+        self.load_state()
+        dataset = EventDeduplicationDataFrame(new_csv_path)
+        new = dataset.df
+        new["title"] = new["title"].astype(str)
+        new["start_date"] = new["start_date"].astype(str)
+        new = dataset.deduplicate_titles(new)
+        new = new.loc[~new["title"].isin(self.df["title"]) & ~new["title"].isin(self.buffer["title"])]
+        new = new.reset_index(drop=True)
+        print(f"New titles - Number of entires: {len(new)}")
+        if len(new) == 0:
+            return self.df
+
+        new = dataset.annotate_event_type(new)
+        new = dataset.annotate_entity(new)
+        new["start_date"] = pd.to_datetime(new["start_date"])
+        new_embeddings = normalize_embeddings(dataset.encode_titles(new["title"].values)).astype(np.float16)
+
+        assigned = self.assign_to_nearest_centroid(new, new_embeddings)
+        print(f"Assigned to existing clusters: {assigned.sum()}/{len(new)}")
+        incoming, incoming_embeddings = self.cluster_buffer(new.loc[~assigned], new_embeddings[~assigned])
+        incoming = pd.concat([new.loc[assigned], incoming], ignore_index=True)
+        incoming_embeddings = np.concatenate([new_embeddings[assigned], incoming_embeddings])
+        incoming["new_cluster"] = incoming["new_cluster"].fillna(incoming[self.clustering_col]).astype("string")
+        changed_clusters = incoming[self.clustering_col].unique()
+
+        rows_before = self.num_rows
+        self.df = pd.concat([self.df, incoming], ignore_index=True)
+        self.embeddings = np.concatenate([self.embeddings, incoming_embeddings])
+        self.row_ids = np.concatenate([self.row_ids, np.arange(rows_before, rows_before + len(incoming))])
+        self.num_rows += len(incoming)
+        self.removed_row_ids, self.relabel = [], {}
+        self.denoise_changed_clusters(changed_clusters)
+        self.update_cluster_table(changed_clusters)
+        self.merge_changed_clusters(changed_clusters)
+        self.write_shard(rows_before)
+        self.save_state()
+        self.df.to_csv(self.output_path, index=False)
+        print(f"Updated dataset - Number of entires: {len(self.df)}, buffered: {len(self.buffer)}")
+        return self.df
+
+    def assign_to_nearest_centroid(self, new, new_embeddings, block_size: int = 1024):
+        cluster_ids = self.cluster_table["ids"]
+        assigned = np.zeros(len(new), dtype=bool)
+        if len(cluster_ids) == 0:
+            return assigned
+        centroids = normalize_embeddings(self.cluster_table["sums"])
+        nearest = np.zeros(len(new), dtype=np.int64)
+        for start in range(0, len(new), block_size):
+            scores = new_embeddings[start:start + block_size].astype(np.float32) @ centroids.T
+            nearest[start:start + block_size] = scores.argmax(axis=1)
+            assigned[start:start + block_size] = scores.max(axis=1) >= self.threshold
+        new[self.clustering_col] = pd.array(np.where(assigned, cluster_ids[nearest], None), dtype="string")
+        new["new_cluster"] = pd.array(np.where(assigned, self.cluster_table["new_clusters"][nearest], None),
+                                      dtype="string")
+        return assigned
+
+    def cluster_buffer(self, unassigned, unassigned_embeddings):
+        """Adds the unassigned titles to the buffer and returns the buffered titles forming new communities."""
+        self.buffer = pd.concat([self.buffer, unassigned], ignore_index=True)
+        self.buffer_embeddings = np.concatenate([self.buffer_embeddings, unassigned_embeddings])
+        self.evict_buffer()
+        communities = community_detection(self.buffer_embeddings,
+                                          threshold=self.threshold,
+                                          min_community_size=self.min_community_size)
+        if len(self.buffer) == 0 or not communities:
+            return self.buffer.iloc[:0].copy(), self.buffer_embeddings[:0]
+
+        community_ids = community_labels(len(self.buffer), communities)
+        clustered = community_ids >= 0
+        formed = self.buffer.loc[clustered].reset_index(drop=True)
+        # ids are never reused, not even those of clusters removed by the denoising
+        formed[self.clustering_col] = pd.array((community_ids[clustered] + self.next_cluster_id).astype(str),
+                                               dtype="string")
+        self.next_cluster_id += len(communities)
+        formed["new_cluster"] = formed[self.clustering_col]
+        formed_embeddings = self.buffer_embeddings[clustered]
+        print(f"New communities from buffer: {len(communities)} ({clustered.sum()} titles)")
+
+        self.buffer = self.buffer.loc[~clustered].reset_index(drop=True)
+        self.buffer_embeddings = self.buffer_embeddings[~clustered]
+        return formed, formed_embeddings
+
+    def evict_buffer(self):
+        """Drops the buffered titles outside the max_buffer_days window and the oldest beyond max_buffer_size."""
+        if len(self.buffer) == 0:
+            return
+        days = to_days(self.buffer["start_date"].values)
+        keep = days >= days.max() - self.max_buffer_days
+        if keep.sum() > self.max_buffer_size:
+            newest = np.argsort(-days, kind="stable")[:self.max_buffer_size]
+            keep = np.zeros(len(days), dtype=bool)
+            keep[newest] = True
+        if not keep.all():
+            print(f"Evicted {(~keep).sum()} buffered titles older than {self.max_buffer_days} days or beyond "
+                  f"{self.max_buffer_size} titles")
+            self.buffer = self.buffer.loc[keep].reset_index(drop=True)
+            self.buffer_embeddings = self.buffer_embeddings[keep]
+
+    @staticmethod
+    def cluster_id_strings(values):
+        # "12" for cluster 12 whether it was read as int32, float or string, NA for rows in no cluster
+        cluster_ids = to_cluster_ids(values)
+        cluster_id_strings = pd.array(cluster_ids.astype(str), dtype="string")
+        cluster_id_strings[cluster_ids == NO_CLUSTER] = pd.NA
+        return cluster_id_strings
+
+    def denoise_changed_clusters(self, changed_clusters):
+        changed = self.df[self.clustering_col].isin(changed_clusters).values
+        changed_rows = self.df.loc[changed]
+        cluster_codes, _ = pd.factorize(changed_rows[self.clustering_col])
+        cluster_codes = cluster_codes.astype(float)
+        labels, run_cluster_ids = temporal_dbscan_1d(cluster_codes, to_days(changed_rows["start_date"].values),
+                                                     eps=self.eps, min_samples=self.min_samples)
+        keep_changed = largest_temporal_run(labels, cluster_codes, run_cluster_ids)
+
+        stats, _ = cluster_statistics(changed_rows.loc[keep_changed], self.clustering_col)
+        oos_clusters = stats.index[stats["oos_purity"] == 1]
+        keep_changed &= ~changed_rows[self.clustering_col].isin(oos_clusters).values
+
+        keep = ~changed
+        keep[np.nonzero(changed)[0][keep_changed]] = True
+        print(f"Temporal DBSCAN and OOS removal on {len(np.unique(cluster_codes))} changed clusters: "
+              f"removed {(~keep).sum()} titles")
+        self.removed_row_ids.append(self.row_ids[~keep])
+        self.df = self.df.loc[keep].reset_index(drop=True)
+        self.embeddings = self.embeddings[keep]
+        self.row_ids = self.row_ids[keep]
+
+    def merge_changed_clusters(self, changed_clusters):
+        """Merges changed clusters with temporally near clusters; spans and merged ids come from the cluster table."""
+        table = pd.DataFrame({"first_day": self.cluster_table["first_days"],
+                              "last_day": self.cluster_table["last_days"],
+                              "new_cluster": self.cluster_table["new_clusters"]},
+                             index=pd.Index(self.cluster_table["ids"]))
+        changed_spans = table.loc[table.index.isin(changed_clusters)]
+        if len(changed_spans) == 0:
+            return
+        near = (table["last_day"] >= changed_spans["first_day"].min() - self.max_gap) & \
+               (table["first_day"] <= changed_spans["last_day"].max() + self.max_gap)
+        near_clusters = table.index[near.values]
+        near_rows = self.df.loc[self.df[self.clustering_col].isin(near_clusters).values]
+
+        frequent_entities = EventDeduplicationDataFrame.get_frequent_entities(near_rows, self.clustering_col,
+                                                                              self.min_entity_count)
+        cluster_a, cluster_b, _ = entity_overlap_pairs(near_clusters.get_indexer(frequent_entities["cluster"]),
+                                                       frequent_entities["entity"].values,
+                                                       table.loc[near_clusters, "first_day"].values,
+                                                       table.loc[near_clusters, "last_day"].values,
+                                                       max_gap=self.max_gap, min_overlap=self.min_overlap)
+        is_changed = near_clusters.isin(changed_clusters)
+        touches_changed = is_changed[cluster_a] | is_changed[cluster_b]
+        cluster_a, cluster_b = cluster_a[touches_changed], cluster_b[touches_changed]
+        if len(cluster_a) == 0:
+            return
+
+        # union the merged clusters (new_cluster) of both ends of every edge
+        new_cluster_of = table.loc[near_clusters, "new_cluster"]
+        # numeric order, components are named after their numerically smallest cluster ("9" before "10")
+        merged_ids = pd.Index(sorted(new_cluster_of.dropna().unique(), key=int))
+        merged_to = merge_connected_clusters(merged_ids,
+                                             merged_ids.get_indexer(new_cluster_of.values[cluster_a]),
+                                             merged_ids.get_indexer(new_cluster_of.values[cluster_b]))
+        relabel = {merged_id: to for merged_id, to in zip(merged_ids, merged_to) if merged_id != to}
+        self.apply_relabel(relabel)
+        self.relabel.update(relabel)
+        print(f"Merged {len(cluster_a)} cluster pairs")
+
+    def apply_relabel(self, relabel):
+        """Renames merged clusters in new_cluster, only the rows of those clusters are touched."""
+        if not relabel:
+            return
+        rows = self.df["new_cluster"].isin(list(relabel)).values
+        self.df.loc[rows, "new_cluster"] = self.df.loc[rows, "new_cluster"].replace(relabel)
+        new_clusters = self.cluster_table["new_clusters"]
+        self.cluster_table["new_clusters"] = pd.Series(new_clusters, dtype=object).replace(relabel).values
+
+    def get_cluster_table(self, df, embeddings):
+        """Centroid sums, sizes, first and last day and merged cluster (new_cluster) of the clusters of df."""
+        cluster_codes, cluster_ids = pd.factorize(df[self.clustering_col])
+        valid = cluster_codes >= 0
+        membership = sparse.csr_matrix((np.ones(valid.sum(), dtype=np.float32),
+                                        (cluster_codes[valid], np.nonzero(valid)[0])),
+                                       shape=(len(cluster_ids), len(df)))
+        codes = np.arange(len(cluster_ids))
+        days = pd.Series(to_days(df["start_date"].values)[valid]).groupby(cluster_codes[valid])
+        # a cluster which was not merged is its own merged cluster
+        new_clusters = df["new_cluster"][valid].groupby(cluster_codes[valid]).first().reindex(codes)
+        return {"ids": np.asarray(cluster_ids, dtype=object),
+                "sums": np.asarray(membership @ embeddings.astype(np.float32)),
+                "counts": np.bincount(cluster_codes[valid], minlength=len(cluster_ids)),
+                "first_days": days.min().reindex(codes).values,
+                "last_days": days.max().reindex(codes).values,
+                "new_clusters": np.where(new_clusters.isna().values, np.asarray(cluster_ids, dtype=object),
+                                         new_clusters.values.astype(object))}
+
+    def update_cluster_table(self, changed_clusters):
+        changed = self.df[self.clustering_col].isin(changed_clusters).values
+        changed_table = self.get_cluster_table(self.df.loc[changed], self.embeddings[changed])
+        unchanged = ~pd.Index(self.cluster_table["ids"]).isin(changed_clusters)
+        self.cluster_table = {key: np.concatenate([self.cluster_table[key][unchanged], changed_table[key]])
+                              for key in CLUSTER_TABLE_KEYS}
+
+    def rewrite_state(self):
+        """Writes the whole state with a single shard, after initialize or to compact the shards of many updates."""
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        shard_dir, self.shard_dir = self.shard_dir, Path(self.state_dir, "shards.tmp")
+        shutil.rmtree(self.shard_dir, ignore_errors=True)
+        self.shard_dir.mkdir()
+        self.num_shards = 0
+        self.row_ids = np.arange(len(self.df))
+        self.num_rows = len(self.df)
+        self.removed_row_ids, self.relabel = [], {}
+        self.write_shard(rows_before=0)
+        shutil.rmtree(shard_dir, ignore_errors=True)
+        self.shard_dir = self.shard_dir.rename(shard_dir)
+        self.save_state()
+
+    def write_shard(self, rows_before: int):
+        """
+        Writes the rows added since rows_before (as they are now) as the next shard, with the ids of the older rows
+        removed meanwhile and the merged clusters (relabel) to replay on the older rows.
+        """
+        appended = self.row_ids >= rows_before
+        shard_path = Path(self.shard_dir, f"{self.num_shards:05d}")
+        self.df.loc[appended].reset_index(drop=True).to_pickle(shard_path.with_suffix(".pkl"))
+        removed = np.concatenate(self.removed_row_ids) if self.removed_row_ids else np.empty(0, dtype=np.int64)
+        np.savez(shard_path.with_suffix(".npz"), embeddings=self.embeddings[appended], row_ids=self.row_ids[appended],
+                 removed_row_ids=removed[removed < rows_before], rows_before=rows_before,
+                 relabel_from=np.asarray(list(self.relabel), dtype=str),
+                 relabel_to=np.asarray(list(self.relabel.values()), dtype=str))
+        self.num_shards += 1
+
+    def save_state(self):
+        """The buffer and the cluster table (both bounded by the buffer and cluster count) and the shard count."""
+        self.buffer.to_pickle(self.buffer_path)
+        np.save(self.buffer_embeddings_path, self.buffer_embeddings)
+        np.savez(self.centroids_path, **{key: self.cluster_table[key].astype(str) if key in ["ids", "new_clusters"]
+                                         else self.cluster_table[key] for key in CLUSTER_TABLE_KEYS})
+        # written last: shards which are not counted here are ignored by load_state
+        with open(self.meta_path, "w") as f:
+            json.dump({"num_shards": self.num_shards, "num_rows": self.num_rows,
+                       "next_cluster_id": self.next_cluster_id}, f)
+
+    def load_state(self):
+        if not self.meta_path.exists():
+            raise FileNotFoundError(f"No incremental state in {self.state_dir}, please run initialize first!")
+        with open(self.meta_path) as f:
+            meta = json.load(f)
+        self.num_shards, self.num_rows, self.next_cluster_id = \
+            meta["num_shards"], meta["num_rows"], meta["next_cluster_id"]
+        shard_paths = [Path(self.shard_dir, f"{shard:05d}") for shard in range(self.num_shards)]
+        shards = [np.load(shard_path.with_suffix(".npz")) for shard_path in shard_paths]
+        self.df = pd.concat([pd.read_pickle(shard_path.with_suffix(".pkl")) for shard_path in shard_paths],
+                            ignore_index=True)
+        self.embeddings = np.concatenate([shard["embeddings"] for shard in shards])
+        self.row_ids = np.concatenate([shard["row_ids"] for shard in shards])
+        centroids = np.load(self.centroids_path)
+        self.cluster_table = {key: centroids[key].astype(object) if key in ["ids", "new_clusters"] else centroids[key]
+                              for key in CLUSTER_TABLE_KEYS}
+        # replays the removals and merges of every update on the rows which existed before it
+        for shard in shards[1:]:
+            if len(shard["removed_row_ids"]):
+                keep = ~np.isin(self.row_ids, shard["removed_row_ids"])
+                self.df = self.df.loc[keep].reset_index(drop=True)
+                self.embeddings = self.embeddings[keep]
+                self.row_ids = self.row_ids[keep]
+            if len(shard["relabel_from"]):
+                relabel = dict(zip(shard["relabel_from"], shard["relabel_to"]))
+                rows = self.df["new_cluster"].isin(list(relabel)).values & (self.row_ids < shard["rows_before"])
+                self.df.loc[rows, "new_cluster"] = self.df.loc[rows, "new_cluster"].replace(relabel)
+        self.buffer = pd.read_pickle(self.buffer_path)
+        self.buffer_embeddings = np.load(self.buffer_embeddings_path)
+
+    def compact(self):
+        self.load_state()
+        self.rewrite_state()
+        print(f"Compacted the incremental state into one shard of {len(self.df)} titles.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incremental silver labelling of newly crawled news titles.")
+    parser.add_argument("--init", help="silver-labelled csv (e.g. final_df_v1.csv) to initialize the state from")
+    parser.add_argument("--update", help="csv of newly crawled titles")
+    parser.add_argument("--state-dir", default="./data/gdelt_crawled/incremental")
+    parser.add_argument("--output", default=None, help="updated silver-labelled csv, default STATE_DIR/silver_labelled.csv")
+    parser.add_argument("--max-buffer-days", type=float, default=7)
+    parser.add_argument("--compact", action="store_true", help="rewrite the shards of past updates as one shard")
+    args = parser.parse_args()
+
+    labeler = IncrementalSilverLabeler(state_dir=args.state_dir, output_path=args.output,
+                                       max_buffer_days=args.max_buffer_days)
+    if args.init:
+        labeler.initialize(args.init)
+    if args.update:
+        labeler.update(args.update)
+    if args.compact:
+        labeler.compact()
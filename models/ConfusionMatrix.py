@@ -0,0 +1,79 @@
+import logging
+
+import torch
+
+
+logger = logging.getLogger(__name__)
+
+
+class ConfusionMatrixAccumulator(object):
+    """
+    C x C confusion matrix (rows: true, columns: predicted label) updated per batch on the device of the
+    predictions, so the batches need no host synchronisation. compute() derives accuracy, per-class and
+    macro/micro/weighted precision, recall and F1 from it as precision_recall_fscore_support(zero_division=0)
+    does: the averages are over the labels which occur in the true or predicted labels.
+    """
+    def __init__(self, num_classes: int, device=None):
+        self.num_classes = num_classes
+        self.device = device
+        self.matrix = None
+
+    def reset(self):
+        self.matrix = None
+
+    def update(self, y_true, y_predict):
+        """y_predict are label ids or (batch x C) scores."""
+        y_predict = torch.as_tensor(y_predict)
+        if y_predict.dim() == 2:
+            y_predict = torch.argmax(y_predict, dim=1)
+        y_true = torch.as_tensor(y_true, device=y_predict.device)
+        if self.matrix is None:
+            self.matrix = torch.zeros(self.num_classes * self.num_classes, dtype=torch.int64,
+                                      device=self.device or y_predict.device)
+        cells = (y_true.long() * self.num_classes + y_predict.long()).to(self.matrix.device)
+        self.matrix += torch.bincount(cells, minlength=self.num_classes * self.num_classes)
+        return y_predict
+
+    @property
+    def confusion_matrix(self):
+        if self.matrix is None:
+            return torch.zeros((self.num_classes, self.num_classes), dtype=torch.int64)
+        return self.matrix.view(self.num_classes, self.num_classes).cpu()
+
+    def compute(self, label_names: list = None):
+        matrix = self.confusion_matrix.double()
+        true_positives = matrix.diag()
+        support = matrix.sum(dim=1)
+        predicted = matrix.sum(dim=0)
+        total = matrix.sum()
+        precision = torch.where(predicted > 0, true_positives / predicted.clamp(min=1), torch.zeros_like(predicted))
+        recall = torch.where(support > 0, true_positives / support.clamp(min=1), torch.zeros_like(support))
+        f1 = torch.where(precision + recall > 0, 2 * precision * recall / (precision + recall).clamp(min=1e-12),
+                         torch.zeros_like(precision))
+        present = (support + predicted) > 0
+        accuracy = (true_positives.sum() / total).item() if total > 0 else 0.0
+        micro = true_positives.sum() / total.clamp(min=1)
+        weights = support / support.sum().clamp(min=1)
+        metrics = {"accuracy": accuracy, "correct": int(true_positives.sum().item()), "total": int(total.item())}
+        for name, values in [("precision", precision), ("recall", recall), ("f1", f1)]:
+            metrics[f"macro_{name}"] = values[present].mean().item() if present.any() else 0.0
+            metrics[f"micro_{name}"] = micro.item()
+            metrics[f"weighted_{name}"] = (values * weights).sum().item()
+        label_names = label_names or [str(label) for label in range(self.num_classes)]
+        metrics["per_class"] = {label: {"precision": precision[i].item(), "recall": recall[i].item(),
+                                        "f1": f1[i].item(), "support": int(support[i].item())}
+                                for i, label in enumerate(label_names)}
+        return metrics
+
+    @staticmethod
+    def log(metrics):
+        logger.info("Accuracy: {:.4f} ({}/{})\n".format(metrics["accuracy"], metrics["correct"], metrics["total"]))
+        for average in ["macro", "micro", "weighted"]:
+            logger.info(f"{average.capitalize()} metrics:")
+            logger.info(f"    precision: {metrics[f'{average}_precision']}")
+            logger.info(f"    recall: {metrics[f'{average}_recall']}")
+            logger.info(f"    f1: {metrics[f'{average}_f1']}")
+        logger.info(f"Per-class metrics:")
+        for label, values in metrics["per_class"].items():
+            logger.info(f"    {label}: precision {values['precision']:.4f} recall {values['recall']:.4f} "
+                        f"f1 {values['f1']:.4f} support {values['support']}")
@@ -1,18 +1,30 @@
+import argparse
 import csv
 import os
 import logging
+import time
 from pathlib import Path
 
 import numpy as np
+import pandas as pd
 from sentence_transformers import SentenceTransformer
 import torch
 from torch import nn
 from sentence_transformers.util import batch_to_device
-from sklearn.metrics import precision_recall_fscore_support
+
+from ConfusionMatrix import ConfusionMatrixAccumulator
+from OnnxEncoder import OnnxEncoder, export_encoder
 
 
 logger = logging.getLogger(__name__)
 
+# the SoftmaxLoss classifier of the best model, next to it
+CLASSIFIER_FILE = "classifier/classifier.pt"
+
+# encoder backends of InferenceModel: fp32 PyTorch, PyTorch with dynamically int8-quantised Linear layers,
+# and the exported ONNX graph in fp32 or dynamically int8-quantised on ONNX Runtime (CPU only but torch)
+BACKENDS = ["torch", "torch-int8", "onnx", "onnx-int8"]
+
 
 class CustomSentenceTransformer(SentenceTransformer):
 
@@ -34,30 +46,119 @@ class CustomSentenceTransformer(SentenceTransformer):
                     self.save(output_path)
                     if not Path(output_path, "classifier").exists():
                         Path(output_path, "classifier").mkdir()
-                    torch.save(evaluator.softmax_model.classifier.state_dict(), Path(output_path, "classifier"))
+                    torch.save(evaluator.softmax_model.classifier.state_dict(), Path(output_path, CLASSIFIER_FILE))
+
+
+def to_unique_sentence_pairs(pairs, sentences=None):
+    """
+    The unique sentences of pairs and the pairs as (index_a, index_b) rows into them. pairs are
+    (sentence_a, sentence_b) tuples or, with sentences, rows of sentence ids into sentences.
+    """
+    if sentences is None:
+        codes, sentences = pd.factorize(pd.Series(np.asarray(pairs, dtype=object).ravel(), dtype=object))
+        return np.asarray(sentences, dtype=object), codes.reshape(-1, 2)
+    # only the sentences used by pairs are encoded
+    used, inverse = np.unique(np.asarray(pairs, dtype=np.int64).ravel(), return_inverse=True)
+    if isinstance(sentences, (list, tuple)):
+        sentences = np.asarray(sentences, dtype=object)
+    return np.asarray(sentences[used], dtype=object), inverse.reshape(-1, 2)
 
 
 class InferenceModel(object):
+    """
+    Scores sentence pairs with a trained model and its SoftmaxLoss classifier: every unique sentence is
+    encoded once, the classifier is applied to the (u, v, |u - v|) features of all pairs at once.
+    The sentences are encoded by one of BACKENDS, the classifier head stays in fp32 PyTorch.
+    """
     def __init__(self,
                  path_to_lm: str,
-                 path_to_classifier: str,
+                 path_to_classifier: str = None,
                  name: str = "_",
-                 write_predictions: bool = True):
+                 write_predictions: bool = True,
+                 device: str = None,
+                 encode_batch_size: int = 512,
+                 classifier_batch_size: int = 65536,
+                 backend: str = "torch",
+                 num_threads: int = None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend}, choose from {BACKENDS}")
+        if backend != "torch" and device not in (None, "cpu"):
+            raise ValueError(f"The {backend} backend runs on cpu only")
         self.labels2int = self.get_label2int(path_to_lm)
+        self.int2labels = np.array(list(self.labels2int), dtype=object)
         self.csv_file = "evaluation_" + name + "_results.csv"
         self.name = name
         self.write_predictions = write_predictions
+        self._device = "cpu" if backend != "torch" else device
+        self.backend = backend
+        self.encode_batch_size = encode_batch_size
+        self.classifier_batch_size = classifier_batch_size
         self.model = CustomSentenceTransformer(path_to_lm, device=self.device)
-        self.classifier = nn.Linear(3 * 256, len(self.labels2int), device=self.device)
-        self.classifier.load_state_dict(torch.load(path_to_classifier))
+        self.classifier = nn.Linear(3 * self.model.get_sentence_embedding_dimension(), len(self.labels2int),
+                                    device=self.device)
+        if path_to_classifier is None:
+            path_to_classifier = Path(path_to_lm, CLASSIFIER_FILE)
+        elif Path(path_to_classifier).is_dir():
+            path_to_classifier = Path(path_to_classifier, Path(CLASSIFIER_FILE).name)
+        self.classifier.load_state_dict(torch.load(path_to_classifier, map_location=self.device))
         self.model.eval()
         self.classifier.eval()
+        self.onnx_encoder = None
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        if backend == "torch-int8":
+            torch.ao.quantization.quantize_dynamic(self.model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        elif backend.startswith("onnx"):
+            onnx_path = export_encoder(self.model, path_to_lm, quantized=backend == "onnx-int8")
+            self.onnx_encoder = OnnxEncoder(onnx_path, self.model, num_threads=num_threads)
+        self.pairs_per_sec = None
+
+    def pair_logits(self, u, v):
+        return self.classifier(torch.cat([u, v, torch.abs(u - v)], 1))
+
+    def encode(self, sentences):
+        if len(sentences) == 0:
+            return torch.zeros((0, self.model.get_sentence_embedding_dimension()), device=self.device)
+        if self.onnx_encoder is not None:
+            return self.onnx_encoder.encode(sentences, batch_size=self.encode_batch_size)
+        return self.model.encode(list(sentences), batch_size=self.encode_batch_size, convert_to_tensor=True,
+                                 device=self.device, show_progress_bar=False)
+
+    def pair_probabilities(self, embeddings, pair_ids):
+        """Class probabilities of the (index_a, index_b) rows pair_ids into embeddings, as a numpy array."""
+        pair_ids = torch.as_tensor(pair_ids, device=embeddings.device)
+        probabilities = []
+        for batch_start in range(0, len(pair_ids), self.classifier_batch_size):
+            batch = pair_ids[batch_start:batch_start + self.classifier_batch_size]
+            logits = self.pair_logits(embeddings[batch[:, 0]], embeddings[batch[:, 1]])
+            probabilities.append(torch.softmax(logits, dim=1))
+        if not probabilities:
+            return np.zeros((0, len(self.labels2int)), dtype=np.float32)
+        return torch.cat(probabilities).cpu().numpy()
+
+    def predict(self, pairs, sentences=None):
+        """
+        Labels and class probabilities of pairs, either (sentence_a, sentence_b) tuples or, with sentences,
+        (index_a, index_b) rows of sentence ids into sentences.
+        Returns an array of label names and a (pairs x labels) array of probabilities.
+        """
+        start = time.perf_counter()
+        sentences, pair_ids = to_unique_sentence_pairs(pairs, sentences)
+        with torch.no_grad():
+            probabilities = self.pair_probabilities(self.encode(sentences), pair_ids)
+        elapsed = time.perf_counter() - start
+        if elapsed > 0:
+            self.pairs_per_sec = len(pair_ids) / elapsed
+        else:
+            self.pairs_per_sec = float("inf") if len(pair_ids) else 0.0
+        logger.info(f"Scored {len(pair_ids)} pairs ({len(sentences)} unique sentences) in {elapsed:.2f}s on "
+                    f"{self.device} ({self.backend}): {self.pairs_per_sec:.0f} pairs/sec")
+        return self.int2labels[probabilities.argmax(axis=1)], probabilities
 
     def run(self, dataloader, output_path: str = None, epoch: int = -1, steps: int = -1) -> float:
         self.model.eval()
         logger.info(f"Evaluator on device: {self.device}")
-        total = 0
-        correct = 0
+        metrics = ConfusionMatrixAccumulator(len(self.labels2int), device=self.device)
         y_true = []
         y_predict = []
 
@@ -65,44 +166,21 @@ class InferenceModel(object):
 
         for step, batch in enumerate(dataloader):
             features, label_ids = batch
-            y_true.append(label_ids)
             for idx in range(len(features)):
                 features[idx] = batch_to_device(features[idx], self.device)
-            label_ids = torch.tensor(label_ids, device=self.device)
+            label_ids = torch.as_tensor(label_ids).to(self.device, non_blocking=True)
             with torch.no_grad():
-                _, prediction = self.classifier(features, labels=None)
-            y_predict.append(torch.argmax(prediction, dim=1).detach().cpu().numpy())
-            total += prediction.size(0)
-            correct += torch.argmax(prediction, dim=1).eq(label_ids).sum().item()
-        y_true = np.concatenate(y_true)
-        y_predict = np.concatenate(y_predict)
-        macro_precision, macro_recall, macro_f1, _ = precision_recall_fscore_support(y_true, y_predict, average='macro',
-                                                                                     zero_division=0)
-        micro_precision, micro_recall, micro_f1, _ = precision_recall_fscore_support(y_true, y_predict, average='micro',
-                                                                                     zero_division=0)
-        weighted_precision, weighted_recall, weighted_f1, _ = precision_recall_fscore_support(y_true, y_predict,
-                                                                                              average='weighted',
-                                                                                              zero_division=0)
-        accuracy = correct / total
-
-        logger.info("Accuracy: {:.4f} ({}/{})\n".format(accuracy, correct, total))
-        logger.info(f"Macro metrics:")
-        logger.info(f"    precision: {macro_precision}")
-        logger.info(f"    recall: {macro_recall}")
-        logger.info(f"    f1: {macro_f1}")
-        logger.info(f"Micro metrics:")
-        logger.info(f"    precision: {micro_precision}")
-        logger.info(f"    recall: {micro_recall}")
-        logger.info(f"    f1: {micro_f1}")
-        logger.info(f"Weighted metrics:")
-        logger.info(f"    precision: {weighted_precision}")
-        logger.info(f"    recall: {weighted_recall}")
-        logger.info(f"    f1: {weighted_f1}")
+                u, v = [self.model(sentence_features)["sentence_embedding"] for sentence_features in features]
+                prediction = self.pair_logits(u, v)
+            y_true.append(label_ids)
+            y_predict.append(metrics.update(label_ids, prediction))
+        results = metrics.compute(label_names=list(self.labels2int))
+        ConfusionMatrixAccumulator.log(results)
 
         if self.write_predictions:
-            y_true.dump(Path(output_path, f"{self.name}_labels.pkl").absolute())
-            y_predict.dump(Path(output_path, f"{self.name}_prediction.pkl").absolute())
-        return macro_f1
+            torch.cat(y_true).cpu().numpy().dump(Path(output_path, f"{self.name}_labels.pkl").absolute())
+            torch.cat(y_predict).cpu().numpy().dump(Path(output_path, f"{self.name}_prediction.pkl").absolute())
+        return results["macro_f1"]
 
     @staticmethod
     def get_label2int(path_to_classifier):
@@ -119,7 +197,28 @@ class InferenceModel(object):
 
     @property
     def device(self):
+        if self._device is not None:
+            return self._device
         if torch.cuda.is_available():
             return 'cuda'
         else:
-            return "cpu"
\ No newline at end of file
+            return "cpu"
+
+
+if __name__ == "__main__":
+    from SentencePairs import SentencePairs
+
+    parser = argparse.ArgumentParser(description="Scores a sentence pair store and reports accuracy and pairs/sec")
+    parser.add_argument("--model", required=True, help="trained model directory, e.g. ./outputs/v1/event_deduplication/disc")
+    parser.add_argument("--pairs", required=True, help="pair store, e.g. ./data/stormy_data/event_deduplication/test_v3_pairs")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--encode-batch-size", type=int, default=512)
+    parser.add_argument("--backend", default="torch", choices=BACKENDS)
+    args = parser.parse_args()
+    inference_model = InferenceModel(args.model, device=args.device, encode_batch_size=args.encode_batch_size,
+                                     backend=args.backend)
+    sentence_pairs = SentencePairs(args.pairs)
+    labels, _ = inference_model.predict(np.stack([sentence_pairs.a, sentence_pairs.b], axis=1),
+                                        sentences=sentence_pairs.sentences)
+    print(f"accuracy {np.mean(labels == sentence_pairs.label_names):.4f} on {len(labels)} pairs, "
+          f"{inference_model.pairs_per_sec:.0f} pairs/sec on {args.device} ({args.backend})")
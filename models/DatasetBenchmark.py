@@ -0,0 +1,64 @@
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from Datasets import CorpusSchema, PairDataset, unix_timestamp_days
+
+
+def generate_corpus(n_titles: int, n_events: int, seed: int = 0):
+    """Synthetic corpus in a schema of its own: headline, story_id, published (unix seconds), link."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({"headline": [f"headline {i} of story {story}" for i, story in
+                                      enumerate(rng.integers(0, n_events, n_titles))],
+                         "story_id": rng.integers(0, n_events, n_titles),
+                         "published": 1_600_000_000 + rng.integers(0, 60 * 86400, n_titles),
+                         "link": [f"https://example.org/{i}" for i in range(n_titles)]})
+
+
+def items_per_sec(get_item, n_items: int, n_samples: int, seed: int = 0):
+    indices = np.random.default_rng(seed).integers(0, n_items, n_samples).tolist()
+    start = time.perf_counter()
+    for idx in indices:
+        get_item(idx)
+    return n_samples / (time.perf_counter() - start)
+
+
+def run_benchmark(n_titles: int, n_events: int, multiplier: int, n_samples: int, task: str):
+    with tempfile.TemporaryDirectory() as data_dir:
+        csv_path = Path(data_dir, "corpus.csv")
+        generate_corpus(n_titles, n_events).to_csv(csv_path, index=False)
+        # a new corpus only needs its schema
+        schema = CorpusSchema("Synthetic", data_dir, sentence="headline", event="story_id", time="published",
+                              url="link", get_days=unix_timestamp_days)
+        start = time.perf_counter()
+        dataset = PairDataset(csv_path, multiplier, task=task, data_type="train", schema=schema)
+        build_sec = time.perf_counter() - start
+
+        # the former item access: pandas .values of the pair frame on every access
+        pair_df = dataset.pairs.to_frame()
+        labels = [dataset.label2int[label] for label in pair_df.labels.values]
+
+        def pandas_item(idx):
+            return (pair_df.sentence_a.values[idx], pair_df.sentence_b.values[idx]), labels[idx]
+
+        array_rate = items_per_sec(dataset.__getitem__, len(dataset), n_samples)
+        pandas_rate = items_per_sec(pandas_item, len(pair_df), n_samples)
+    print(f"{n_titles} titles, {len(dataset)} pairs, sampled and stored in {build_sec:.2f}s")
+    print(f"    array-backed __getitem__: {array_rate:>12,.0f} items/sec")
+    print(f"    pandas .values __getitem__: {pandas_rate:>10,.0f} items/sec ({array_rate / pandas_rate:.1f}x)")
+    return array_rate, pandas_rate
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Item access throughput of the array-backed pair dataset")
+    parser.add_argument("--titles", type=int, default=50000)
+    parser.add_argument("--events", type=int, default=500)
+    parser.add_argument("--multiplier", type=int, default=30)
+    parser.add_argument("--samples", type=int, default=200000, help="items fetched per measurement")
+    parser.add_argument("--task", default="event_deduplication")
+    args = parser.parse_args()
+    run_benchmark(args.titles, args.events, args.multiplier, args.samples, args.task)
@@ -1,5 +1,6 @@
 from math import floor
 import logging
+import numpy as np
 import pandas as pd
 import torch
 from pathlib import Path
@@ -7,6 +8,14 @@ from torch.utils.data import Dataset
 import random
 from sklearn.model_selection import train_test_split
 
+from SentencePairs import SentencePairs, save_sentence_pairs
+
+try:
+    import faiss
+    FAISS_AVAILABLE = True
+except ImportError:
+    FAISS_AVAILABLE = False
+
 
 logging.basicConfig(level=logging.NOTSET)
 logger = logging.getLogger(__name__)
@@ -54,72 +63,354 @@ def split_crisisfacts_dataset():
     storm_df.to_csv("./data/crisisfacts_data/crisisfacts_storm.csv", index=False)
 
 
-def generate_diversified_random_pairs(df, multiplier, get_label, task):
-    output_length = len(df) * multiplier
-    sampled_df_list = []
-    M = len(df)
-    if M % 2 == 1:
-      M -= 1
+class CorpusSchema(object):
+    """Column names of a news corpus and how its time column maps to integer day ordinals."""
+    __slots__ = ("name", "data_dir", "sentence", "event", "time", "url", "get_days")
+
+    def __init__(self, name, data_dir, sentence, event, time, url, get_days):
+        self.name = name
+        self.data_dir = data_dir
+        self.sentence = sentence
+        self.event = event
+        self.time = time
+        self.url = url
+        self.get_days = get_days
+
+
+def seendate_days(seendates):
+    # seendate is e.g. 20230913T121500Z, its first 8 characters are the day; days since 1970-01-01
+    days = pd.to_datetime(pd.Series(seendates).astype(str).str[:8], format="%Y%m%d")
+    return days.values.astype("datetime64[D]").astype(np.int64)
+
+
+def unix_timestamp_days(timestamps):
+    return np.asarray(timestamps).astype(np.int64) // 86400
+
+
+STORMY_SCHEMA = CorpusSchema("Disc", "./data/stormy_data", sentence="title", event="wikidata_link", time="seendate",
+                             url="url", get_days=seendate_days)
+CRISISFACTS_SCHEMA = CorpusSchema("Crisisfacts", "./data/crisisfacts_data", sentence="text", event="event",
+                                  time="unix_timestamp", url="source", get_days=unix_timestamp_days)
+
+
+def get_label_names(task):
+    if task == "event_deduplication":
+        return ["different_event", "same_event"]
+    elif task == "event_temporality":
+        return ["earlier", "later", "same_date"]
+    return ["different_event", "earlier", "later", "same_date"]
+
+
+def get_n_per_label(n_rows, multiplier, task):
     num_labels = 3 if task == "event_temporality" else 2
+    return floor(n_rows * multiplier / num_labels)
+
+
+def get_pair_labels(cluster_ids, day_ordinals, a, b, task):
+    """Labels of the pairs (a[i], b[i]) of rows; pairs of different events are 'ignored' for event_temporality."""
+    same_event = cluster_ids[a] == cluster_ids[b]
+    temporal_labels = np.select([day_ordinals[a] < day_ordinals[b], day_ordinals[a] == day_ordinals[b]],
+                                ["earlier", "same_date"], "later").astype(object)
+    if task == "event_deduplication":
+        return np.where(same_event, "same_event", "different_event").astype(object)
+    elif task == "event_temporality":
+        return np.where(same_event, temporal_labels, "ignored")
+    else:
+        return np.where(same_event, temporal_labels, "different_event")
+
+
+def sample_same_event_pairs(cluster_ids, n_pairs, rng):
+    """Uniform random ordered pairs of two different rows of the same cluster."""
+    order = np.argsort(cluster_ids, kind="stable")
+    _, cluster_starts, cluster_sizes = np.unique(cluster_ids[order], return_index=True, return_counts=True)
+    pair_counts = cluster_sizes * (cluster_sizes - 1)
+    if pair_counts.sum() == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    clusters = rng.choice(len(cluster_sizes), size=n_pairs, p=pair_counts / pair_counts.sum())
+    i = rng.integers(0, cluster_sizes[clusters])
+    j = rng.integers(0, cluster_sizes[clusters] - 1)
+    j += j >= i
+    return order[cluster_starts[clusters] + i], order[cluster_starts[clusters] + j]
+
+
+def sample_different_event_pairs(cluster_ids, n_pairs, rng):
+    """Uniform random ordered pairs of rows of different clusters (rejection sampling)."""
+    a = rng.integers(0, len(cluster_ids), size=n_pairs)
+    b = rng.integers(0, len(cluster_ids), size=n_pairs)
+    different = cluster_ids[a] != cluster_ids[b]
+    return a[different], b[different]
+
+
+def top_k_other_events(embeddings, queries, candidates, cluster_ids, k: int, index=None):
+    """
+    Rows (query, candidate) of the k candidates most similar to every query which belong to another event.
+    With a faiss index over the candidates, the search is repeated with 4x as many neighbours for as long
+    as a query has fewer than k of other events among them and there are more candidates to fetch.
+    """
+    if index is None:
+        scores = embeddings[queries] @ embeddings[candidates].T
+        neighbours = np.broadcast_to(np.arange(len(candidates)), scores.shape)
+    else:
+        n_fetch = min(4 * k + 1, len(candidates))
+        while True:
+            scores, neighbours = index.search(embeddings[queries], n_fetch)
+            valid = (neighbours >= 0) & (cluster_ids[candidates[np.maximum(neighbours, 0)]] != cluster_ids[queries, None])
+            if n_fetch >= len(candidates) or (valid.sum(axis=1) >= k).all():
+                break
+            n_fetch = min(4 * n_fetch, len(candidates))
+        scores = np.where(neighbours >= 0, scores, -np.inf)
+        neighbours = np.maximum(neighbours, 0)
+    scores = np.where(cluster_ids[candidates[neighbours]] != cluster_ids[queries, None], scores, -np.inf)
+    top = np.argpartition(-scores, min(k, scores.shape[1] - 1), axis=1)[:, :k]
+    found = np.isfinite(np.take_along_axis(scores, top, axis=1))
+    return np.repeat(queries, found.sum(axis=1)), candidates[np.take_along_axis(neighbours, top, axis=1)[found]]
+
+
+def hard_negative_candidates(embeddings, cluster_ids, day_ordinals, k: int = 10, max_day_gap: int = 3,
+                             block_size: int = 512):
+    """
+    Pairs (a, b) of every title with its k most similar titles (cosine of the embeddings) of other events
+    published at most max_day_gap days apart, i.e. different-event pairs which are hard to tell apart.
+    The titles of every day are only searched among the titles of their period, so the cost grows with the
+    daily volume rather than with the corpus. Uses faiss inner product indices if faiss is installed,
+    otherwise an exact blocked search.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    cluster_ids = np.asarray(cluster_ids)
+    day_ordinals = np.asarray(day_ordinals)
+    order = np.argsort(day_ordinals, kind="stable")
+    sorted_days = day_ordinals[order]
+    sources, targets = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for day in np.unique(sorted_days):
+        queries = order[np.searchsorted(sorted_days, day, side="left"):np.searchsorted(sorted_days, day, side="right")]
+        candidates = order[np.searchsorted(sorted_days, day - max_day_gap, side="left"):
+                           np.searchsorted(sorted_days, day + max_day_gap, side="right")]
+        index = None
+        if FAISS_AVAILABLE:
+            index = faiss.IndexFlatIP(embeddings.shape[1])
+            index.add(embeddings[candidates])
+        for start in range(0, len(queries), block_size):
+            block_sources, block_targets = top_k_other_events(embeddings, queries[start:start + block_size],
+                                                              candidates, cluster_ids, k, index=index)
+            sources.append(block_sources)
+            targets.append(block_targets)
+    return np.concatenate(sources).astype(np.int64), np.concatenate(targets).astype(np.int64)
+
+
+def sample_stratified_pairs(cluster_ids, day_ordinals, n_per_label, task, seed=4, max_stalled_rounds=3,
+                            hard_negatives=None, hard_negative_ratio: float = 0.0):
+    """
+    Draws n_per_label distinct ordered pairs of rows for every label of the task, uniformly among the pairs
+    with that label: same-event pairs are drawn within clusters, different-event pairs across clusters,
+    labelled with array comparisons and de-duplicated by their pair key a * n + b.
+    If the corpus has too few distinct pairs of a label, all labels get as many pairs as the rarest one.
+    With hard_negatives (pairs (a, b) of hard_negative_candidates), hard_negative_ratio of the different-event
+    pairs are drawn from them and the rest at random.
+    Returns the rows (a, b) and the labels of the pairs, grouped by label.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(cluster_ids)
+    label_names = get_label_names(task)
+    pair_keys = {label: np.empty(0, dtype=np.int64) for label in label_names}
+    batch_size = max(int(n_per_label), 1) * len(label_names)
+    stalled_rounds = 0
     minimal_label_len = 0
-    title = "title" if "title" in df.columns else "text"
-    event = "wikidata_link" if "title" in df.columns else "event"
-    time = "seendate" if "title" in df.columns else "unix_timestamp"
-    url = "url" if "title" in df.columns else "source"
-
-    while minimal_label_len < output_length/num_labels:
-        B = random.sample(range(len(df)), M)
-        A = list(zip(B[0:int(M/2)], B[int(M/2):M]))
-        A_label = list(map(get_label, A))
-        A_label_ignored_indics = [i for i, label in enumerate(A_label) if label == "ignored"]
-        non_ignored_pairs = {i: a for i, a in enumerate(A) if i not in A_label_ignored_indics}
-        sample_indics = list(non_ignored_pairs.keys())
-        sentence_a = [df[title].values[A[pair][0]] for pair in sample_indics]
-        sentence_b = [df[title].values[A[pair][1]] for pair in sample_indics]
-        event_a = [df[event].values[A[pair][0]] for pair in sample_indics]
-        event_b = [df[event].values[A[pair][1]] for pair in sample_indics]
-        time_a = [df[time].values[A[pair][0]] for pair in sample_indics]
-        time_b = [df[time].values[A[pair][1]] for pair in sample_indics]
-        url_a = [df[url].values[A[pair][0]] for pair in sample_indics]
-        url_b = [df[url].values[A[pair][1]] for pair in sample_indics]
-        labels = [A_label[i] for i in sample_indics]
-        sample_df = pd.DataFrame(
-                list(zip(sentence_a, event_a, time_a, labels, sentence_b, event_b, time_b, url_a, url_b)),
-                columns=['sentence_a', 'event_a', 'time_a', 'labels', 'sentence_b', 'event_b', 'time_b', 'url_a',
-                         'url_b'])
-        sampled_df_list.append(sample_df)
-        final_df = pd.concat(sampled_df_list)
-        final_df = final_df.drop_duplicates(keep='last')
-        minimal_label_len = min(final_df.labels.value_counts().values)
-        logger.info(f"minimal_label_len: {minimal_label_len}/{output_length/num_labels}")
-    stratified_sample = final_df.groupby('labels').apply(
-        lambda x: x.sample(n=floor(output_length/num_labels))
-    )
+    while minimal_label_len < n_per_label:
+        missing = [label for label in label_names if len(pair_keys[label]) < n_per_label]
+        a, b = sample_same_event_pairs(cluster_ids, batch_size, rng)
+        if "different_event" in missing:
+            a_different, b_different = sample_different_event_pairs(cluster_ids, batch_size, rng)
+            a, b = np.concatenate([a, a_different]), np.concatenate([b, b_different])
+        labels = get_pair_labels(cluster_ids, day_ordinals, a, b, task)
+        for label in missing:
+            pair_keys[label] = np.unique(np.concatenate([pair_keys[label], (a * n + b)[labels == label]]))
+        previous_minimal_label_len = minimal_label_len
+        minimal_label_len = min(len(keys) for keys in pair_keys.values())
+        logger.info(f"minimal_label_len: {minimal_label_len}/{n_per_label}")
+        # the rarest label is (nearly) exhausted
+        stalled_rounds = stalled_rounds + 1 if minimal_label_len - previous_minimal_label_len < 0.01 * n_per_label else 0
+        if stalled_rounds >= max_stalled_rounds:
+            logger.warning(f"Not enough distinct pairs for every label, sampling {minimal_label_len} per label.")
+            n_per_label = minimal_label_len
+            break
+
+    if hard_negatives is not None and hard_negative_ratio > 0 and "different_event" in label_names:
+        hard_keys = np.unique(hard_negatives[0] * n + hard_negatives[1])
+        n_hard = min(len(hard_keys), int(round(hard_negative_ratio * n_per_label)))
+        hard_keys = rng.choice(hard_keys, size=n_hard, replace=False)
+        random_keys = np.setdiff1d(pair_keys["different_event"], hard_keys, assume_unique=True)
+        pair_keys["different_event"] = np.concatenate(
+            [hard_keys, rng.choice(random_keys, size=int(n_per_label) - n_hard, replace=False)])
+        logger.info(f"hard negatives: {n_hard}/{n_per_label} different_event pairs.")
+
+    sampled_keys = [rng.choice(pair_keys[label], size=int(n_per_label), replace=False) for label in label_names]
+    sampled_labels = np.repeat(np.asarray(label_names, dtype=object), [len(keys) for keys in sampled_keys])
+    sampled_keys = np.concatenate(sampled_keys)
+    return sampled_keys // n, sampled_keys % n, sampled_labels
+
+
+def generate_diversified_random_pairs(df, multiplier, task, schema=None, seed=4):
+    """
+    Stratified sample of len(df) * multiplier sentence pairs, equally many per label, in the layout of the
+    former pair CSVs. schema maps the columns of df (CorpusSchema, STORMY_SCHEMA by default).
+    """
+    schema = STORMY_SCHEMA if schema is None else schema
+    a, b, labels = sample_stratified_pairs(to_cluster_ids(df[schema.event]), schema.get_days(df[schema.time]),
+                                           get_n_per_label(len(df), multiplier, task), task, seed=seed)
+    stratified_sample = pd.DataFrame({"sentence_a": df[schema.sentence].values[a],
+                                      "event_a": df[schema.event].values[a],
+                                      "time_a": df[schema.time].values[a],
+                                      "labels": labels,
+                                      "sentence_b": df[schema.sentence].values[b],
+                                      "event_b": df[schema.event].values[b],
+                                      "time_b": df[schema.time].values[b],
+                                      "url_a": df[schema.url].values[a],
+                                      "url_b": df[schema.url].values[b]},
+                                     index=pd.MultiIndex.from_arrays([labels, np.arange(len(labels))],
+                                                                     names=["labels", None]))
     logger.info(f"stratified sampled df: {len(stratified_sample)}.")
     return stratified_sample
 
 
-class StormyDataset(torch.utils.data.Dataset):
+def to_cluster_ids(events):
+    """Integer event ids; rows without an event get an id of their own, as NaN never equals NaN."""
+    cluster_ids, _ = pd.factorize(pd.Series(events))
+    missing = cluster_ids < 0
+    cluster_ids[missing] = cluster_ids.max() + 1 + np.arange(missing.sum())
+    return cluster_ids
+
+
+class StratifiedPairStream(torch.utils.data.IterableDataset):
+    """
+    Stratified sentence pairs sampled lazily from the corpus arrays, a fresh sample every epoch.
+    The sample of an epoch only depends on (seed, epoch): it is advanced by every iteration in the main
+    process; DataLoader workers iterate copies of the stream, so iterate it with a PairStreamDataLoader,
+    which sets the epoch before starting the workers. Every worker draws the same sample and yields every
+    num_workers-th pair of it, so the workers together yield each pair once.
+    Only the corpus and the pair indices of the current epoch are held in memory; its length is the
+    number of pairs of the current epoch, which can be below n_per_label per label if a stratum is short.
+    """
+    def __init__(self, sentences, cluster_ids, day_ordinals, multiplier, task, label2int, seed: int = 4,
+                 transform=None, hard_negatives=None, hard_negative_ratio: float = 0.0):
+        self.sentences = np.asarray(sentences, dtype=object)
+        self.cluster_ids = np.asarray(cluster_ids)
+        self.day_ordinals = np.asarray(day_ordinals)
+        self.task = task
+        self.label2int = label2int
+        self.n_per_label = get_n_per_label(len(self.sentences), multiplier, task)
+        self.seed = seed
+        self.epoch = 0
+        # e.g. a function building a sentence_transformers InputExample from ((sentence_a, sentence_b), label)
+        self.transform = transform
+        self.hard_negatives = hard_negatives
+        self.hard_negative_ratio = hard_negative_ratio
+        self.sample = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def sample_epoch(self, epoch: int):
+        """Shuffled rows (a, b) and int labels of the pairs of an epoch."""
+        if self.sample is not None and self.sample[0] == epoch:
+            return self.sample[1]
+        a, b, labels = sample_stratified_pairs(self.cluster_ids, self.day_ordinals, self.n_per_label, self.task,
+                                               seed=[self.seed, epoch], hard_negatives=self.hard_negatives,
+                                               hard_negative_ratio=self.hard_negative_ratio)
+        order = np.random.default_rng([self.seed, epoch, 1]).permutation(len(a))
+        self.sample = (epoch, (a[order], b[order], pd.Series(labels[order]).map(self.label2int).values))
+        return self.sample[1]
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        a, b, labels = self.sample_epoch(self.epoch)
+        if worker_info is None:
+            self.epoch += 1
+        for i in range(worker_id, len(a), num_workers):
+            item = (self.sentences[a[i]], self.sentences[b[i]]), int(labels[i])
+            yield item if self.transform is None else self.transform(*item)
+
+    def __getstate__(self):
+        # workers sample their epoch themselves
+        state = self.__dict__.copy()
+        state["sample"] = None
+        return state
+
+    def __len__(self):
+        return len(self.sample_epoch(self.epoch)[0])
+
+
+class PairStreamDataLoader(torch.utils.data.DataLoader):
+    """
+    DataLoader over a StratifiedPairStream which advances its epoch: workers get a copy of the stream when
+    an iteration starts, so the epoch is set on the stream first. Not for persistent_workers, whose copies
+    are made once.
+    """
+    def __init__(self, dataset: StratifiedPairStream, **kwargs):
+        if kwargs.get("persistent_workers"):
+            raise ValueError("PairStreamDataLoader needs fresh workers every epoch")
+        super().__init__(dataset, **kwargs)
+        self.epoch = dataset.epoch
+
+    def __iter__(self):
+        self.dataset.set_epoch(self.epoch)
+        self.epoch += 1
+        return super().__iter__()
+
+
+class PairDataset(torch.utils.data.Dataset):
+    """
+    Stratified sentence pairs of a corpus, configured by a CorpusSchema (the schema class attribute of the
+    subclasses). The corpus columns are held as arrays, the pairs as a SentencePairs store in
+    {schema.data_dir}/{task}/{data_type}_v3_pairs; items are ((sentence_a, sentence_b), label).
+    """
+    schema = None
+
     def __init__(self,
                  csv_path,
                  multiplier: int,
                  task: str = "combined",
                  data_type: str = "train",
-                 forced: bool = True):
+                 forced: bool = True,
+                 lazy: bool = False,
+                 schema=None,
+                 hard_negative_ratio: float = 0.0,
+                 encode_sentences=None):
         random.seed(4)
+        self.schema = schema if schema is not None else self.schema
+        # share of hard different-event pairs, found among the titles embedded by encode_sentences(sentences)
+        self.hard_negative_ratio = hard_negative_ratio
+        self.encode_sentences = encode_sentences
         self.data_type = data_type
         self.task = task
         self.multiplier = multiplier
-        self.df = pd.read_csv(csv_path)
-        logger.info(f"Disc dataset: {task} - {data_type}.")
-        logger.info(f"Unique sentence in original df: {len(self.df.title.unique())}.")
+        df = pd.read_csv(csv_path)
+        self.sentences = df[self.schema.sentence].values.astype(object)
+        self.events = df[self.schema.event].values
+        self.times = df[self.schema.time].values
+        self.urls = df[self.schema.url].values
+        self.cluster_ids = to_cluster_ids(self.events)
+        self.day_ordinals = self.schema.get_days(self.times)
+        logger.info(f"{self.schema.name} dataset: {task} - {data_type}.")
+        logger.info(f"Unique sentence in original df: {len(pd.unique(self.sentences))}.")
         self.label2int = self.get_label2int(task)
-        if not Path(f"./data/stormy_data/{task}").exists():
-            Path(f"./data/stormy_data/{task}").mkdir()
-        save_path = str(Path(f"./data/stormy_data/{task}", f"{data_type}_v3.csv").absolute())
-        self.sampled_df = self.get_sentence_pairs(save_path=save_path, forced=forced)
-        logger.info(f"Unique sentence in sentence-pairs: {len(list(set(self.sampled_df.sentence_a.unique()).union(set(self.sampled_df.sentence_a.unique()))))}.")
-        self.labels = [self.label2int[label] for label in self.sampled_df.labels.values]
+        Path(self.schema.data_dir, task).mkdir(parents=True, exist_ok=True)
+        if lazy:
+            # pairs are sampled per epoch by get_pair_stream, nothing is written
+            self.pairs = None
+            self.labels = None
+            return
+        pairs_name = f"{data_type}_v3_hard{hard_negative_ratio:g}_pairs" if hard_negative_ratio > 0 else f"{data_type}_v3_pairs"
+        save_path = str(Path(self.schema.data_dir, task, pairs_name).absolute())
+        self.pairs = self.get_sentence_pairs(save_path=save_path, forced=forced)
+        logger.info(f"Unique sentence in sentence-pairs: {self.pairs.num_unique_sentences}.")
+        self.labels = self.pairs.labels
+        # item access only indexes these arrays
+        self.pair_sentences = self.pairs.sentences
+        self.pair_a = np.asarray(self.pairs.a)
+        self.pair_b = np.asarray(self.pairs.b)
+        self.pair_labels = np.asarray(self.labels).tolist()
         self.get_descriptions()
 
     @staticmethod
@@ -135,218 +426,64 @@ class StormyDataset(torch.utils.data.Dataset):
         return label2int
 
     def get_sentence_pairs(self, save_path=None, forced=True):
-        if not Path(save_path).exists() or forced:
-            df = generate_diversified_random_pairs(self.df, self.multiplier, self.get_label, self.task)
-            df.to_csv(save_path)
-            logger.info(f"Sentence-pairs size: {len(df)}.")
-            df["sentence_pairs"] = df["sentence_a"] + " " + df["sentence_b"]
-            logger.info(f"# Unique Sentence-pairs size: {len(set(df['sentence_pairs']))}.")
-            logger.info(f"samples labels distribution: {df.labels.value_counts()}).")
-            logger.info(f"sentence pair df len: {len(df)})")
-            logger.info(f"unique sentence_a len: {len(df.sentence_a.value_counts())})")
-            logger.info(f"unique sentence_b len: {len(df.sentence_b.value_counts())})")
-            logger.info(f"unique event_a len: {len(df.event_a.value_counts())})")
-            logger.info(f"unique event_b len: {len(df.event_b.value_counts())})")
-            logger.info(f"unique time_a len: {len(df.time_a.value_counts())})")
-            logger.info(f"unique time_b len: {len(df.time_b.value_counts())})")
-            logger.info(f"unique labels len: {len(df.labels.value_counts())})")
-            logger.info("")
-        else:
-            df = pd.read_csv(save_path)
-
-        logger.info(f"Sampled sentence-pairs' length: {len(df)}.")
-        logger.info(f"Sampled sentence-pairs' label distribution: {df.labels.value_counts()}.\n")
-
-        return df
-
-    def get_label(self, index_tuple):
-        clusters = self.df.wikidata_link.values
-        cluster_i = clusters[index_tuple[0]]
-        cluster_j = clusters[index_tuple[1]]
-        if self.task == "combined":
-            if cluster_i != cluster_j:
-                return "different_event"
-            else:
-                unix_times = self.df.seendate.values
-                unix_time_i = unix_times[index_tuple[0]][:8]
-                unix_time_j = unix_times[index_tuple[1]][:8]
-                if unix_time_i < unix_time_j:
-                    label = "earlier"
-                elif unix_time_i == unix_time_j:
-                    label = "same_date"
-                else:
-                    label = "later"
-                return label
-        elif self.task == "event_deduplication":
-            if cluster_i != cluster_j:
-                return "different_event"
-            else:
-                return "same_event"
-        elif self.task == "event_temporality":
-            if cluster_i != cluster_j:
-                return "ignored"
-            else:
-                unix_times = self.df.seendate.values
-                unix_time_i = unix_times[index_tuple[0]][:8]
-                unix_time_j = unix_times[index_tuple[1]][:8]
-                if unix_time_i < unix_time_j:
-                    label = "earlier"
-                elif unix_time_i == unix_time_j:
-                    label = "same_date"
-                else:
-                    label = "later"
-                return label
+        if not SentencePairs.exists(save_path) or forced:
+            a, b, labels = sample_stratified_pairs(self.cluster_ids, self.day_ordinals,
+                                                   get_n_per_label(len(self.sentences), self.multiplier, self.task), self.task,
+                                                   hard_negatives=self.get_hard_negatives(),
+                                                   hard_negative_ratio=self.hard_negative_ratio)
+            save_sentence_pairs(save_path, self.get_table(), a, b, [self.label2int[label] for label in labels],
+                                self.label2int)
+        pairs = SentencePairs(save_path)
+        logger.info(f"Sampled sentence-pairs' length: {len(pairs)}.")
+        logger.info(f"Sampled sentence-pairs' label distribution: {pd.Series(pairs.label_names).value_counts()}.\n")
+        return pairs
+
+    def get_hard_negatives(self):
+        if self.hard_negative_ratio <= 0:
+            return None
+        if self.encode_sentences is None:
+            raise ValueError("hard_negative_ratio > 0 needs encode_sentences to embed the titles")
+        return hard_negative_candidates(self.encode_sentences(self.sentences), self.cluster_ids, self.day_ordinals)
+
+    def get_pair_stream(self, seed: int = 4, transform=None):
+        """Iterable dataset of freshly sampled pairs every epoch, see StratifiedPairStream."""
+        return StratifiedPairStream(self.sentences, self.cluster_ids, self.day_ordinals, self.multiplier, self.task,
+                                    self.label2int, seed=seed, transform=transform,
+                                    hard_negatives=self.get_hard_negatives(),
+                                    hard_negative_ratio=self.hard_negative_ratio)
+
+    def get_table(self):
+        return pd.DataFrame({"sentence": self.sentences, "event": self.events, "time": self.times, "url": self.urls})
 
     def get_descriptions(self):
-        print(f"Disc dataset {({self.task}-{self.data_type})} csv has {len(self.sampled_df)} entries.")
-        print(f"     Number of clusters - {len(self.df.wikidata_link.unique())}\n\n\n")
+        print(f"{self.schema.name} dataset {({self.task}-{self.data_type})} has {len(self.pair_labels)} pairs.")
+        print(f"     Number of clusters - {len(pd.unique(self.events))}\n\n\n")
 
     def __getitem__(self, idx):
-        return (self.sampled_df.sentence_a.values[idx], self.sampled_df.sentence_b.values[idx]), self.labels[idx]
+        return (self.pair_sentences[self.pair_a[idx]], self.pair_sentences[self.pair_b[idx]]), self.pair_labels[idx]
 
     def __len__(self):
-        return len(self.sampled_df)
+        return len(self.pair_labels)
 
 
-class CrisisFactsDataset(torch.utils.data.Dataset):
-    def __init__(self,
-                 csv_path,
-                 multiplier: int,
-                 task: str = "combined",
-                 data_type: str = "train",
-                 forced: bool = True):
-        random.seed(4)
-        self.data_type = data_type
-        self.task = task
-        self.multiplier = multiplier
-        self.df = pd.read_csv(csv_path)
-        logger.info(f"Crisisfacts dataset: {task} - {data_type}.")
-        logger.info(f"Unique sentence in original df: {len(self.df.text.unique())}.")
-        self.label2int = self.get_label2int(task)
-        if not Path(f"./data/crisisfacts_data/{task}").exists():
-            Path(f"./data/crisisfacts_data/{task}").mkdir()
-        save_path = str(Path(f"./data/crisisfacts_data/{task}", f"{data_type}_v3.csv").absolute())
-        self.sampled_df = self.get_sentence_pairs(save_path=save_path, forced=forced)
-        logger.info(f"Unique sentence in sentence-pairs: {len(list(set(self.sampled_df.sentence_a.unique()).union(set(self.sampled_df.sentence_a.unique()))))}.")
-        self.labels = [self.label2int[label] for label in self.sampled_df.labels.values]
-        self.get_descriptions()
-
-    @staticmethod
-    def get_label2int(task):
-        if task == "combined":
-            label2int = {"different_event": 0, "earlier": 1, "same_date": 2, "later": 3}
-        elif task == "event_deduplication":
-            label2int = {"different_event": 0, "same_event": 1}
-        elif task == "event_temporality":
-            label2int = {"earlier": 0, "same_date": 1, "later": 2}
-        else:
-            ValueError(
-                f"{task} not defined! Please choose from 'combined', 'event_deduplication' or 'event_temporality'")
-        return label2int
-
-    def get_sentence_pairs(self, save_path=None, forced=True):
-        if not Path(save_path).exists() or forced:
-            df = generate_diversified_random_pairs(self.df, self.multiplier, self.get_label, self.task)
-            df.to_csv(save_path)
-            logger.info(f"Sentence-pairs size: {len(df)}.")
-            df["sentence_pairs"] = df["sentence_a"] + " " + df["sentence_b"]
-            logger.info(f"# Unique Sentence-pairs size: {len(set(df['sentence_pairs']))}.")
-            logger.info(f"samples labels distribution: {df.labels.value_counts()}).")
-            logger.info(f"sentence pair df len: {len(df)})")
-            logger.info(f"unique sentence_a len: {len(df.sentence_a.value_counts())})")
-            logger.info(f"unique sentence_b len: {len(df.sentence_b.value_counts())})")
-            logger.info(f"unique event_a len: {len(df.event_a.value_counts())})")
-            logger.info(f"unique event_b len: {len(df.event_b.value_counts())})")
-            logger.info(f"unique time_a len: {len(df.time_a.value_counts())})")
-            logger.info(f"unique time_b len: {len(df.time_b.value_counts())})")
-            logger.info(f"unique labels len: {len(df.labels.value_counts())})")
-            logger.info("")
-        else:
-            df = pd.read_csv(save_path)
-
-        logger.info(f"Sampled sentence-pairs' length: {len(df)}.")
-        logger.info(f"Sampled sentence-pairs' label distribution: {df.labels.value_counts()}.\n")
-
-        return df
-
-    def get_label(self, index_tuple):
-        clusters = self.df.event.values
-        unix_times = self.df.unix_timestamp.values
-        cluster_i = clusters[index_tuple[0]]
-        cluster_j = clusters[index_tuple[1]]
-        if self.task == "combined":
-            if cluster_i != cluster_j:
-                return "different_event"
-            else:
-                unix_time_i = self.round_to_day(unix_times[index_tuple[0]])
-                unix_time_j = self.round_to_day(unix_times[index_tuple[1]])
-                if unix_time_i < unix_time_j:
-                    label = "earlier"
-                elif unix_time_i == unix_time_j:
-                    label = "same_date"
-                else:
-                    label = "later"
-                return label
-        elif self.task == "event_deduplication":
-            if cluster_i != cluster_j:
-                return "different_event"
-            else:
-                return "same_event"
-        elif self.task == "event_temporality":
-            if cluster_i != cluster_j:
-                return "ignored"
-            else:
-                unix_time_i = self.round_to_day(unix_times[index_tuple[0]])
-                unix_time_j = self.round_to_day(unix_times[index_tuple[1]])
-                if unix_time_i < unix_time_j:
-                    label = "earlier"
-                elif unix_time_i == unix_time_j:
-                    label = "same_date"
-                else:
-                    label = "later"
-                return label
+class StormyDataset(PairDataset):
+    schema = STORMY_SCHEMA
 
-    @staticmethod
-    def round_to_day(timestamp):
-        return timestamp - (timestamp % 86400)
-
-    def get_descriptions(self):
-        print(f"Crisisfacts dataset{({self.task}-{self.data_type})} csv has {len(self.sampled_df)} entries.")
-        print(f"     Number of clusters - {len(self.df.event.unique())}\n\n\n")
 
-    def __getitem__(self, idx):
-        return (self.sampled_df.sentence_a.values[idx], self.sampled_df.sentence_b.values[idx]), self.labels[idx]
-
-    def __len__(self):
-        return len(self.sampled_df)
+class CrisisFactsDataset(PairDataset):
+    schema = CRISISFACTS_SCHEMA
 
 
 if __name__ == "__main__":
     # split_stormy_dataset()
     # split_crisisfacts_dataset()
 
-    train_csv_path = Path("./data/stormy_data/train_v3.csv")
-    valid_csv_path = Path("./data/stormy_data/valid_v3.csv")
-    test_csv_path = Path("./data/stormy_data/test_v3.csv")
-    train_event_deduplication_storm = StormyDataset(train_csv_path, task="event_deduplication", multiplier=35, data_type="train", forced=True)
-    valid_event_deduplication_storm = StormyDataset(valid_csv_path, task="event_deduplication", multiplier=30, data_type="valid", forced=True)
-    test_event_deduplication_storm = StormyDataset(test_csv_path, task="event_deduplication", multiplier=30, data_type="test", forced=True)
-
-    train_event_temporality_storm = StormyDataset(train_csv_path, task="event_temporality", multiplier=50, data_type="train", forced=True)
-    valid_event_temporality_storm = StormyDataset(valid_csv_path, task="event_temporality", multiplier=30, data_type="valid", forced=True)
-    test_event_temporality_storm = StormyDataset(test_csv_path, task="event_temporality", multiplier=30, data_type="test", forced=True)
-
-
-    train_crisisfacts_csv_path = Path("./data/crisisfacts_data/crisisfacts_train.csv")
-    valid_crisisfacts_csv_path = Path("./data/crisisfacts_data/crisisfacts_valid.csv")
-    test_crisisfacts_csv_path = Path("./data/crisisfacts_data/crisisfacts_test.csv")
-    train_event_deduplication_crisisfacts = CrisisFactsDataset(train_crisisfacts_csv_path, task="event_deduplication",
-                                                               multiplier=23.3, data_type="train", forced=True)
-    valid_event_deduplication_crisisfacts = CrisisFactsDataset(valid_crisisfacts_csv_path, task="event_deduplication",
-                                                               multiplier=10, data_type="valid", forced=True)
-    test_event_deduplication_crisisfacts = CrisisFactsDataset(test_crisisfacts_csv_path, task="event_deduplication",
-                                                              multiplier=16, data_type="test", forced=True)
-
-    train_event_temporality_crisisfacts = CrisisFactsDataset(train_crisisfacts_csv_path, task="event_temporality", multiplier=33, data_type="train", forced=True)
-    valid_event_temporality_crisisfacts = CrisisFactsDataset(valid_crisisfacts_csv_path, task="event_temporality", multiplier=10, data_type="valid", forced=True)
-    test_event_temporality_crisisfacts = CrisisFactsDataset(test_crisisfacts_csv_path, task="event_temporality", multiplier=16, data_type="test", forced=True)
+    # multipliers of the train, valid and test pairs per corpus and task
+    pair_sets = [(STORMY_SCHEMA, "./data/stormy_data/{}_v3.csv", "event_deduplication", [35, 30, 30]),
+                 (STORMY_SCHEMA, "./data/stormy_data/{}_v3.csv", "event_temporality", [50, 30, 30]),
+                 (CRISISFACTS_SCHEMA, "./data/crisisfacts_data/crisisfacts_{}.csv", "event_deduplication", [23.3, 10, 16]),
+                 (CRISISFACTS_SCHEMA, "./data/crisisfacts_data/crisisfacts_{}.csv", "event_temporality", [33, 10, 16])]
+    for schema, csv_pattern, task, multipliers in pair_sets:
+        for data_type, multiplier in zip(["train", "valid", "test"], multipliers):
+            PairDataset(Path(csv_pattern.format(data_type)), task=task, multiplier=multiplier, data_type=data_type,
+                        forced=True, schema=schema)
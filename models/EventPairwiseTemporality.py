@@ -1,5 +1,6 @@
 import pickle
 import random
+import time
 from pathlib import Path
 import math
 import logging
@@ -9,10 +10,14 @@ import pandas as pd
 import torch.cuda
 from torch import nn
 from sentence_transformers import SentencesDataset, losses, models, InputExample, SentenceTransformer
-from torch.utils.data import DataLoader
-from Datasets import StormyDataset, CrisisFactsDataset
+from torch.utils.data import DataLoader, IterableDataset
+from Datasets import StormyDataset, CrisisFactsDataset, PairStreamDataLoader
 from EventPairwiseTemporalityEvaluator import EventPairwiseTemporalityEvaluator
+from CustomSentenceTransformer import CustomSentenceTransformer
 from Datasets import split_crisisfacts_dataset, split_stormy_dataset
+from SentencePairs import SentencePairs
+from TokenCache import TokenCache, TokenPairDataset, PretokenizedDataLoader
+from LengthBucketing import LengthBucketBatchSampler, derive_max_seq_length
 
 
 logging.basicConfig(level=logging.NOTSET)
@@ -20,6 +25,16 @@ logger = logging.getLogger(__name__)
 logging.getLogger().setLevel(logging.INFO)
 
 
+def to_input_example(sentences, label):
+    return InputExample(texts=list(sentences), label=label)
+
+
+def to_input_examples(pairs):
+    sentences = pairs.sentences
+    return [InputExample(texts=[sentences[a], sentences[b]], label=int(label))
+            for a, b, label in zip(pairs.a, pairs.b, pairs.labels)]
+
+
 class EventPairwiseTemporalityModel(object):
     def __init__(self,
                  multipliers: list,
@@ -31,8 +46,35 @@ class EventPairwiseTemporalityModel(object):
                  load_pretrained: bool = False,
                  pretrained_model_path: str = "./outputs/v5/event_deduplication/",
                  task: str = "combined",
-                 forced: bool = False):
+                 forced: bool = False,
+                 lazy_pairs: bool = False,
+                 pretokenize: bool = False,
+                 hard_negative_ratio: float = 0.0,
+                 hard_negative_encoder: str = "sentence-transformers/all-MiniLM-L6-v2",
+                 max_seq_length=256,
+                 length_bucketing: bool = False,
+                 max_tokens: int = None,
+                 unique_sentence_eval: bool = True):
+        if lazy_pairs and (pretokenize or length_bucketing):
+            # the pair stream yields sentence strings of pairs sampled every epoch, not rows of a pair store
+            raise ValueError("lazy_pairs cannot be combined with pretokenize or length_bucketing, "
+                             "which need the fixed pairs of a pair store")
         self.forced = forced
+        # evaluate by encoding every unique sentence once instead of both sentences of every pair
+        self.unique_sentence_eval = unique_sentence_eval
+        # "auto": derived from the token lengths of the first sentences loaded, the training set
+        self.max_seq_length = max_seq_length
+        # training batches of pairs of similar length, of batch_size pairs or max_tokens padded tokens;
+        # needs the token lengths, so it implies pretokenize
+        self.length_bucketing = length_bucketing
+        self.max_tokens = max_tokens
+        # share of the training different_event pairs which are similar titles of other events of the same days
+        self.hard_negative_ratio = hard_negative_ratio
+        self.hard_negative_encoder = hard_negative_encoder
+        # tokenise every sentence of the pair stores once instead of every pair in every epoch
+        self.pretokenize = pretokenize or length_bucketing
+        # sample fresh training pairs every epoch instead of one fixed sample
+        self.lazy_pairs = lazy_pairs
         self.exp_name = exp_name
         self.num_epochs = num_epochs
         self.task = task
@@ -42,21 +84,21 @@ class EventPairwiseTemporalityModel(object):
         self.batch_size = batch_size
         self.label2int = self.get_label2int(task)
 
-        word_embedding_model = models.Transformer(transformer_model, max_seq_length=256)
+        word_embedding_model = models.Transformer(transformer_model, max_seq_length=256 if max_seq_length == "auto" else max_seq_length)
         pooling_model = models.Pooling(word_embedding_model.get_word_embedding_dimension())
         dense_model = models.Dense(in_features=pooling_model.get_sentence_embedding_dimension(),
                                    out_features=256, activation_function=nn.Tanh())
         if not load_pretrained:
-            self.model = SentenceTransformer(modules=[word_embedding_model, pooling_model, dense_model], device=self.device)
+            self.model = CustomSentenceTransformer(modules=[word_embedding_model, pooling_model, dense_model], device=self.device)
         else:
             if Path(pretrained_model_path).exists():
-                self.model = SentenceTransformer(str(Path(pretrained_model_path).absolute()), device=self.device)
+                self.model = CustomSentenceTransformer(str(Path(pretrained_model_path).absolute()), device=self.device)
 
             elif Path("./outputs", exp_name, task, "pytorch_model.bin").exists():
-                self.model = SentenceTransformer(str(Path("./outputs", exp_name, task).absolute()), device=self.device)
+                self.model = CustomSentenceTransformer(str(Path("./outputs", exp_name, task).absolute()), device=self.device)
             else:
-                self.model = SentenceTransformer(modules=[word_embedding_model, pooling_model, dense_model],
-                                                 device=self.device)
+                self.model = CustomSentenceTransformer(modules=[word_embedding_model, pooling_model, dense_model],
+                                                       device=self.device)
         self.train_loss = losses.SoftmaxLoss(model=self.model,
                                              sentence_embedding_dimension=self.model.get_sentence_embedding_dimension(),
                                              num_labels=len(self.label2int))
@@ -74,30 +116,66 @@ class EventPairwiseTemporalityModel(object):
                 f"{task} not defined! Please choose from 'combined', 'event_deduplication' or 'event_temporality'")
         return label2int
 
+    def encode_for_hard_negatives(self, sentences):
+        encoder = SentenceTransformer(self.hard_negative_encoder, device=self.device)
+        return encoder.encode(list(sentences), batch_size=256, convert_to_numpy=True, normalize_embeddings=True,
+                              show_progress_bar=True)
+
+    def to_examples(self, pairs):
+        return pairs if self.pretokenize else to_input_examples(pairs)
+
+    def resolve_max_seq_length(self, data):
+        if self.max_seq_length != "auto":
+            return
+        sentences = data.sentences if hasattr(data, "sentences") else [text for example in data for text in example.texts]
+        self.max_seq_length = derive_max_seq_length(sentences, self.model.tokenizer)
+        self.model.max_seq_length = self.max_seq_length
+
+    def get_dataloader(self, data, shuffle: bool, length_bucketing: bool = False):
+        self.resolve_max_seq_length(data)
+        if isinstance(data, IterableDataset):
+            if length_bucketing:
+                raise ValueError("length_bucketing needs the fixed pairs of a pair store, not a pair stream")
+            # the pair stream shuffles every epoch itself, the loader advances its epoch
+            return PairStreamDataLoader(data, batch_size=self.batch_size)
+        if isinstance(data, SentencePairs):
+            tokenizer = self.model.tokenizer
+            cache_dir = TokenCache.get_cache_dir(data.path, tokenizer, self.model.max_seq_length)
+            token_cache = TokenCache.build(cache_dir, data.sentences, tokenizer, self.model.max_seq_length,
+                                           fingerprint=data.sentence_fingerprint)
+            if length_bucketing:
+                batch_sampler = LengthBucketBatchSampler(token_cache.lengths[data.a], token_cache.lengths[data.b],
+                                                         batch_size=None if self.max_tokens else self.batch_size,
+                                                         max_tokens=self.max_tokens, shuffle=shuffle)
+                return PretokenizedDataLoader(TokenPairDataset(data), token_cache, batch_sampler=batch_sampler)
+            return PretokenizedDataLoader(TokenPairDataset(data), token_cache, shuffle=shuffle,
+                                          batch_size=self.batch_size)
+        return DataLoader(SentencesDataset(data, self.model), shuffle=shuffle, batch_size=self.batch_size)
+
     def prepare_data(self, data_type="train"):
         if data_type != "test":
             train_csv_path = Path("./data/stormy_data/train_v3.csv")
             valid_csv_path = Path("./data/stormy_data/valid_v3.csv")
-            train = StormyDataset(train_csv_path, task=self.task, data_type=data_type, forced=self.forced, multiplier=self.multipliers[0]) #50
+            train = StormyDataset(train_csv_path, task=self.task, data_type=data_type, forced=self.forced, multiplier=self.multipliers[0], lazy=self.lazy_pairs,
+                          hard_negative_ratio=self.hard_negative_ratio, encode_sentences=self.encode_for_hard_negatives) #50
             valid = StormyDataset(valid_csv_path, task=self.task, data_type="valid", forced=self.forced, multiplier=self.multipliers[1]) #30
-            train_examples = [InputExample(texts=[train.sampled_df.sentence_a.values[i], train.sampled_df.sentence_b.values[i]],
-                                           label=train.labels[i]) for i in range(len(train))]
-            valid_examples = [InputExample(texts=[valid.sampled_df.sentence_a.values[i], valid.sampled_df.sentence_b.values[i]],
-                                           label=valid.labels[i]) for i in range(len(valid))]
+            if self.lazy_pairs:
+                train_examples = train.get_pair_stream(transform=to_input_example)
+            else:
+                train_examples = self.to_examples(train.pairs)
+            valid_examples = self.to_examples(valid.pairs)
             logger.info(f"Test (Disc - train): {len(train_examples)} pairs of sentences")
             logger.info(f"Test (Disc - valid): {len(valid_examples)} pairs of sentences\n\n")
             return train_examples, valid_examples
         else:
             test_csv_path = Path("./data/stormy_data/test_v3.csv")
             test = StormyDataset(test_csv_path, task=self.task, data_type=data_type, forced=self.forced, multiplier=self.multipliers[2]) #30
-            test_examples = [InputExample(texts=[test.sampled_df.sentence_a.values[i], test.sampled_df.sentence_b.values[i]],
-                                           label=test.labels[i]) for i in range(len(test))]
+            test_examples = self.to_examples(test.pairs)
             logger.info(f"Test (Disc - test): {len(test_examples)} pairs of sentences")
 
             test_csv_path = Path("./data/crisisfacts_data/crisisfacts_test.csv")
             test = CrisisFactsDataset(test_csv_path, task=self.task, data_type=data_type, forced=self.forced, multiplier=self.multipliers[3])  #30
-            test_examples_crisisfact = [InputExample(texts=[test.sampled_df.sentence_a.values[i], test.sampled_df.sentence_b.values[i]],
-                                          label=test.labels[i]) for i in range(len(test))]
+            test_examples_crisisfact = self.to_examples(test.pairs)
             logger.info(f"Test (Crisisfacts - test): {len(test_examples_crisisfact)} pairs of sentences")
 
             return test_examples, test_examples_crisisfact
@@ -106,12 +184,14 @@ class EventPairwiseTemporalityModel(object):
         if data_type != "test":
             train_csv_path = Path("./data/crisisfacts_data/crisisfacts_train.csv")
             valid_csv_path = Path("./data/crisisfacts_data/crisisfacts_valid.csv")
-            train = CrisisFactsDataset(train_csv_path, task=self.task, data_type=data_type, forced=self.forced, multiplier=self.multipliers[0]) #50
+            train = CrisisFactsDataset(train_csv_path, task=self.task, data_type=data_type, forced=self.forced, multiplier=self.multipliers[0], lazy=self.lazy_pairs,
+                          hard_negative_ratio=self.hard_negative_ratio, encode_sentences=self.encode_for_hard_negatives) #50
             valid = CrisisFactsDataset(valid_csv_path, task=self.task, data_type="valid", forced=self.forced, multiplier=self.multipliers[1]) #30
-            train_examples_crisisfact = [InputExample(texts=[train.sampled_df.sentence_a.values[i], train.sampled_df.sentence_b.values[i]],
-                                                     label=train.labels[i]) for i in range(len(train))]
-            valid_examples_crisisfact = [InputExample(texts=[valid.sampled_df.sentence_a.values[i], valid.sampled_df.sentence_b.values[i]],
-                                                      label=valid.labels[i]) for i in range(len(valid))]
+            if self.lazy_pairs:
+                train_examples_crisisfact = train.get_pair_stream(transform=to_input_example)
+            else:
+                train_examples_crisisfact = self.to_examples(train.pairs)
+            valid_examples_crisisfact = self.to_examples(valid.pairs)
             logger.info(f"Test (Crisisfacts - train): {len(train_examples_crisisfact)} pairs of sentences")
             logger.info(f"Test (Crisisfacts - valid): {len(valid_examples_crisisfact)} pairs of sentences\n\n")
 
@@ -119,14 +199,12 @@ class EventPairwiseTemporalityModel(object):
         else:
             test_csv_path = Path("./data/stormy_data/test_v3.csv")
             test = StormyDataset(test_csv_path, task=self.task, data_type=data_type, forced=self.forced, multiplier=self.multipliers[2]) #30
-            test_examples = [InputExample(texts=[test.sampled_df.sentence_a.values[i], test.sampled_df.sentence_b.values[i]],
-                                          label=test.labels[i]) for i in range(len(test))]
+            test_examples = self.to_examples(test.pairs)
             logger.info(f"Test (Disc - test): {len(test_examples)} pairs of sentences")
 
             test_csv_path = Path("./data/crisisfacts_data/crisisfacts_test.csv")
             test = CrisisFactsDataset(test_csv_path, task=self.task, data_type=data_type, forced=self.forced, multiplier=self.multipliers[3]) #30
-            test_examples_crisisfact = [InputExample(texts=[test.sampled_df.sentence_a.values[i], test.sampled_df.sentence_b.values[i]],
-                                                     label=test.labels[i]) for i in range(len(test))]
+            test_examples_crisisfact = self.to_examples(test.pairs)
             logger.info(f"Test (Crisisfacts - test): {len(test_examples_crisisfact)} pairs of sentences\n\n")
             return test_examples, test_examples_crisisfact
 
@@ -137,13 +215,12 @@ class EventPairwiseTemporalityModel(object):
         else:
             training_data, validation_data = self.prepare_data(data_type="train")
 
-        training_dataset = SentencesDataset(training_data, self.model)
-        validation_dataset = SentencesDataset(validation_data, self.model)
-        training_dataloader = DataLoader(training_dataset, shuffle=True, batch_size=self.batch_size)
-        validation_dataloader = DataLoader(validation_dataset, shuffle=False, batch_size=self.batch_size)
+        training_dataloader = self.get_dataloader(training_data, shuffle=True, length_bucketing=self.length_bucketing)
+        validation_dataloader = self.get_dataloader(validation_data, shuffle=False)
         validation_evaluator = EventPairwiseTemporalityEvaluator(validation_dataloader,
                                                                  name=f'validation_{self.exp_name}_{self.task}',
-                                                                 softmax_model=self.train_loss)
+                                                                 softmax_model=self.train_loss,
+                                                                 pairs=validation_data if self.unique_sentence_eval else None)
 
         warmup_steps = math.ceil(len(training_dataloader) * self.num_epochs * 0.1)  # 10% of train data for warm-up
         logger.info(f"Warmup-steps: {warmup_steps}")
@@ -153,6 +230,7 @@ class EventPairwiseTemporalityModel(object):
         validation_evaluator(self.model, output_path=str(Path("./outputs", self.exp_name, self.task, "validation")))
         output_path = str(Path("./outputs", self.exp_name, self.task, "crisisfacts").absolute()) if task_validation else str(Path("./outputs", self.exp_name, self.task, "disc").absolute())
         # Train the model
+        start = time.perf_counter()
         self.model.fit(train_objectives=[(training_dataloader, self.train_loss)],
                        evaluator=validation_evaluator,
                        epochs=self.num_epochs,
@@ -162,6 +240,9 @@ class EventPairwiseTemporalityModel(object):
                        show_progress_bar=True,
                        save_best_model=True,
                        optimizer_params={'lr': 2e-05})
+        if isinstance(training_dataloader.batch_sampler, LengthBucketBatchSampler):
+            # tokens/sec over the whole fit, including the evaluations during training
+            training_dataloader.batch_sampler.report(elapsed_sec=time.perf_counter() - start)
 
     def test(self, task_validation: False):
         logger.info(f"Testing on Disc test set...")
@@ -169,30 +250,28 @@ class EventPairwiseTemporalityModel(object):
             testing_data, testing_data_crisisfacts_test = self.prepare_task_validation_data(data_type="test")
         else:
             testing_data, testing_data_crisisfacts_test = self.prepare_data(data_type="test")
-        testing_dataset = SentencesDataset(testing_data, self.model)
-        testing_dataloader = DataLoader(testing_dataset, shuffle=False, batch_size=self.batch_size)
+        testing_dataloader = self.get_dataloader(testing_data, shuffle=False)
         testing_evaluator = EventPairwiseTemporalityEvaluator(testing_dataloader,
                                                               name=f'test_{self.exp_name}_{self.task}_gdelt',
-                                                              softmax_model=self.train_loss)
+                                                              softmax_model=self.train_loss,
+                                                              pairs=testing_data if self.unique_sentence_eval else None)
 
         testing_evaluator(self.model, output_path=str(Path("./outputs", self.exp_name, self.task, "test")))
-        test_csv_path = Path(f"./data/stormy_data/{self.task}/test_v3.csv")
-        df = pd.read_csv(test_csv_path)
+        df = SentencePairs(Path(f"./data/stormy_data/{self.task}/test_v3_pairs")).to_frame()
         with open(Path("./outputs", self.exp_name, self.task, "test", f"test_{self.exp_name}_{self.task}_gdelt_prediction.pkl"), "rb") as fp:
             predictions = pickle.load(fp)
         df["predictions"] = predictions
         df.to_csv(Path("./outputs", self.exp_name, self.task, "test", "test_predictions_disc.csv"))
 
         logger.info(f"Testing on Crisisfacts test set...")
-        testing_dataset = SentencesDataset(testing_data_crisisfacts_test, self.model)
-        testing_dataloader = DataLoader(testing_dataset, shuffle=False, batch_size=self.batch_size)
+        testing_dataloader = self.get_dataloader(testing_data_crisisfacts_test, shuffle=False)
         testing_evaluator = EventPairwiseTemporalityEvaluator(testing_dataloader,
                                                               name=f'test_{self.exp_name}_{self.task}_crisisfacts',
-                                                              softmax_model=self.train_loss)
+                                                              softmax_model=self.train_loss,
+                                                              pairs=testing_data_crisisfacts_test if self.unique_sentence_eval else None)
 
         testing_evaluator(self.model, output_path=str(Path("./outputs", self.exp_name, self.task, "test")))
-        test_csv_path = Path(f"./data/crisisfacts_data/{self.task}/test_v3.csv")
-        df = pd.read_csv(test_csv_path)
+        df = SentencePairs(Path(f"./data/crisisfacts_data/{self.task}/test_v3_pairs")).to_frame()
         with open(Path("./outputs", self.exp_name, self.task, "test",
                        f"test_{self.exp_name}_{self.task}_crisisfacts_prediction.pkl"), "rb") as fp:
             predictions = pickle.load(fp)
@@ -4,23 +4,59 @@ from pathlib import Path
 from tqdm import tqdm
 
 import numpy as np
+import pandas as pd
 from sentence_transformers.evaluation import LabelAccuracyEvaluator
 from torch.utils.data import DataLoader
 from sentence_transformers.util import batch_to_device
 import logging
 import torch
-from sklearn.metrics import precision_recall_fscore_support
+
+from ConfusionMatrix import ConfusionMatrixAccumulator
 
 logger = logging.getLogger(__name__)
 logging.getLogger().setLevel(logging.INFO)
 
 
+def get_unique_sentence_pairs(data):
+    """
+    Unique sentences and, for every pair, the indices of its sentences among them and its label,
+    from a SentencePairs store or a list of InputExamples.
+    """
+    if hasattr(data, "sentences"):
+        sentences, inverse = np.unique(np.asarray(data.sentences, dtype=str), return_inverse=True)
+        inverse = inverse.ravel()
+        return sentences, inverse[np.asarray(data.a)], inverse[np.asarray(data.b)], np.asarray(data.labels, dtype=np.int64)
+    codes, sentences = pd.factorize(pd.Series([text for example in data for text in example.texts], dtype=object))
+    return np.asarray(sentences, dtype=object), codes[0::2], codes[1::2], np.array([example.label for example in data])
+
+
+def pair_features(softmax_model, u, v):
+    """The input of the SoftmaxLoss classifier for the sentence embeddings u and v of the pairs."""
+    features = []
+    if softmax_model.concatenation_sent_rep:
+        features.extend([u, v])
+    if softmax_model.concatenation_sent_difference:
+        features.append(torch.abs(u - v))
+    if softmax_model.concatenation_sent_multiplication:
+        features.append(u * v)
+    return torch.cat(features, 1)
+
+
 class EventPairwiseTemporalityEvaluator(LabelAccuracyEvaluator):
-    def __init__(self, dataloader: DataLoader, name: str = "", softmax_model=None, write_csv: bool = True, write_predictions: bool = True):
+    """
+    With pairs (a SentencePairs store or the InputExamples of the dataloader), every unique sentence is encoded
+    once and the classifier is applied to the gathered embeddings of all pairs, instead of running the
+    transformer on both sentences of every pair.
+    """
+    def __init__(self, dataloader: DataLoader, name: str = "", softmax_model=None, write_csv: bool = True, write_predictions: bool = True,
+                 pairs=None, encode_batch_size: int = 1024, classifier_batch_size: int = 65536):
         super().__init__(dataloader, name, softmax_model, write_csv)
         self.csv_file = "evaluation_"+name+"_results.csv"
         self.name = name
         self.write_predictions = write_predictions
+        self.unique_sentence_pairs = get_unique_sentence_pairs(pairs) if pairs is not None else None
+        self.encode_batch_size = encode_batch_size
+        self.classifier_batch_size = classifier_batch_size
         self.csv_headers = ["epoch", "steps", "accuracy", "macro_precision", "macro_recall", "macro_f1",
                                      "micro_precision", "micro_recall",  "micro_f1",
                                      "weighted_precision", "weighted_recall", "weighted_f1"]
@@ -30,11 +66,6 @@ class EventPairwiseTemporalityEvaluator(LabelAccuracyEvaluator):
     def __call__(self, model, output_path: str = None, epoch: int = -1, steps: int = -1) -> float:
         model.eval()
         logger.info(f"Evaluator on device: {self.device}")
-        total = 0
-        correct = 0
-        y_true = []
-        y_predict = []
-
         if epoch != -1:
             if steps == -1:
                 out_txt = " after epoch {}:".format(epoch)
@@ -44,45 +75,23 @@ class EventPairwiseTemporalityEvaluator(LabelAccuracyEvaluator):
             out_txt = ":"
 
         logger.info("Evaluation on the "+self.name+" dataset"+out_txt)
-        self.dataloader.collate_fn = model.smart_batching_collate
-
-        for step, batch in tqdm(enumerate(self.dataloader)):
-            features, label_ids = batch
-            y_true.append(label_ids)
-            for idx in range(len(features)):
-                features[idx] = batch_to_device(features[idx], self.device)
-            label_ids = torch.tensor(label_ids, device=self.device)
-            with torch.no_grad():
-                _, prediction = self.softmax_model(features, labels=None)
-            y_predict.append(torch.argmax(prediction, dim=1).detach().cpu().numpy())
-            total += prediction.size(0)
-            correct += torch.argmax(prediction, dim=1).eq(label_ids).sum().item()
-        y_true = np.concatenate(y_true)
-        y_predict = np.concatenate(y_predict)
-        macro_precision, macro_recall, macro_f1, _ = precision_recall_fscore_support(y_true, y_predict, average='macro', zero_division=0)
-        micro_precision, micro_recall, micro_f1, _ = precision_recall_fscore_support(y_true, y_predict, average='micro', zero_division=0)
-        weighted_precision, weighted_recall, weighted_f1, _ = precision_recall_fscore_support(y_true, y_predict, average='weighted', zero_division=0)
-        accuracy = correct/total
-
-        logger.info("Accuracy: {:.4f} ({}/{})\n".format(accuracy, correct, total))
-        logger.info(f"Macro metrics:")
-        logger.info(f"    precision: {macro_precision}")
-        logger.info(f"    recall: {macro_recall}")
-        logger.info(f"    f1: {macro_f1}")
-        logger.info(f"Micro metrics:")
-        logger.info(f"    precision: {micro_precision}")
-        logger.info(f"    recall: {micro_recall}")
-        logger.info(f"    f1: {micro_f1}")
-        logger.info(f"Weighted metrics:")
-        logger.info(f"    precision: {weighted_precision}")
-        logger.info(f"    recall: {weighted_recall}")
-        logger.info(f"    f1: {weighted_f1}")
+        metrics = ConfusionMatrixAccumulator(self.softmax_model.classifier.out_features, device=self.device)
+        if self.unique_sentence_pairs is not None:
+            y_true, y_predict = self.predict_unique_sentences(model, metrics)
+        else:
+            y_true, y_predict = self.predict_batches(model, metrics)
+        results = metrics.compute()
+        ConfusionMatrixAccumulator.log(results)
+        accuracy = results["accuracy"]
+        macro_precision, macro_recall, macro_f1 = results["macro_precision"], results["macro_recall"], results["macro_f1"]
+        micro_precision, micro_recall, micro_f1 = results["micro_precision"], results["micro_recall"], results["micro_f1"]
+        weighted_precision, weighted_recall, weighted_f1 = results["weighted_precision"], results["weighted_recall"], results["weighted_f1"]
 
         if output_path is not None and self.write_csv:
             csv_path = Path(output_path, self.csv_file).absolute()
             if self.write_predictions:
-                y_true.dump(Path(output_path, f"{self.name}_labels.pkl").absolute())
-                y_predict.dump(Path(output_path, f"{self.name}_prediction.pkl").absolute())
+                y_true.cpu().numpy().dump(Path(output_path, f"{self.name}_labels.pkl").absolute())
+                y_predict.cpu().numpy().dump(Path(output_path, f"{self.name}_prediction.pkl").absolute())
 
             if not os.path.isfile(csv_path):
                 with open(csv_path, newline='', mode="w", encoding="utf-8") as f:
@@ -100,6 +109,39 @@ class EventPairwiseTemporalityEvaluator(LabelAccuracyEvaluator):
 
         return macro_f1
 
+    def predict_batches(self, model, metrics):
+        # labels and predictions stay on the device until the end, no synchronisation per batch
+        y_true = []
+        y_predict = []
+        self.dataloader.collate_fn = model.smart_batching_collate
+        for step, batch in tqdm(enumerate(self.dataloader)):
+            features, label_ids = batch
+            for idx in range(len(features)):
+                features[idx] = batch_to_device(features[idx], self.device)
+            label_ids = torch.as_tensor(label_ids).to(self.device, non_blocking=True)
+            with torch.no_grad():
+                _, prediction = self.softmax_model(features, labels=None)
+            y_true.append(label_ids)
+            y_predict.append(metrics.update(label_ids, prediction))
+        return torch.cat(y_true), torch.cat(y_predict)
+
+    def predict_unique_sentences(self, model, metrics):
+        sentences, a, b, y_true = self.unique_sentence_pairs
+        logger.info(f"Encoding {len(sentences)} unique sentences of {len(a)} pairs")
+        with torch.no_grad():
+            embeddings = model.encode(list(sentences), batch_size=self.encode_batch_size, convert_to_tensor=True,
+                                      device=self.device, show_progress_bar=False)
+            a = torch.as_tensor(a, device=embeddings.device)
+            b = torch.as_tensor(b, device=embeddings.device)
+            y_true = torch.as_tensor(y_true, device=embeddings.device)
+            y_predict = []
+            for start in range(0, len(a), self.classifier_batch_size):
+                end = start + self.classifier_batch_size
+                logits = self.softmax_model.classifier(pair_features(self.softmax_model, embeddings[a[start:end]],
+                                                                     embeddings[b[start:end]]))
+                y_predict.append(metrics.update(y_true[start:end], logits))
+        return y_true, torch.cat(y_predict)
+
     @property
     def device(self):
         if torch.cuda.is_available():
@@ -0,0 +1,100 @@
+import argparse
+import logging
+import random
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import torch
+
+from Datasets import STORMY_SCHEMA
+from EventPairwiseTemporality import EventPairwiseTemporalityModel
+from SentencePairs import SentencePairs
+
+
+logging.basicConfig(level=logging.NOTSET)
+logger = logging.getLogger(__name__)
+logging.getLogger().setLevel(logging.INFO)
+
+
+# (name, training multiplier, hard negative ratio); the first one is the random-pair baseline
+DEFAULT_CONFIGS = [("random-35", 35, 0.0),
+                   ("hard50-10", 10, 0.5),
+                   ("hard50-5", 5, 0.5),
+                   ("hard75-5", 5, 0.75)]
+
+
+def read_macro_f1(exp_name, task, dataset):
+    results_path = Path("./outputs", exp_name, task, "test", f"evaluation_test_{exp_name}_{task}_{dataset}_results.csv")
+    return pd.read_csv(results_path).macro_f1.values[-1]
+
+
+def run_config(exp_name, name, multiplier, hard_negative_ratio, task, transformer_model, batch_size, num_epochs, seed):
+    torch.manual_seed(seed)
+    random.seed(seed)
+    np.random.seed(seed)
+    run_name = f"{exp_name}-{name}"
+    # forced, the pair stores of all configs share their paths
+    model = EventPairwiseTemporalityModel(multipliers=[multiplier, 30, 30, 16],
+                                          forced=True,
+                                          batch_size=batch_size,
+                                          num_epochs=num_epochs,
+                                          exp_name=run_name,
+                                          transformer_model=transformer_model,
+                                          load_pretrained=False,
+                                          task=task,
+                                          hard_negative_ratio=hard_negative_ratio)
+    start = time.perf_counter()
+    model.train(task_validation=False)
+    train_sec = time.perf_counter() - start
+    model.test(task_validation=False)
+    pairs_name = f"train_v3_hard{hard_negative_ratio:g}_pairs" if hard_negative_ratio > 0 else "train_v3_pairs"
+    return {"config": name,
+            "multiplier": multiplier,
+            "hard_negative_ratio": hard_negative_ratio,
+            "train_pairs": len(SentencePairs(Path(STORMY_SCHEMA.data_dir, task, pairs_name))),
+            "train_sec": train_sec,
+            "macro_f1_gdelt": read_macro_f1(run_name, task, "gdelt"),
+            "macro_f1_crisisfacts": read_macro_f1(run_name, task, "crisisfacts")}
+
+
+def run_experiment(exp_name, configs, task, transformer_model, batch_size, num_epochs, seed, tolerance):
+    """
+    Trains one model per config on the Disc training set and compares macro-F1 on both test sets and the
+    number of training pairs with the baseline (first config).
+    """
+    results = pd.DataFrame([run_config(exp_name, name, multiplier, ratio, task, transformer_model, batch_size,
+                                       num_epochs, seed) for name, multiplier, ratio in configs])
+    baseline = results.iloc[0]
+    results["pair_fraction"] = results.train_pairs / baseline.train_pairs
+    results["delta_f1_gdelt"] = results.macro_f1_gdelt - baseline.macro_f1_gdelt
+    results["delta_f1_crisisfacts"] = results.macro_f1_crisisfacts - baseline.macro_f1_crisisfacts
+    results["matches_baseline"] = (results.delta_f1_gdelt >= -tolerance) & (results.delta_f1_crisisfacts >= -tolerance)
+    output_path = Path("./outputs", f"hard_negative_experiment_{exp_name}_{task}.csv")
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    results.to_csv(output_path, index=False)
+    print(results.to_string(index=False))
+    print(f"Results written to {output_path}")
+    return results
+
+
+def parse_config(value):
+    name, multiplier, ratio = value.split(":")
+    return name, int(multiplier), float(ratio)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Macro-F1 of hard-negative pair sampling against the random baseline")
+    parser.add_argument("--exp-name", default="hard-negatives")
+    parser.add_argument("--task", default="event_deduplication", choices=["event_deduplication", "combined"])
+    parser.add_argument("--configs", nargs="+", type=parse_config,
+                        default=DEFAULT_CONFIGS, help="name:multiplier:hard_negative_ratio, baseline first")
+    parser.add_argument("--transformer-model", default="distilbert/distilbert-base-cased")
+    parser.add_argument("--batch-size", type=int, default=450)
+    parser.add_argument("--num-epochs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=0.005, help="allowed macro-F1 drop against the baseline")
+    args = parser.parse_args()
+    run_experiment(args.exp_name, args.configs, args.task, args.transformer_model, args.batch_size, args.num_epochs,
+                   args.seed, args.tolerance)
@@ -0,0 +1,89 @@
+import argparse
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+from CustomSentenceTransformer import BACKENDS, InferenceModel
+from SentencePairs import SentencePairs
+
+
+logging.basicConfig(level=logging.NOTSET)
+logger = logging.getLogger(__name__)
+logging.getLogger().setLevel(logging.INFO)
+
+
+def prediction_drift(reference_probabilities, probabilities, labels=None, reference_labels=None, gold_labels=None):
+    """
+    Drift of the predictions of a backend from the fp32 reference: share of pairs whose label changes,
+    largest and mean absolute change of a class probability and, with gold labels, the change in accuracy.
+    """
+    drift = {"label_agreement": float(np.mean(np.argmax(reference_probabilities, axis=1) ==
+                                              np.argmax(probabilities, axis=1))),
+             "max_probability_diff": float(np.abs(reference_probabilities - probabilities).max()),
+             "mean_probability_diff": float(np.abs(reference_probabilities - probabilities).mean())}
+    if gold_labels is not None:
+        drift["accuracy"] = float(np.mean(labels == gold_labels))
+        drift["accuracy_diff"] = drift["accuracy"] - float(np.mean(reference_labels == gold_labels))
+    return drift
+
+
+def pairs_per_sec(inference_model, pair_ids, sentences, repeats: int):
+    # the first call warms up the backend (allocations, ONNX Runtime graph optimisation)
+    inference_model.predict(pair_ids[:1000], sentences=sentences)
+    rates = []
+    for _ in range(repeats):
+        labels, probabilities = inference_model.predict(pair_ids, sentences=sentences)
+        rates.append(inference_model.pairs_per_sec)
+    return float(np.median(rates)), labels, probabilities
+
+
+def run_benchmark(model_path, pairs_path, backends, n_pairs: int, encode_batch_size: int, repeats: int,
+                  num_threads: int, max_disagreement: float, seed: int = 0):
+    """
+    Pairs/sec on cpu of the backends on a sample of the pairs of a pair store, with their drift from the
+    fp32 torch backend. A backend passes the drift check if at most max_disagreement of the labels change.
+    """
+    sentence_pairs = SentencePairs(pairs_path)
+    sample = np.sort(np.random.default_rng(seed).choice(len(sentence_pairs), size=min(n_pairs, len(sentence_pairs)),
+                                                        replace=False))
+    pair_ids = np.stack([sentence_pairs.a[sample], sentence_pairs.b[sample]], axis=1)
+    gold_labels = sentence_pairs.label_names[sample]
+    sentences = sentence_pairs.sentences
+    results = []
+    reference = None
+    for backend in ["torch"] + [backend for backend in backends if backend != "torch"]:
+        start = time.perf_counter()
+        inference_model = InferenceModel(model_path, device="cpu", write_predictions=False, backend=backend,
+                                         encode_batch_size=encode_batch_size, num_threads=num_threads)
+        load_sec = time.perf_counter() - start
+        rate, labels, probabilities = pairs_per_sec(inference_model, pair_ids, sentences, repeats)
+        if reference is None:
+            reference = (rate, labels, probabilities)
+        drift = prediction_drift(reference[2], probabilities, labels, reference[1], gold_labels)
+        results.append({"backend": backend, "load_sec": load_sec, "pairs_per_sec": rate,
+                        "speedup": rate / reference[0] if reference[0] else float("nan"), **drift,
+                        "drift_ok": 1 - drift["label_agreement"] <= max_disagreement})
+    results = pd.DataFrame(results)
+    print(f"{len(pair_ids)} pairs of {pairs_path} on cpu:")
+    print(results.to_string(index=False))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pairs/sec and prediction drift of the InferenceModel backends on cpu")
+    parser.add_argument("--model", required=True, help="trained model directory, e.g. ./outputs/v1/event_deduplication/disc")
+    parser.add_argument("--pairs", required=True, help="pair store, e.g. ./data/stormy_data/event_deduplication/test_v3_pairs")
+    parser.add_argument("--backends", nargs="+", default=BACKENDS, choices=BACKENDS)
+    parser.add_argument("--n-pairs", type=int, default=20000)
+    parser.add_argument("--encode-batch-size", type=int, default=128)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument("--max-disagreement", type=float, default=0.01, help="allowed share of changed labels")
+    args = parser.parse_args()
+    benchmark = run_benchmark(args.model, args.pairs, args.backends, args.n_pairs, args.encode_batch_size,
+                              args.repeats, args.num_threads, args.max_disagreement)
+    if not benchmark.drift_ok.all():
+        raise SystemExit(f"Prediction drift above {args.max_disagreement:.1%}: "
+                         f"{', '.join(benchmark.backend[~benchmark.drift_ok])}")
@@ -0,0 +1,123 @@
+import logging
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+logger = logging.getLogger(__name__)
+
+
+def derive_max_seq_length(sentences, tokenizer, quantile: float = 0.999, multiple_of: int = 8,
+                          sample_size: int = 20000, seed: int = 0):
+    """
+    Token length covering the quantile of the sentences (estimated on a sample of them), rounded up to a
+    multiple of multiple_of and capped at the maximum length of the tokenizer's model.
+    """
+    sentences = np.asarray(sentences, dtype=object)
+    if len(sentences) > sample_size:
+        sentences = sentences[np.random.default_rng(seed).choice(len(sentences), size=sample_size, replace=False)]
+    model_max_length = min(getattr(tokenizer, "model_max_length", 512), 512)
+    input_ids = tokenizer([str(sentence) for sentence in sentences], truncation=True,
+                          max_length=model_max_length)["input_ids"]
+    lengths = np.fromiter(map(len, input_ids), dtype=np.int64, count=len(input_ids))
+    max_seq_length = int(np.ceil(np.quantile(lengths, quantile) / multiple_of) * multiple_of)
+    max_seq_length = min(max(max_seq_length, multiple_of), model_max_length)
+    logger.info(f"max_seq_length {max_seq_length}: {quantile:.1%} of the sentences have at most "
+                f"{np.quantile(lengths, quantile):.0f} tokens (median {np.median(lengths):.0f}, max {lengths.max()})")
+    return max_seq_length
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batches of pairs of similar token length: every epoch the pairs are shuffled, cut into buckets of
+    bucket_size pairs, sorted by the length of their longer sentence within the bucket and cut into batches,
+    and the batches are shuffled.
+    Batches have batch_size pairs or, with max_tokens, as many pairs as fit into max_tokens padded tokens
+    (both sentences of a pair are padded to the longest one of their side of the batch).
+    Counts real and padded tokens of the yielded batches for report().
+    """
+    def __init__(self, lengths_a, lengths_b, batch_size: int = None, max_tokens: int = None, bucket_size: int = None,
+                 shuffle: bool = True, seed: int = 0):
+        if batch_size is None and max_tokens is None:
+            raise ValueError("Either batch_size or max_tokens is needed")
+        self.lengths_a = np.asarray(lengths_a, dtype=np.int64)
+        self.lengths_b = np.asarray(lengths_b, dtype=np.int64)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        pairs_per_batch = batch_size or max(1, max_tokens // max(1, int(np.mean(self.lengths_a + self.lengths_b))))
+        self.bucket_size = bucket_size or 100 * pairs_per_batch
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.plan = None
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def get_batches(self, epoch: int):
+        if self.plan is not None and self.plan[0] == epoch:
+            return self.plan[1]
+        rng = np.random.default_rng([self.seed, epoch])
+        n = len(self.lengths_a)
+        order = rng.permutation(n) if self.shuffle else np.arange(n)
+        # the longer sentence of the pair: sorting by it leaves less padding on both sides than the sum
+        pair_lengths = np.maximum(self.lengths_a, self.lengths_b)
+        batches = []
+        for start in range(0, n, self.bucket_size):
+            bucket = order[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(pair_lengths[bucket], kind="stable")]
+            if self.max_tokens is None:
+                batches.extend(np.split(bucket, np.arange(self.batch_size, len(bucket), self.batch_size)))
+            else:
+                batches.extend(self.token_budget_batches(bucket))
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        self.plan = (epoch, batches)
+        return batches
+
+    def token_budget_batches(self, bucket):
+        batches = []
+        start, max_a, max_b = 0, 0, 0
+        for i, (length_a, length_b) in enumerate(zip(self.lengths_a[bucket], self.lengths_b[bucket])):
+            max_a, max_b = max(max_a, length_a), max(max_b, length_b)
+            if (i + 1 - start) * (max_a + max_b) > self.max_tokens and i > start:
+                batches.append(bucket[start:i])
+                start, max_a, max_b = i, length_a, length_b
+        batches.append(bucket[start:])
+        return batches
+
+    def __iter__(self):
+        batches = self.get_batches(self.epoch)
+        self.epoch += 1
+        for batch in batches:
+            lengths_a, lengths_b = self.lengths_a[batch], self.lengths_b[batch]
+            self.real_tokens += int(lengths_a.sum() + lengths_b.sum())
+            self.padded_tokens += len(batch) * int(lengths_a.max() + lengths_b.max())
+            yield batch.tolist()
+
+    def __len__(self):
+        return len(self.get_batches(self.epoch))
+
+    @property
+    def padding_ratio(self):
+        return 1 - self.real_tokens / self.padded_tokens if self.padded_tokens else 0.0
+
+    def report(self, elapsed_sec: float = None):
+        report = {"real_tokens": self.real_tokens, "padded_tokens": self.padded_tokens,
+                  "padding_ratio": self.padding_ratio,
+                  "tokens_per_sec": self.real_tokens / elapsed_sec if elapsed_sec else None}
+        logger.info(f"Padding ratio: {report['padding_ratio']:.1%} of {self.padded_tokens} padded tokens"
+                    + (f", {report['tokens_per_sec']:.0f} tokens/sec" if elapsed_sec else ""))
+        return report
+
+
+def padding_ratio(batches, lengths_a, lengths_b):
+    """Share of padding tokens of the batches (lists of pair indices), e.g. of a plain shuffled DataLoader."""
+    lengths_a, lengths_b = np.asarray(lengths_a), np.asarray(lengths_b)
+    real, padded = 0, 0
+    for batch in batches:
+        real += lengths_a[batch].sum() + lengths_b[batch].sum()
+        padded += len(batch) * (lengths_a[batch].max() + lengths_b[batch].max())
+    return 1 - real / padded if padded else 0.0
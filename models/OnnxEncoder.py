@@ -0,0 +1,89 @@
+import logging
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch import nn
+
+try:
+    import onnxruntime
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    ONNX_AVAILABLE = True
+except ImportError:
+    ONNX_AVAILABLE = False
+
+
+logger = logging.getLogger(__name__)
+
+
+class SentenceEmbeddingGraph(nn.Module):
+    """Transformer + Pooling + Dense of a SentenceTransformer as a function of the token ids, for the export."""
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model({"input_ids": input_ids, "attention_mask": attention_mask})["sentence_embedding"]
+
+
+def get_onnx_path(model_dir, quantized: bool = True):
+    return Path(model_dir, "onnx", "encoder.int8.onnx" if quantized else "encoder.onnx")
+
+
+def export_encoder(model, model_dir, quantized: bool = True, opset_version: int = 14, forced: bool = False):
+    """
+    Exports the encoder of model to model_dir/onnx/encoder.onnx with dynamic batch and sequence axes and,
+    quantized, its dynamic int8 quantisation (int8 weights, activations quantised per batch) to encoder.int8.onnx.
+    """
+    if not ONNX_AVAILABLE:
+        raise ImportError("The onnx backends need onnx and onnxruntime: pip install onnx onnxruntime")
+    onnx_path = get_onnx_path(model_dir, quantized=False)
+    if not onnx_path.exists() or forced:
+        onnx_path.parent.mkdir(parents=True, exist_ok=True)
+        features = model.tokenize(["An example title", "Another, somewhat longer example title"])
+        graph = SentenceEmbeddingGraph(model).cpu().eval()
+        with torch.no_grad():
+            torch.onnx.export(graph, (features["input_ids"], features["attention_mask"]), str(onnx_path),
+                              input_names=["input_ids", "attention_mask"], output_names=["sentence_embedding"],
+                              dynamic_axes={"input_ids": {0: "batch", 1: "sequence"},
+                                            "attention_mask": {0: "batch", 1: "sequence"},
+                                            "sentence_embedding": {0: "batch"}},
+                              opset_version=opset_version)
+        logger.info(f"Exported the encoder to {onnx_path}")
+    if not quantized:
+        return onnx_path
+    int8_path = get_onnx_path(model_dir, quantized=True)
+    if not int8_path.exists() or forced:
+        quantize_dynamic(str(onnx_path), str(int8_path), weight_type=QuantType.QInt8)
+        logger.info(f"Quantised the encoder to {int8_path}")
+    return int8_path
+
+
+class OnnxEncoder(object):
+    """
+    Sentence embeddings from an exported encoder on the ONNX Runtime CPU provider. The tokenizer of the
+    SentenceTransformer is used; as in SentenceTransformer.encode, sentences are batched by length.
+    """
+    def __init__(self, onnx_path, model, num_threads: int = None):
+        if not ONNX_AVAILABLE:
+            raise ImportError("The onnx backends need onnx and onnxruntime: pip install onnx onnxruntime")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(str(onnx_path), options, providers=["CPUExecutionProvider"])
+        self.input_names = [graph_input.name for graph_input in self.session.get_inputs()]
+        self.model = model
+
+    def encode(self, sentences, batch_size: int = 512):
+        sentences = [str(sentence) for sentence in sentences]
+        order = np.argsort([-len(sentence) for sentence in sentences], kind="stable")
+        embeddings = []
+        for start in range(0, len(sentences), batch_size):
+            features = self.model.tokenize([sentences[i] for i in order[start:start + batch_size]])
+            inputs = {name: features[name].numpy().astype(np.int64) for name in self.input_names}
+            embeddings.append(self.session.run(["sentence_embedding"], inputs)[0])
+        if not embeddings:
+            return torch.zeros((0, self.model.get_sentence_embedding_dimension()))
+        embeddings = np.concatenate(embeddings)
+        return torch.from_numpy(embeddings[np.argsort(order)])
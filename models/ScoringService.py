@@ -0,0 +1,278 @@
+import argparse
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from CustomSentenceTransformer import BACKENDS, InferenceModel, to_unique_sentence_pairs
+
+
+logging.basicConfig(level=logging.NOTSET)
+logger = logging.getLogger(__name__)
+logging.getLogger().setLevel(logging.INFO)
+
+HTTP_STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class ServiceOverloaded(Exception):
+    pass
+
+
+class EmbeddingCache(object):
+    """LRU cache of sentence embeddings (CPU tensors) keyed by the sentence."""
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.embeddings = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, sentence):
+        embedding = self.embeddings.get(sentence)
+        if embedding is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.embeddings.move_to_end(sentence)
+        return embedding
+
+    def put(self, sentence, embedding):
+        if self.capacity <= 0:
+            return
+        self.embeddings[sentence] = embedding
+        self.embeddings.move_to_end(sentence)
+        while len(self.embeddings) > self.capacity:
+            self.embeddings.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0
+
+    def __len__(self):
+        return len(self.embeddings)
+
+
+class MicroBatcher(object):
+    """
+    Collects the pairs of concurrent requests for up to max_wait_ms or max_batch_pairs pairs and scores them
+    as one batch in a single worker thread, so the event loop keeps accepting requests meanwhile.
+    Requests are rejected with ServiceOverloaded while more than max_pending_pairs pairs are waiting.
+    """
+    def __init__(self, score, max_batch_pairs: int = 256, max_wait_ms: float = 5.0, max_pending_pairs: int = 8192):
+        self.score = score
+        self.max_batch_pairs = max_batch_pairs
+        self.max_wait_ms = max_wait_ms
+        self.max_pending_pairs = max_pending_pairs
+        self.pending_pairs = 0
+        self.queue = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.batch_sizes = deque(maxlen=10000)
+
+    async def submit(self, pairs):
+        if self.pending_pairs and self.pending_pairs + len(pairs) > self.max_pending_pairs:
+            raise ServiceOverloaded(f"{self.pending_pairs} pairs pending")
+        future = asyncio.get_running_loop().create_future()
+        self.pending_pairs += len(pairs)
+        self.queue.put_nowait((pairs, future))
+        return await future
+
+    async def collect_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        n_pairs = len(batch[0][0])
+        deadline = loop.time() + self.max_wait_ms / 1000
+        while n_pairs < self.max_batch_pairs:
+            if self.queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = self.queue.get_nowait()
+            batch.append(item)
+            n_pairs += len(item[0])
+        return batch, n_pairs
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        return asyncio.create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch, n_pairs = await self.collect_batch()
+            try:
+                labels, probabilities = await loop.run_in_executor(
+                    self.executor, self.score, [pair for pairs, _ in batch for pair in pairs])
+            except Exception as e:
+                logger.exception("Scoring failed")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                start = 0
+                for pairs, future in batch:
+                    if not future.done():
+                        future.set_result((labels[start:start + len(pairs)], probabilities[start:start + len(pairs)]))
+                    start += len(pairs)
+            finally:
+                self.pending_pairs -= n_pairs
+                self.batch_sizes.append(n_pairs)
+
+
+class ScoringService(object):
+    """
+    HTTP/1.1 service (keep-alive, JSON) around one InferenceModel:
+        POST /score {"pairs": [[sentence_a, sentence_b], ...]} -> {"labels": [...], "probabilities": [[...], ...]}
+        GET /stats: request, batch, cache and latency (p50/p90/p99 ms) statistics
+        GET /health
+    Overloaded, /score answers 503 with Retry-After.
+    """
+    def __init__(self, inference_model: InferenceModel, max_batch_pairs: int = 256, max_wait_ms: float = 5.0,
+                 max_pending_pairs: int = 8192, cache_size: int = 100000):
+        self.inference_model = inference_model
+        self.cache = EmbeddingCache(cache_size)
+        self.batcher = MicroBatcher(self.score, max_batch_pairs, max_wait_ms, max_pending_pairs)
+        self.latencies_ms = deque(maxlen=10000)
+        self.requests = 0
+        self.pairs = 0
+        self.rejected = 0
+
+    def embed(self, sentences):
+        """Embeddings of sentences, only those not in the cache are encoded."""
+        embeddings = [self.cache.get(sentence) for sentence in sentences]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            encoded = self.inference_model.encode([sentences[i] for i in missing]).cpu()
+            for i, embedding in zip(missing, encoded):
+                embeddings[i] = embedding
+                self.cache.put(sentences[i], embedding)
+        return torch.stack(embeddings)
+
+    def score(self, pairs):
+        sentences, pair_ids = to_unique_sentence_pairs(pairs)
+        with torch.no_grad():
+            probabilities = self.inference_model.pair_probabilities(self.embed(list(sentences)), pair_ids)
+        return self.inference_model.int2labels[probabilities.argmax(axis=1)], probabilities
+
+    def stats(self):
+        latencies = np.asarray(self.latencies_ms) if self.latencies_ms else np.zeros(1)
+        return {"requests": self.requests, "pairs": self.pairs, "rejected": self.rejected,
+                "pending_pairs": self.batcher.pending_pairs,
+                "batches": len(self.batcher.batch_sizes),
+                "mean_batch_pairs": float(np.mean(self.batcher.batch_sizes)) if self.batcher.batch_sizes else 0.0,
+                "cache_size": len(self.cache), "cache_hit_rate": self.cache.hit_rate,
+                "latency_ms": {f"p{q}": float(np.percentile(latencies, q)) for q in (50, 90, 99)}}
+
+    async def handle_score(self, body):
+        try:
+            pairs = json.loads(body)["pairs"]
+            if not all(isinstance(pair, list) and len(pair) == 2 and all(isinstance(s, str) for s in pair)
+                       for pair in pairs):
+                raise ValueError
+        except (ValueError, KeyError, TypeError):
+            return 400, {"error": 'expected {"pairs": [[sentence_a, sentence_b], ...]}'}
+        if len(pairs) > self.batcher.max_pending_pairs:
+            return 413, {"error": f"at most {self.batcher.max_pending_pairs} pairs per request"}
+        if not pairs:
+            return 200, {"labels": [], "probabilities": []}
+        start = time.perf_counter()
+        try:
+            labels, probabilities = await self.batcher.submit(pairs)
+        except ServiceOverloaded as e:
+            self.rejected += 1
+            return 503, {"error": str(e)}
+        self.latencies_ms.append((time.perf_counter() - start) * 1000)
+        self.requests += 1
+        self.pairs += len(pairs)
+        return 200, {"labels": labels.tolist(), "probabilities": probabilities.round(6).tolist()}
+
+    async def route(self, method, path, body):
+        if path == "/score":
+            return await self.handle_score(body) if method == "POST" else (405, {"error": "use POST"})
+        if path == "/stats":
+            return 200, self.stats()
+        if path == "/health":
+            return 200, {"status": "ok"}
+        return 404, {"error": f"{path} not found"}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                try:
+                    status, payload = await self.route(method, path.split("?")[0], body)
+                except Exception as e:
+                    status, payload = 500, {"error": str(e)}
+                content = json.dumps(payload).encode()
+                keep_alive = headers.get("connection", "").lower() != "close"
+                response_headers = [f"HTTP/1.1 {status} {HTTP_STATUS[status]}", "Content-Type: application/json",
+                                    f"Content-Length: {len(content)}",
+                                    f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+                if status == 503:
+                    response_headers.append("Retry-After: 1")
+                writer.write(("\r\n".join(response_headers) + "\r\n\r\n").encode() + content)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8080):
+        """Starts the batcher and the server, returns the server (port 0 binds a free port)."""
+        self.batcher_task = self.batcher.start()
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        logger.info(f"Scoring service on http://{host}:{server.sockets[0].getsockname()[1]}")
+        return server
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8080):
+        server = await self.start(host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def get_arg_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--model", required=True, help="trained model directory, e.g. ./outputs/v1/event_deduplication/disc")
+    parser.add_argument("--backend", default="torch", choices=BACKENDS)
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--max-batch-pairs", type=int, default=256)
+    parser.add_argument("--max-wait-ms", type=float, default=5.0)
+    parser.add_argument("--max-pending-pairs", type=int, default=8192)
+    parser.add_argument("--cache-size", type=int, default=100000, help="sentence embeddings kept, 0 disables the cache")
+    return parser
+
+
+def build_service(args):
+    inference_model = InferenceModel(args.model, device=args.device, write_predictions=False, backend=args.backend)
+    return ScoringService(inference_model, max_batch_pairs=args.max_batch_pairs, max_wait_ms=args.max_wait_ms,
+                          max_pending_pairs=args.max_pending_pairs, cache_size=args.cache_size)
+
+
+if __name__ == "__main__":
+    parser = get_arg_parser("Micro-batching HTTP scoring service for event pairs")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    asyncio.run(build_service(args).serve(args.host, args.port))
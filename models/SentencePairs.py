@@ -0,0 +1,168 @@
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+TABLE_COLUMNS = ["sentence", "event", "time", "url"]
+
+
+def save_strings(path, name, values):
+    """Strings as one UTF-8 buffer {name}.bin plus their int64 offsets {name}_offsets.npy."""
+    encoded = [str(value).encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(value) for value in encoded])
+    with open(Path(path, f"{name}.bin"), "wb") as f:
+        f.write(b"".join(encoded))
+    np.save(Path(path, f"{name}_offsets.npy"), offsets)
+
+
+class StringColumn(object):
+    """
+    A string column of a pair store, decoded lazily: an integer index decodes one string, an array or slice
+    index only the selected ones. The UTF-8 buffer and the offsets are memory-mapped. Interned columns have
+    {name}_ids.npy, the row -> string id mapping into the buffer of unique strings.
+    """
+    def __init__(self, path, name):
+        buffer_path = Path(path, f"{name}.bin")
+        # np.memmap cannot map empty files
+        self.buffer = (np.memmap(buffer_path, dtype=np.uint8, mode="r") if buffer_path.stat().st_size
+                       else np.zeros(0, dtype=np.uint8))
+        self.offsets = np.load(Path(path, f"{name}_offsets.npy"), mmap_mode="r")
+        ids_path = Path(path, f"{name}_ids.npy")
+        self.ids = np.load(ids_path, mmap_mode="r") if ids_path.exists() else None
+
+    def decode(self, string_id):
+        return self.buffer[self.offsets[string_id]:self.offsets[string_id + 1]].tobytes().decode("utf-8")
+
+    @property
+    def num_unique(self):
+        return len(self.offsets) - 1
+
+    def unique(self):
+        return np.array([self.decode(i) for i in range(self.num_unique)], dtype=object)
+
+    def __getitem__(self, idx):
+        if np.ndim(idx) == 0 and not isinstance(idx, slice):
+            return self.decode(int(self.ids[idx]) if self.ids is not None else int(idx))
+        string_ids = np.arange(len(self))[idx] if self.ids is None else np.asarray(self.ids[idx])
+        # pairs repeat their sentences, each selected string is decoded once
+        unique_ids, inverse = np.unique(string_ids, return_inverse=True)
+        return np.array([self.decode(i) for i in unique_ids], dtype=object)[inverse.ravel()]
+
+    def __array__(self, dtype=None, copy=None):
+        # the whole column: every unique string is decoded once
+        values = self.unique()
+        if self.ids is not None:
+            values = values[np.asarray(self.ids)]
+        return values if dtype is None else values.astype(dtype)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def __len__(self):
+        return len(self.ids) if self.ids is not None else self.num_unique
+
+
+def save_sentence_pairs(path, table, a, b, labels, label2int):
+    """
+    Writes sentence pairs as an interned table plus index arrays to the directory path:
+        - every corpus row used by a pair once (table with the columns of TABLE_COLUMNS); numeric columns as
+          .npy, strings interned: every distinct string once in a UTF-8 buffer with offsets, plus the int32
+          string id of every row,
+        - a.npy, b.npy: int32 table rows of the pairs, labels.npy: uint8 label ids, meta.json: label2int.
+    a and b are rows of table, only the rows used by pairs are kept.
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    used_rows, inverse = np.unique(np.concatenate([a, b]), return_inverse=True)
+    inverse = inverse.ravel().astype(np.int32)
+    table = table.iloc[used_rows]
+    numeric_cols = []
+    for col in TABLE_COLUMNS:
+        if pd.api.types.is_numeric_dtype(table[col]):
+            np.save(Path(path, f"{col}.npy"), table[col].values)
+            numeric_cols.append(col)
+        else:
+            string_ids, strings = pd.factorize(table[col].astype(str).values)
+            save_strings(path, col, strings)
+            np.save(Path(path, f"{col}_ids.npy"), string_ids.astype(np.int32))
+    np.save(Path(path, "a.npy"), inverse[:len(a)])
+    np.save(Path(path, "b.npy"), inverse[len(a):])
+    np.save(Path(path, "labels.npy"), np.asarray(labels, dtype=np.uint8))
+    with open(Path(path, "meta.json"), "w") as f:
+        json.dump({"label2int": label2int, "numeric_columns": numeric_cols, "table_size": len(used_rows)}, f)
+    return path
+
+
+class SentencePairs(object):
+    """
+    Sentence pairs written by save_sentence_pairs. The pair arrays are memory-mapped, the table columns are
+    opened when first used; strings are decoded on access (see StringColumn).
+    """
+    def __init__(self, path, mmap: bool = True):
+        self.path = Path(path)
+        with open(Path(self.path, "meta.json")) as f:
+            meta = json.load(f)
+        self.label2int = meta["label2int"]
+        self.numeric_columns = meta["numeric_columns"]
+        mmap_mode = "r" if mmap else None
+        self.a = np.load(Path(self.path, "a.npy"), mmap_mode=mmap_mode)
+        self.b = np.load(Path(self.path, "b.npy"), mmap_mode=mmap_mode)
+        self.labels = np.load(Path(self.path, "labels.npy"), mmap_mode=mmap_mode)
+        self.columns = {}
+
+    @staticmethod
+    def exists(path):
+        return Path(path, "meta.json").exists()
+
+    def column(self, name):
+        if name not in self.columns:
+            if name in self.numeric_columns:
+                self.columns[name] = np.load(Path(self.path, f"{name}.npy"))
+            else:
+                self.columns[name] = StringColumn(self.path, name)
+        return self.columns[name]
+
+    @property
+    def sentences(self):
+        return self.column("sentence")
+
+    @property
+    def sentence_fingerprint(self):
+        """Hash of the files of the sentence column, e.g. to match a TokenCache to this sentence table."""
+        digest = hashlib.sha1()
+        for name in ["sentence.bin", "sentence_offsets.npy", "sentence_ids.npy"]:
+            if Path(self.path, name).exists():
+                with open(Path(self.path, name), "rb") as f:
+                    for chunk in iter(lambda: f.read(1 << 24), b""):
+                        digest.update(chunk)
+        return digest.hexdigest()
+
+    @property
+    def num_unique_sentences(self):
+        sentences = self.sentences
+        return sentences.num_unique if sentences.ids is not None else len(np.unique(np.asarray(sentences)))
+
+    @property
+    def label_names(self):
+        int2label = {i: label for label, i in self.label2int.items()}
+        return np.array([int2label[i] for i in range(len(int2label))], dtype=object)[self.labels]
+
+    def to_frame(self):
+        """The pairs in the layout of the former pair CSVs."""
+        frame = {}
+        for side, rows in [("a", self.a), ("b", self.b)]:
+            for col in TABLE_COLUMNS:
+                frame[f"{col}_{side}"] = self.column(col)[rows]
+        frame["labels"] = self.label_names
+        return pd.DataFrame(frame)[["sentence_a", "event_a", "time_a", "labels", "sentence_b", "event_b", "time_b",
+                                    "url_a", "url_b"]]
+
+    def __getitem__(self, idx):
+        return (self.sentences[self.a[idx]], self.sentences[self.b[idx]]), int(self.labels[idx])
+
+    def __len__(self):
+        return len(self.labels)
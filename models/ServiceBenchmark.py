@@ -0,0 +1,92 @@
+import asyncio
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from ScoringService import build_service, get_arg_parser
+from SentencePairs import SentencePairs
+
+
+async def post_json(reader, writer, path, payload):
+    body = json.dumps(payload).encode()
+    writer.write(f"POST {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return status, json.loads(await reader.readexactly(int(headers["content-length"])))
+
+
+async def get_json(port, path):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return json.loads(response.split(b"\r\n\r\n", 1)[1])
+
+
+async def client(port, pairs, pairs_per_request, deadline, seed, latencies_ms, statuses):
+    """One keep-alive connection sending requests of random pairs back to back until the deadline."""
+    rng = np.random.default_rng(seed)
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        while time.perf_counter() < deadline:
+            request = [pairs[i] for i in rng.integers(0, len(pairs), pairs_per_request)]
+            start = time.perf_counter()
+            status, _ = await post_json(reader, writer, "/score", {"pairs": request})
+            statuses.append(status)
+            if status == 200:
+                latencies_ms.append((time.perf_counter() - start) * 1000)
+            else:
+                await asyncio.sleep(0.01)
+    finally:
+        writer.close()
+
+
+async def run_load(service, pairs, concurrency: int, pairs_per_request: int, duration_sec: float):
+    server = await service.start("127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    latencies_ms, statuses = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(port, pairs, pairs_per_request, start + duration_sec, seed, latencies_ms, statuses)
+                           for seed in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    server_stats = await get_json(port, "/stats")
+    server.close()
+    await server.wait_closed()
+    service.batcher_task.cancel()
+    latencies_ms = np.asarray(latencies_ms) if latencies_ms else np.zeros(1)
+    return {"concurrency": concurrency, "pairs_per_request": pairs_per_request,
+            "requests_per_sec": statuses.count(200) / elapsed,
+            "pairs_per_sec": statuses.count(200) * pairs_per_request / elapsed,
+            "rejected": len(statuses) - statuses.count(200),
+            "p50_ms": np.percentile(latencies_ms, 50), "p90_ms": np.percentile(latencies_ms, 90),
+            "p99_ms": np.percentile(latencies_ms, 99),
+            "mean_batch_pairs": server_stats["mean_batch_pairs"], "cache_hit_rate": server_stats["cache_hit_rate"]}
+
+
+if __name__ == "__main__":
+    parser = get_arg_parser("Localhost load benchmark of the scoring service: throughput and client latency percentiles")
+    parser.add_argument("--pairs", required=True, help="pair store, e.g. ./data/stormy_data/event_deduplication/test_v3_pairs")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32], help="concurrent clients per run")
+    parser.add_argument("--pairs-per-request", type=int, default=1)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds per run")
+    args = parser.parse_args()
+    sentence_pairs = SentencePairs(args.pairs)
+    sentences = sentence_pairs.sentences
+    pairs = [[str(sentences[a]), str(sentences[b])] for a, b in zip(sentence_pairs.a, sentence_pairs.b)]
+    results = []
+    for concurrency in args.concurrency:
+        # a fresh service per run: an empty cache and statistics of this run only
+        results.append(asyncio.run(run_load(build_service(args), pairs, concurrency, args.pairs_per_request,
+                                            args.duration)))
+    print(pd.DataFrame(results).to_string(index=False))
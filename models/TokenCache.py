@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import os
+import re
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenCache(object):
+    """
+    Token ids of every sentence of a sentence table, tokenised once:
+        input_ids.npy (int32, all sentences concatenated), offsets.npy (int64) and lengths.npy (int32).
+    The arrays are memory-mapped and re-opened after pickling, so DataLoader workers share the pages
+    instead of receiving copies.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        with open(Path(self.cache_dir, "meta.json")) as f:
+            meta = json.load(f)
+        self.pad_token_id = meta["pad_token_id"]
+        self.max_seq_length = meta["max_seq_length"]
+        self.arrays = None
+
+    @staticmethod
+    def get_cache_dir(root, tokenizer, max_seq_length: int):
+        name = re.sub(r"[^\w.-]+", "_", str(getattr(tokenizer, "name_or_path", type(tokenizer).__name__)))
+        return Path(root, f"tokens_{name}_{max_seq_length}")
+
+    @staticmethod
+    def get_fingerprint(sentences):
+        digest = hashlib.sha1()
+        for sentence in sentences:
+            digest.update(str(sentence).encode("utf-8") + b"\0")
+        return digest.hexdigest()
+
+    @staticmethod
+    def build(cache_dir, sentences, tokenizer, max_seq_length: int, batch_size: int = 10000, forced: bool = False,
+              fingerprint: str = None):
+        """
+        Tokenises sentences into cache_dir unless it already holds them. The cache is matched to the sentences
+        by fingerprint (default: a hash of the sentences), so a regenerated sentence table is tokenised again.
+        """
+        cache_dir = Path(cache_dir)
+        fingerprint = fingerprint or TokenCache.get_fingerprint(sentences)
+        meta_path = Path(cache_dir, "meta.json")
+        if meta_path.exists() and not forced:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta.get("fingerprint") == fingerprint and meta.get("num_sentences") == len(sentences):
+                return TokenCache(cache_dir)
+            logger.info(f"Sentence table of {cache_dir} changed, tokenising it again")
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        if meta_path.exists():
+            meta_path.unlink()
+        input_ids = []
+        for start in range(0, len(sentences), batch_size):
+            batch = [str(sentence) for sentence in sentences[start:start + batch_size]]
+            input_ids.extend(tokenizer(batch, truncation=True, max_length=max_seq_length)["input_ids"])
+        lengths = np.fromiter(map(len, input_ids), dtype=np.int32, count=len(input_ids))
+        offsets = np.zeros(len(lengths), dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)[:-1]
+        arrays = {"input_ids": np.fromiter((token for ids in input_ids for token in ids), dtype=np.int32,
+                                           count=lengths.sum()),
+                  "offsets": offsets, "lengths": lengths}
+        for name, array in arrays.items():
+            # replaced, not truncated: caches still open elsewhere keep their memory-mapped files
+            tmp_path = Path(cache_dir, f"{name}.npy.tmp")
+            with open(tmp_path, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp_path, Path(cache_dir, f"{name}.npy"))
+        # written last, a cache without meta.json is incomplete
+        with open(meta_path, "w") as f:
+            json.dump({"pad_token_id": tokenizer.pad_token_id, "max_seq_length": max_seq_length,
+                       "num_sentences": len(lengths), "num_tokens": int(lengths.sum()),
+                       "fingerprint": fingerprint}, f)
+        logger.info(f"Tokenised {len(lengths)} sentences ({lengths.sum()} tokens) into {cache_dir}")
+        return TokenCache(cache_dir)
+
+    def open(self):
+        if self.arrays is None:
+            self.arrays = {name: np.load(Path(self.cache_dir, f"{name}.npy"), mmap_mode="r")
+                           for name in ["input_ids", "offsets", "lengths"]}
+        return self.arrays
+
+    @property
+    def lengths(self):
+        return self.open()["lengths"]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["arrays"] = None
+        return state
+
+    def pad(self, rows):
+        """Features of the sentences rows (input_ids, attention_mask) padded to the longest of them."""
+        arrays = self.open()
+        rows = np.asarray(rows)
+        lengths = arrays["lengths"][rows].astype(np.int64)
+        width = int(lengths.max()) if len(rows) else 0
+        positions = np.arange(width)
+        mask = positions[None, :] < lengths[:, None]
+        token_positions = np.minimum(arrays["offsets"][rows][:, None] + positions[None, :], len(arrays["input_ids"]) - 1)
+        input_ids = np.where(mask, arrays["input_ids"][token_positions], self.pad_token_id)
+        return {"input_ids": torch.from_numpy(input_ids.astype(np.int64)),
+                "attention_mask": torch.from_numpy(mask.astype(np.int64))}
+
+
+class TokenPairDataset(Dataset):
+    """Sentence table rows and label of every pair of a SentencePairs, the sentences come from a TokenCache."""
+    def __init__(self, pairs):
+        self.a = pairs.a
+        self.b = pairs.b
+        self.labels = pairs.labels
+
+    def __getitem__(self, idx):
+        return int(self.a[idx]), int(self.b[idx]), int(self.labels[idx])
+
+    def __getitems__(self, indices):
+        # whole batches are fetched with one fancy index (torch >= 2.0)
+        indices = np.asarray(indices)
+        return np.stack([self.a[indices], self.b[indices], self.labels[indices]], axis=1).astype(np.int64)
+
+    def __len__(self):
+        return len(self.labels)
+
+
+class TokenPairCollator(object):
+    """Collates (row_a, row_b, label) items into the (features, labels) batches of smart_batching_collate."""
+    def __init__(self, token_cache: TokenCache):
+        self.token_cache = token_cache
+
+    def __call__(self, batch):
+        rows = np.asarray(batch, dtype=np.int64).reshape(-1, 3)
+        features = [self.token_cache.pad(rows[:, 0]), self.token_cache.pad(rows[:, 1])]
+        return features, torch.from_numpy(rows[:, 2])
+
+
+class PretokenizedDataLoader(DataLoader):
+    """
+    DataLoader over a TokenPairDataset which keeps its TokenPairCollator: SentenceTransformer.fit and the
+    evaluators set collate_fn to smart_batching_collate, which would tokenise the strings again.
+    """
+    def __init__(self, dataset: TokenPairDataset, token_cache: TokenCache, **kwargs):
+        super().__init__(dataset, collate_fn=TokenPairCollator(token_cache), **kwargs)
+
+    def __setattr__(self, name, value):
+        if name == "collate_fn" and isinstance(getattr(self, "collate_fn", None), TokenPairCollator):
+            return
+        super().__setattr__(name, value)
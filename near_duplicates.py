@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+
+BUCKET_KEY_PRIME = 1099511628211
+
+
+def normalize_titles(titles, min_length: int = 5):
+    """
+    Comparison form of the titles: lower case, punctuation removed, whitespace collapsed and
+    right-padded to min_length, so that every title has at least one shingle.
+    """
+    titles = pd.Series(titles, dtype=object).fillna("").astype(str)
+    titles = titles.str.lower().str.replace(r"[\W_]+", " ", regex=True).str.strip()
+    return titles.str.pad(min_length, side="right")
+
+
+def title_shingles(normalized_titles, k: int = 5):
+    """
+    Character k-grams (k <= 8) of all titles, each packed exactly into an uint64.
+    Returns the shingles of all titles concatenated and the number of shingles of every title.
+    """
+    encoded = [title.encode("utf-8") for title in normalized_titles]
+    lengths = np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded))
+    buffer = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    n_grams = len(buffer) - k + 1
+    codes = np.zeros(max(n_grams, 0), dtype=np.uint64)
+    for j in range(k):
+        codes |= buffer[j:j + n_grams].astype(np.uint64) << np.uint64(8 * j)
+
+    # only k-grams starting and ending inside the same title
+    counts = np.maximum(lengths - k + 1, 0)
+    title_starts = np.cumsum(lengths) - lengths
+    gram_offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return codes[np.repeat(title_starts, counts) + gram_offsets], counts
+
+
+def minhash_signatures(shingles, counts, num_perm: int = 64, seed: int = 0):
+    """
+    MinHash signature (num_perm uint32 values) of every title, from the output of title_shingles.
+    The i-th hash function is the multiply-shift hash (a_i * x + b_i) >> 32 over uint64.
+    """
+    rng = np.random.default_rng(seed)
+    multipliers = rng.integers(1, 2 ** 63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    increments = rng.integers(0, 2 ** 63, size=num_perm, dtype=np.uint64)
+    signatures = np.full((len(counts), num_perm), np.iinfo(np.uint32).max, dtype=np.uint32)
+    has_shingles = counts > 0
+    segment_starts = (np.cumsum(counts) - counts)[has_shingles]
+    for i in range(num_perm):
+        hashes = ((multipliers[i] * shingles + increments[i]) >> np.uint64(32)).astype(np.uint32)
+        signatures[has_shingles, i] = np.minimum.reduceat(hashes, segment_starts)
+    return signatures
+
+
+def lsh_near_duplicate_groups(signatures, threshold: float = 0.8, bands: int = 16):
+    """
+    Groups titles whose estimated Jaccard similarity is at least threshold.
+    Signatures are split into bands; titles with an identical band are candidates, every candidate is
+    compared with the first title of its bucket and linked to it if their signatures agree on at least
+    threshold of the hash functions. Groups are the connected components of these links.
+    Returns the group id of every title.
+    """
+    n, num_perm = signatures.shape
+    rows_per_band = num_perm // bands
+    sources, targets = [], []
+    for band in range(bands):
+        # bucket key of the band, bucket collisions are filtered out by the signature agreement below
+        bucket_keys = np.zeros(n, dtype=np.uint64)
+        for column in range(band * rows_per_band, (band + 1) * rows_per_band):
+            bucket_keys = bucket_keys * np.uint64(BUCKET_KEY_PRIME) + signatures[:, column]
+        _, first, buckets = np.unique(bucket_keys, return_index=True, return_inverse=True)
+        leaders = first[buckets.ravel()]
+        candidates = np.nonzero(leaders != np.arange(n))[0]
+        agreement = (signatures[candidates] == signatures[leaders[candidates]]).mean(axis=1)
+        linked = candidates[agreement >= threshold]
+        sources.append(linked)
+        targets.append(leaders[linked])
+    sources, targets = np.concatenate(sources), np.concatenate(targets)
+    links = sparse.csr_matrix((np.ones(len(sources), dtype=np.int8), (sources, targets)), shape=(n, n))
+    _, groups = connected_components(links, directed=False)
+    return groups.astype(np.int32)
+
+
+def near_duplicate_groups(titles, threshold: float = 0.8, num_perm: int = 64, bands: int = 16, k: int = 5):
+    """
+    Near-duplicate group id of every title. Titles without any word character (empty, whitespace or
+    punctuation only) would all share the padding shingle, each of them is a group of its own.
+    """
+    normalized = normalize_titles(titles, min_length=k)
+    blank = (normalized.str.strip() == "").values
+    groups = np.zeros(len(normalized), dtype=np.int32)
+    shingles, counts = title_shingles(normalized[~blank], k=k)
+    groups[~blank] = lsh_near_duplicate_groups(minhash_signatures(shingles, counts, num_perm=num_perm),
+                                               threshold=threshold, bands=bands)
+    groups[blank] = groups[~blank].max(initial=-1) + 1 + np.arange(blank.sum())
+    return groups
+
+
+def collapse_near_duplicates(df, group_col: str = "duplicate_group"):
+    """
+    One representative row per group (the last one, like drop_duplicates(keep="last")) with the
+    number of titles it stands for in the multiplicity column.
+    """
+    groups = df[group_col].values
+    representatives = pd.Series(np.arange(len(df))).groupby(groups).max().values
+    collapsed = df.iloc[representatives].reset_index(drop=True)
+    collapsed["multiplicity"] = np.bincount(groups)[collapsed[group_col].values]
+    return collapsed
+
+
+def expand_near_duplicates(representatives, members, group_col: str = "duplicate_group", derived_cols=()):
+    """
+    Maps the columns added to the representatives (annotations, clusters) and the derived_cols, which the
+    members may already have but the pipeline recomputed on the representatives (e.g. cluster_50_70),
+    back to all members of their groups. Members of groups whose representative was removed are dropped.
+    """
+    copied_cols = [col for col in representatives.columns
+                   if col != group_col and (col not in members.columns or col in derived_cols)]
+    expanded = members.drop(columns=[col for col in copied_cols if col in members.columns]) \
+        .merge(representatives[[group_col] + copied_cols], on=group_col, how="inner")
+    return expanded[list(members.columns) + [col for col in copied_cols if col not in members.columns]]
@@ -0,0 +1,121 @@
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    from pyinstrument import Profiler as PyinstrumentProfiler
+    PYINSTRUMENT_AVAILABLE = True
+except ImportError:
+    PYINSTRUMENT_AVAILABLE = False
+
+
+# off if unset, otherwise "json" (report only), "cprofile" or "pyinstrument" (report and one dump per stage)
+PROFILE_ENV = "SILVER_LABEL_PROFILE"
+PROFILE_DIR_ENV = "SILVER_LABEL_PROFILE_DIR"
+
+
+def peak_rss_mb():
+    # ru_maxrss is the high-water mark of the process, in KB on linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 2 ** 20 if sys.platform == "darwin" else peak_rss / 2 ** 10
+
+
+class StageProfiler(object):
+    """
+    Records wall time, CPU time, peak RSS, rows in/out and throughput of named stages and writes
+    them as a JSON report. Configured from the environment, so profiling needs no code edits:
+        SILVER_LABEL_PROFILE=json|cprofile|pyinstrument  SILVER_LABEL_PROFILE_DIR=./data/gdelt_crawled/profiles
+    When disabled, stage() only hands out a record and measures nothing.
+    """
+    def __init__(self, mode: str = None, profile_dir=None):
+        self.mode = (mode if mode is not None else os.environ.get(PROFILE_ENV, "")).lower()
+        if self.mode in ["1", "true"]:
+            self.mode = "json"
+        if self.mode not in ["", "json", "cprofile", "pyinstrument"]:
+            raise ValueError(f"{self.mode} not defined! Please choose from 'json', 'cprofile' or 'pyinstrument'")
+        if self.mode == "pyinstrument" and not PYINSTRUMENT_AVAILABLE:
+            print("pyinstrument is not installed, falling back to cProfile")
+            self.mode = "cprofile"
+        self.profile_dir = Path(os.environ.get(PROFILE_DIR_ENV) or profile_dir or "./data/gdelt_crawled/profiles")
+        self.records = []
+
+    def reset(self):
+        self.records = []
+
+    @property
+    def enabled(self):
+        return self.mode != ""
+
+    @contextmanager
+    def stage(self, name: str, rows_in: int = None, dump: bool = True):
+        """
+        Set record["rows_out"] inside the block; the timings are added when it exits.
+        Steps nested in a profiled stage should pass dump=False, only one profiler can be active at a time.
+        """
+        record = {"stage": name, "rows_in": rows_in, "rows_out": None}
+        if not self.enabled:
+            yield record
+            return
+
+        profiler = self.start_profiler() if dump else None
+        rss_before = peak_rss_mb()
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["wall_time_sec"] = time.perf_counter() - wall_start
+            record["cpu_time_sec"] = time.process_time() - cpu_start
+            record["peak_rss_mb"] = peak_rss_mb()
+            record["peak_rss_increase_mb"] = record["peak_rss_mb"] - rss_before
+            record["rows_per_sec"] = rows_in / record["wall_time_sec"] if rows_in and record["wall_time_sec"] > 0 else None
+            self.stop_profiler(profiler, name)
+            self.records.append(record)
+
+    def add(self, name: str, **fields):
+        """Records a stage which was not run, e.g. one loaded from the stage cache."""
+        if self.enabled:
+            self.records.append({"stage": name, **fields})
+
+    def start_profiler(self):
+        if self.mode == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+            return profiler
+        elif self.mode == "pyinstrument":
+            profiler = PyinstrumentProfiler()
+            profiler.start()
+            return profiler
+        return None
+
+    def stop_profiler(self, profiler, name):
+        if profiler is None:
+            return
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        file_name = name.replace("/", "__")
+        if self.mode == "cprofile":
+            profiler.disable()
+            profiler.dump_stats(Path(self.profile_dir, f"{file_name}.prof"))
+        else:
+            profiler.stop()
+            with open(Path(self.profile_dir, f"{file_name}.html"), "w") as f:
+                f.write(profiler.output_html())
+
+    def write_report(self, file_name: str = "stage_report.json"):
+        if not self.enabled:
+            return None
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        report_path = Path(self.profile_dir, file_name)
+        with open(report_path, "w") as f:
+            json.dump({"mode": self.mode, "peak_rss_mb": peak_rss_mb(), "stages": self.records}, f, indent=2)
+        for record in self.records:
+            if "wall_time_sec" in record:
+                print(f"    {record['stage']:<40} {record['wall_time_sec']:>9.2f}s wall {record['cpu_time_sec']:>9.2f}s cpu "
+                      f"{record['peak_rss_mb']:>9.0f} MB peak rss  {record['rows_in']} -> {record['rows_out']} rows")
+        print(f"Stage report written to {report_path}")
+        return report_path
@@ -0,0 +1,202 @@
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from clustering import NO_CLUSTER, community_labels, merge_connected_clusters
+from similarity import blas_thread_limit, community_detection, date_proximity_kernel, normalize_embeddings
+
+
+def time_shards(days, window_days: float = 30, overlap_days: float = 7):
+    """
+    Overlapping time windows [start, start + window_days + overlap_days) every window_days days.
+    Every title is in the window of its date (its home shard) and, if it falls into the overlap, also
+    in the previous one, so every event shorter than overlap_days lies completely inside one shard.
+    Returns the row indices of every shard and the home shard of every row.
+    """
+    days = np.asarray(days, dtype=np.float64)
+    offsets = days - days.min()
+    home_shard = (offsets // window_days).astype(np.int64)
+    shard_rows = []
+    for shard in range(home_shard.max() + 1):
+        start = shard * window_days
+        shard_rows.append(np.nonzero((offsets >= start) & (offsets < start + window_days + overlap_days))[0])
+    return shard_rows, home_shard
+
+
+def cluster_shard(embeddings, days, weights, clustering_params: list, block_size: int = 2048,
+                  date_weight: float = 0.1, date_scale: float = 7.0, top_k: int = None):
+    """
+    Runs community detection for every parameter set on one shard.
+    clustering_params lists dicts with name, min_community_size, threshold and temporal (mix in the
+    date proximity as in EventDeduplicationDataFrame.cluster_titles).
+    Returns the shard-local int32 cluster ids of every parameter set.
+    """
+    temporal_kernel = date_proximity_kernel(days, date_weight=date_weight, date_scale=date_scale)
+    labels = {}
+    for params in clustering_params:
+        # one thread per shard, the shards themselves run in parallel
+        communities = community_detection(embeddings,
+                                          threshold=params["threshold"],
+                                          min_community_size=params["min_community_size"],
+                                          block_size=block_size,
+                                          n_jobs=1,
+                                          pairwise_kernel=temporal_kernel if params["temporal"] else None,
+                                          weights=weights,
+                                          top_k=top_k)
+        labels[params["name"]] = community_labels(len(embeddings), communities)
+    return labels
+
+
+def limit_blas_threads(n_threads: int):
+    # pool initializer: the shard processes share the cores instead of each using all of them through BLAS
+    blas_thread_limit(n_threads)
+
+
+def run_shard_file(shard_path):
+    """Clusters a shard written by ShardedClusterer.write_shards and stores the labels next to it."""
+    shard_path = Path(shard_path)
+    with open(shard_path.with_suffix(".json")) as f:
+        config = json.load(f)
+    shard = np.load(shard_path)
+    labels = cluster_shard(shard["embeddings"], shard["days"], shard["weights"], config["clustering_params"],
+                           block_size=config["block_size"], date_weight=config["date_weight"],
+                           date_scale=config["date_scale"], top_k=config.get("top_k"))
+    result_path = shard_path.with_name(shard_path.stem + "_labels.npz")
+    np.savez(result_path, **labels)
+    return result_path
+
+
+def stitch_shards(shard_rows, shard_labels, home_shard, embeddings, overlap_rows, stitch_threshold: float):
+    """
+    Joins the shard-local clusters into global ones: clusters of neighbouring shards which both have
+    members in the overlap between them are linked if their centroids have a cosine similarity of at least
+    stitch_threshold, linked clusters are merged (union-find). Every row takes the cluster of its home
+    shard, or the one of the other shard containing it if it is in no cluster there.
+    Returns int32 global cluster ids (largest cluster first) with NO_CLUSTER for rows in no cluster.
+    """
+    n = len(home_shard)
+    # global ids of the shard-local clusters
+    offsets = np.cumsum([0] + [labels.max() + 1 if len(labels) else 0 for labels in shard_labels])
+    centroids = np.zeros((offsets[-1], embeddings.shape[1]), dtype=np.float32)
+    for shard, (rows, labels) in enumerate(zip(shard_rows, shard_labels)):
+        clustered = labels != NO_CLUSTER
+        np.add.at(centroids, offsets[shard] + labels[clustered], embeddings[rows[clustered]].astype(np.float32))
+    centroids = normalize_embeddings(centroids)
+
+    edges_a, edges_b = [], []
+    for shard in range(len(shard_rows) - 1):
+        boundary = overlap_rows[shard]
+        left = shard_labels[shard][np.searchsorted(shard_rows[shard], boundary)]
+        right = shard_labels[shard + 1][np.searchsorted(shard_rows[shard + 1], boundary)]
+        left = np.unique(left[left != NO_CLUSTER]) + offsets[shard]
+        right = np.unique(right[right != NO_CLUSTER]) + offsets[shard + 1]
+        if len(left) == 0 or len(right) == 0:
+            continue
+        a, b = np.nonzero(centroids[left] @ centroids[right].T >= stitch_threshold)
+        edges_a.append(left[a])
+        edges_b.append(right[b])
+    edges_a = np.concatenate(edges_a) if edges_a else np.empty(0, dtype=np.int64)
+    edges_b = np.concatenate(edges_b) if edges_b else np.empty(0, dtype=np.int64)
+    components = merge_connected_clusters(np.arange(offsets[-1]), edges_a, edges_b).astype(np.int64)
+
+    global_labels = np.full(n, NO_CLUSTER, dtype=np.int64)
+    from_home = np.zeros(n, dtype=bool)
+    for shard, (rows, labels) in enumerate(zip(shard_rows, shard_labels)):
+        clustered = labels != NO_CLUSTER
+        is_home = home_shard[rows] == shard
+        # home shard labels win, other shards only fill rows which are in no cluster yet
+        take = clustered & (is_home | ((global_labels[rows] == NO_CLUSTER) & ~from_home[rows]))
+        global_labels[rows[take]] = components[offsets[shard] + labels[take]]
+        from_home[rows[take & is_home]] = True
+
+    # renumber as community_detection does: 0 for the largest cluster
+    clustered = global_labels != NO_CLUSTER
+    cluster_ids, inverse, sizes = np.unique(global_labels[clustered], return_inverse=True, return_counts=True)
+    rank = np.empty(len(cluster_ids), dtype=np.int32)
+    rank[np.argsort(-sizes, kind="stable")] = np.arange(len(cluster_ids), dtype=np.int32)
+    labels = np.full(n, NO_CLUSTER, dtype=np.int32)
+    labels[clustered] = rank[inverse.ravel()]
+    return labels
+
+
+class ShardedClusterer(object):
+    """
+    Community detection on overlapping time windows of the corpus, run in a process pool (or on several
+    nodes sharing shard_dir: write_shards, then `python sharded_clustering.py --shard <shard.npz>` per shard,
+    then collect), with the clusters straddling window boundaries stitched by centroid similarity.
+    The quadratic similarity search only runs within shards, so the cost grows linearly with the time span.
+    """
+    def __init__(self, shard_dir, window_days: float = 30, overlap_days: float = 7, n_jobs: int = None,
+                 block_size: int = 2048, date_weight: float = 0.1, date_scale: float = 7.0, top_k: int = None):
+        self.shard_dir = Path(shard_dir)
+        self.window_days = window_days
+        self.overlap_days = overlap_days
+        self.n_jobs = n_jobs or os.cpu_count() or 1
+        self.block_size = block_size
+        self.date_weight = date_weight
+        self.date_scale = date_scale
+        self.top_k = top_k
+
+    def write_shards(self, embeddings, days, clustering_params: list, weights=None):
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        for stale_path in self.shard_dir.glob("shard_?????*"):
+            stale_path.unlink()
+        weights = np.ones(len(days), dtype=np.int64) if weights is None else np.asarray(weights)
+        shard_rows, home_shard = time_shards(days, self.window_days, self.overlap_days)
+        shard_paths = []
+        for shard, rows in enumerate(shard_rows):
+            shard_path = Path(self.shard_dir, f"shard_{shard:05d}.npz")
+            np.savez(shard_path, rows=rows, embeddings=embeddings[rows], days=np.asarray(days)[rows],
+                     weights=weights[rows])
+            with open(shard_path.with_suffix(".json"), "w") as f:
+                json.dump({"clustering_params": clustering_params, "block_size": self.block_size,
+                           "date_weight": self.date_weight, "date_scale": self.date_scale, "top_k": self.top_k}, f)
+            shard_paths.append(shard_path)
+        np.save(Path(self.shard_dir, "home_shard.npy"), home_shard)
+        print(f"Wrote {len(shard_paths)} shards of {self.window_days} (+{self.overlap_days}) days "
+              f"with {np.mean([len(rows) for rows in shard_rows]):.0f} titles on average to {self.shard_dir}")
+        return shard_paths
+
+    def run_shards(self, shard_paths):
+        # largest shards first, to keep the pool busy until the end
+        shard_paths = sorted(shard_paths, key=lambda path: -path.stat().st_size)
+        if self.n_jobs == 1:
+            return [run_shard_file(path) for path in shard_paths]
+        with ProcessPoolExecutor(max_workers=self.n_jobs, initializer=limit_blas_threads,
+                                 initargs=(max(1, (os.cpu_count() or 1) // self.n_jobs),)) as executor:
+            return list(executor.map(run_shard_file, shard_paths))
+
+    def collect(self, embeddings, days, clustering_params: list):
+        shard_paths = sorted(self.shard_dir.glob("shard_?????.npz"))
+        home_shard = np.load(Path(self.shard_dir, "home_shard.npy"))
+        shard_rows = [np.load(path)["rows"] for path in shard_paths]
+        offsets = np.asarray(days, dtype=np.float64) - np.min(days)
+        # rows in the overlap between shard k and k + 1 (their home shard is k + 1)
+        overlap_rows = [rows[(home_shard[rows] == shard + 1) &
+                             (offsets[rows] < (shard + 1) * self.window_days + self.overlap_days)]
+                        for shard, rows in enumerate(shard_rows[:-1])]
+        shard_results = [np.load(path.with_name(path.stem + "_labels.npz")) for path in shard_paths]
+        labels = {}
+        for params in clustering_params:
+            labels[params["name"]] = stitch_shards(shard_rows, [result[params["name"]] for result in shard_results],
+                                                   home_shard, embeddings, overlap_rows,
+                                                   stitch_threshold=params["threshold"])
+        return labels
+
+    def fit(self, embeddings, days, clustering_params: list, weights=None):
+        """Returns int32 cluster ids (NO_CLUSTER for rows in no cluster) for every parameter set."""
+        shard_paths = self.write_shards(embeddings, days, clustering_params, weights=weights)
+        self.run_shards(shard_paths)
+        return self.collect(embeddings, days, clustering_params)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Clusters one shard written by ShardedClusterer.write_shards")
+    parser.add_argument("--shard", nargs="+", required=True, help="shard_*.npz files to cluster")
+    args = parser.parse_args()
+    for path in args.shard:
+        print(f"Labels written to {run_shard_file(path)}")
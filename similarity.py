@@ -0,0 +1,211 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import numpy as np
+from scipy import sparse
+
+try:
+    from threadpoolctl import threadpool_limits
+    THREADPOOLCTL_AVAILABLE = True
+except ImportError:
+    THREADPOOLCTL_AVAILABLE = False
+
+
+INT8_SCALE = 127.0
+
+
+def normalize_embeddings(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return embeddings / norms
+
+
+class Int8Embeddings(object):
+    """
+    int8 embeddings with one float32 scale per row, chosen such that every dequantized
+    row has unit norm again. Slicing returns dequantized float32 rows.
+    """
+    def __init__(self, embeddings):
+        row_max = np.abs(embeddings).max(axis=1, keepdims=True)
+        row_max[row_max == 0] = 1.0
+        self.values = np.round(embeddings / row_max * INT8_SCALE).astype(np.int8)
+        norms = np.linalg.norm(self.values.astype(np.float32), axis=1)
+        norms[norms == 0] = 1.0
+        self.scales = (1.0 / norms).astype(np.float32)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, item):
+        # int8 dot products are accumulated in float32, which is exact up to ~1000 dimensions
+        return self.values[item].astype(np.float32) * self.scales[item, None]
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.scales.nbytes
+
+
+def quantize_embeddings(embeddings, precision: str = "float16"):
+    """
+    L2-normalises the embeddings and stores them in a compact dtype.
+    float16 halves the memory of float32, int8 quarters it.
+    """
+    embeddings = normalize_embeddings(embeddings)
+    if precision == "float32":
+        return embeddings
+    elif precision == "float16":
+        return embeddings.astype(np.float16)
+    elif precision == "int8":
+        return Int8Embeddings(embeddings)
+    else:
+        raise ValueError(f"{precision} not defined! Please choose from 'float32', 'float16' or 'int8'")
+
+
+def dequantize_block(block):
+    return np.asarray(block).astype(np.float32, copy=False)
+
+
+def blas_thread_limit(n_threads: int):
+    """Limits the BLAS threads of the process while in the context (no-op without threadpoolctl)."""
+    return threadpool_limits(limits=n_threads, user_api="blas") if THREADPOOLCTL_AVAILABLE else nullcontext()
+
+
+def blocked_cosine_topk(embeddings,
+                        threshold: float,
+                        top_k: int = None,
+                        block_size: int = 2048,
+                        n_jobs: int = 1,
+                        pairwise_kernel=None):
+    """
+    Computes all cosine similarities >= threshold of a set of normalised (and possibly
+    quantized) embeddings with itself, block by block.
+    Only a block_size x block_size tile of scores exists at any time; per tile the entries
+    above the threshold are streamed into a sparse result, keeping at most top_k per row.
+    The matrix products already use all cores through BLAS. With n_jobs > 1, row blocks are processed in
+    n_jobs threads as well (numpy releases the GIL inside the matrix products, the thresholding then runs in
+    parallel too) and BLAS is limited to cpu_count // n_jobs threads meanwhile, so the cores are not
+    oversubscribed (the limit needs threadpoolctl).
+
+    pairwise_kernel(row_indices, col_indices, scores) may modify the scores of a tile in place
+    before thresholding, e.g. to mix in a date-proximity term.
+
+    Returns a scipy.sparse.csr_matrix of shape (n, n) with float32 similarities.
+    """
+    n = len(embeddings)
+    n_jobs = n_jobs or 1
+    row_starts = list(range(0, n, block_size))
+
+    def process_row_block(row_start):
+        row_end = min(row_start + block_size, n)
+        rows = dequantize_block(embeddings[row_start:row_end])
+        row_indices = np.arange(row_start, row_end)
+        block_rows, block_cols, block_scores = [], [], []
+        for col_start in range(0, n, block_size):
+            col_end = min(col_start + block_size, n)
+            scores = rows @ dequantize_block(embeddings[col_start:col_end]).T
+            if pairwise_kernel is not None:
+                pairwise_kernel(row_indices, np.arange(col_start, col_end), scores)
+            r, c = np.nonzero(scores >= threshold)
+            block_rows.append(r + row_start)
+            block_cols.append(c + col_start)
+            block_scores.append(scores[r, c])
+            del scores
+        block_rows = np.concatenate(block_rows)
+        block_cols = np.concatenate(block_cols)
+        block_scores = np.concatenate(block_scores).astype(np.float32)
+        if top_k is not None and len(block_rows):
+            block_rows, block_cols, block_scores = keep_top_k_per_row(block_rows, block_cols, block_scores, top_k)
+        return block_rows, block_cols, block_scores
+
+    if n_jobs == 1:
+        results = [process_row_block(row_start) for row_start in row_starts]
+    else:
+        blas_threads = max(1, (os.cpu_count() or 1) // n_jobs)
+        with blas_thread_limit(blas_threads), ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(process_row_block, row_starts))
+
+    rows = np.concatenate([r for r, _, _ in results]) if results else np.empty(0, dtype=np.int64)
+    cols = np.concatenate([c for _, c, _ in results]) if results else np.empty(0, dtype=np.int64)
+    scores = np.concatenate([s for _, _, s in results]) if results else np.empty(0, dtype=np.float32)
+    return sparse.csr_matrix((scores, (rows, cols)), shape=(n, n))
+
+
+def keep_top_k_per_row(rows, cols, scores, top_k):
+    order = np.lexsort((-scores, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    row_starts = np.searchsorted(rows, rows, side="left")
+    rank = np.arange(len(rows)) - row_starts
+    keep = rank < top_k
+    return rows[keep], cols[keep], scores[keep]
+
+
+def community_detection(embeddings,
+                        threshold: float = 0.75,
+                        min_community_size: int = 10,
+                        block_size: int = 2048,
+                        n_jobs: int = 1,
+                        similarities=None,
+                        pairwise_kernel=None,
+                        weights=None,
+                        top_k: int = None):
+    """
+    Same semantics as sentence_transformers.util.community_detection, but built on the
+    sparse output of blocked_cosine_topk instead of dense row blocks of torch scores.
+    Communities are returned as lists of row indices, largest first.
+
+    weights counts every row as that many rows (e.g. the multiplicity of collapsed near-duplicate
+    titles), community sizes are then the sums of the weights of their members.
+
+    top_k bounds the memory of the similarities to top_k entries per row. A community is then made of the
+    top_k nearest rows at most, rows of larger events end up in several communities or none; without
+    top_k (the default) the result is exact.
+    """
+    if top_k is not None and top_k < min_community_size:
+        raise ValueError(f"top_k ({top_k}) must be at least min_community_size ({min_community_size})")
+    if similarities is None:
+        similarities = blocked_cosine_topk(embeddings, threshold=threshold, top_k=top_k, block_size=block_size,
+                                           n_jobs=n_jobs, pairwise_kernel=pairwise_kernel)
+    n = similarities.shape[0]
+    weights = np.ones(n, dtype=np.int64) if weights is None else np.asarray(weights)
+    min_community_size = min(min_community_size, weights.sum())
+    neighbour_rows = np.repeat(np.arange(n), np.diff(similarities.indptr))
+    neighbour_counts = np.bincount(neighbour_rows, weights=weights[similarities.indices], minlength=n)
+
+    extracted_communities = []
+    for i in np.nonzero(neighbour_counts >= min_community_size)[0]:
+        start, end = similarities.indptr[i], similarities.indptr[i + 1]
+        extracted_communities.append(similarities.indices[start:end])
+    extracted_communities = sorted(extracted_communities, key=lambda x: weights[x].sum(), reverse=True)
+
+    unique_communities = []
+    extracted = np.zeros(n, dtype=bool)
+    for community in extracted_communities:
+        community = np.sort(community)
+        non_overlapped_community = community[~extracted[community]]
+        if weights[non_overlapped_community].sum() >= min_community_size:
+            unique_communities.append(non_overlapped_community.tolist())
+            extracted[non_overlapped_community] = True
+    unique_communities = sorted(unique_communities, key=lambda x: weights[x].sum(), reverse=True)
+    return unique_communities
+
+
+def to_day_ordinals(dates):
+    return np.asarray(dates, dtype="datetime64[D]").astype(np.int64)
+
+
+def date_proximity_kernel(day_ordinals, date_weight: float = 0.1, date_scale: float = 7.0):
+    """
+    Returns a pairwise_kernel for blocked_cosine_topk which mixes the title similarity of a
+    tile with the publication-date proximity exp(-|day_i - day_j| / date_scale):
+        score = (1 - date_weight) * title_similarity + date_weight * date_proximity
+    """
+    day_ordinals = np.asarray(day_ordinals, dtype=np.float32)
+
+    def kernel(row_indices, col_indices, scores):
+        day_difference = np.abs(day_ordinals[row_indices, None] - day_ordinals[None, col_indices])
+        scores *= (1 - date_weight)
+        scores += date_weight * np.exp(-day_difference / date_scale)
+
+    return kernel
@@ -0,0 +1,160 @@
+import hashlib
+import inspect
+import json
+import pickle
+from pathlib import Path
+
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+
+def hash_dataframe(df):
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps([list(map(str, df.columns)), list(map(str, df.dtypes))]).encode())
+    try:
+        hasher.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    except TypeError:
+        # unhashable cells (e.g. dicts) fall back to their pickled form
+        hasher.update(pickle.dumps(df))
+    return hasher.hexdigest()
+
+
+class Stage(object):
+    """
+    One step of a pipeline: func(*input_frames, **params) -> DataFrame.
+    inputs are names of upstream stages (or of source frames given to PipelineRunner.run).
+    The code version defaults to a hash of the source code of func and of the functions in code,
+    which should list everything the stage result depends on.
+    """
+    def __init__(self, name: str, func, inputs: list, params: dict = None, version: str = None, code: list = None):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.params = params or {}
+        self.version = version if version is not None else self.source_hash([func] + (code or []))
+
+    @staticmethod
+    def source_hash(functions):
+        hasher = hashlib.sha256()
+        for func in functions:
+            try:
+                source = inspect.getsource(func)
+            except (OSError, TypeError):
+                source = getattr(func, "__qualname__", repr(func))
+            hasher.update(source.encode())
+        return hasher.hexdigest()[:16]
+
+    def key(self, input_keys: list):
+        description = {"name": self.name,
+                       "version": self.version,
+                       "params": self.params,
+                       "inputs": input_keys}
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class ArtifactStore(object):
+    """Stage outputs stored as parquet (pickle if pyarrow is missing), keyed by the stage key."""
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.suffix = ".parquet" if PARQUET_AVAILABLE else ".pkl"
+
+    def path(self, name, key):
+        return Path(self.root, f"{name}-{key[:16]}{self.suffix}")
+
+    def exists(self, name, key):
+        return self.path(name, key).exists()
+
+    def load(self, name, key):
+        if PARQUET_AVAILABLE:
+            return pd.read_parquet(self.path(name, key))
+        return pd.read_pickle(self.path(name, key))
+
+    def save(self, name, key, df):
+        path = self.path(name, key)
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        if PARQUET_AVAILABLE:
+            df.to_parquet(tmp_path, index=False)
+        else:
+            df.to_pickle(tmp_path)
+        tmp_path.replace(path)
+
+
+class PipelineRunner(object):
+    """
+    Runs stages in dependency order. A stage key hashes the stage name, code version, parameters
+    and the keys of its inputs (source frames are keyed by their content), so a stage is only
+    recomputed if something upstream of it or its own parameters changed.
+    A profiling.StageProfiler records every stage which is run.
+    """
+    def __init__(self, stages: list, cache_dir, profiler=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.store = ArtifactStore(cache_dir)
+        self.manifest_path = Path(cache_dir, "manifest.json")
+        self.profiler = profiler
+
+    def run(self, sources: dict, targets: list = None):
+        keys = {name: hash_dataframe(df) for name, df in sources.items()}
+        frames = dict(sources)
+        manifest = {}
+        for stage in self.execution_order(targets or list(self.stages), sources):
+            input_keys = [keys[name] for name in stage.inputs]
+            key = stage.key(input_keys)
+            keys[stage.name] = key
+            if self.store.exists(stage.name, key):
+                print(f"    [{stage.name}] cached ({key[:16]})")
+                frames[stage.name] = None
+                if self.profiler is not None:
+                    self.profiler.add(stage.name, cached=True)
+            else:
+                print(f"    [{stage.name}] running ({key[:16]})")
+                input_frames = [self.get_frame(name, frames, keys) for name in stage.inputs]
+                frames[stage.name] = self.run_stage(stage, input_frames)
+                self.store.save(stage.name, key, frames[stage.name])
+            manifest[stage.name] = {"key": key, "inputs": stage.inputs, "params": stage.params,
+                                    "version": stage.version, "path": str(self.store.path(stage.name, key))}
+        with open(self.manifest_path, "w") as f:
+            json.dump(manifest, f, indent=2, default=str)
+        return {name: self.get_frame(name, frames, keys) for name in (targets or list(self.stages))}
+
+    def run_stage(self, stage, input_frames):
+        if self.profiler is None:
+            return stage.func(*input_frames, **stage.params)
+        with self.profiler.stage(stage.name, rows_in=len(input_frames[0]) if input_frames else None) as record:
+            output = stage.func(*input_frames, **stage.params)
+            record["rows_out"] = len(output)
+        return output
+
+    def get_frame(self, name, frames, keys):
+        # cached frames are only loaded when a downstream stage or the caller needs them
+        if frames.get(name) is None:
+            frames[name] = self.store.load(name, keys[name])
+        return frames[name]
+
+    def execution_order(self, targets, sources):
+        order = []
+        visited = set()
+        visiting = set()
+
+        def visit(name):
+            if name in sources or name in visited:
+                return
+            if name not in self.stages:
+                raise ValueError(f"{name} is neither a stage nor a source!")
+            if name in visiting:
+                raise ValueError(f"Cycle in pipeline at stage {name}!")
+            visiting.add(name)
+            for input_name in self.stages[name].inputs:
+                visit(input_name)
+            visiting.remove(name)
+            visited.add(name)
+            order.append(self.stages[name])
+
+        for target in targets:
+            visit(target)
+        return order
@@ -0,0 +1,8 @@
+import sys
+from pathlib import Path
+
+# the scripts import each other from the repository root, the models from their own directory
+ROOT = Path(__file__).resolve().parents[1]
+for path in [ROOT, Path(ROOT, "models")]:
+    if str(path) not in sys.path:
+        sys.path.insert(0, str(path))
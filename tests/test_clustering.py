@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from sklearn.cluster import DBSCAN
+
+from clustering import NO_CLUSTER, largest_temporal_run, temporal_dbscan_1d
+
+
+def assert_same_partition(labels, days, dbscan, eps):
+    expected = dbscan.labels_
+    assert np.array_equal(labels == -1, expected == -1)
+    core = np.zeros(len(labels), dtype=bool)
+    core[dbscan.core_sample_indices_] = True
+    # one run per sklearn cluster and vice versa on the core points
+    pairs = set(zip(labels[core], expected[core]))
+    assert len(pairs) == len(set(labels[core])) == len(set(expected[core]))
+    # a border point within eps of two runs may join either (sklearn takes the first one it reaches)
+    for i in np.nonzero(~core & (labels != -1))[0]:
+        assert np.any(core & (labels == labels[i]) & (np.abs(days - days[i]) <= eps))
+
+
+@pytest.mark.parametrize("eps, min_samples", [(1, 3), (2, 2), (3.5, 5)])
+def test_temporal_dbscan_1d_matches_sklearn(eps, min_samples):
+    rng = np.random.default_rng(0)
+    n = 3000
+    cluster_ids = rng.integers(0, 40, n).astype(np.float64)
+    cluster_ids[rng.random(n) < 0.1] = NO_CLUSTER
+    days = rng.integers(0, 60, n) + rng.choice([0.0, 0.5], n)
+    labels, run_cluster_ids = temporal_dbscan_1d(cluster_ids, days, eps=eps, min_samples=min_samples)
+
+    assert np.all(labels[cluster_ids == NO_CLUSTER] == -1)
+    for cluster in np.unique(cluster_ids[cluster_ids != NO_CLUSTER]):
+        rows = np.nonzero(cluster_ids == cluster)[0]
+        dbscan = DBSCAN(eps=eps, min_samples=min_samples).fit(days[rows].reshape(-1, 1))
+        assert_same_partition(labels[rows], days[rows], dbscan, eps)
+        assert np.all(run_cluster_ids[labels[rows][labels[rows] >= 0]] == cluster)
+
+
+def test_temporal_dbscan_1d_weights_match_sample_weight():
+    rng = np.random.default_rng(1)
+    days = rng.integers(0, 30, 200).astype(np.float64)
+    weights = rng.integers(1, 4, 200)
+    labels, _ = temporal_dbscan_1d(np.zeros(200), days, eps=1, min_samples=6, weights=weights)
+    dbscan = DBSCAN(eps=1, min_samples=6).fit(days.reshape(-1, 1), sample_weight=weights)
+    assert_same_partition(labels, days, dbscan, 1)
+
+
+def test_temporal_dbscan_1d_without_clusters():
+    labels, run_cluster_ids = temporal_dbscan_1d(np.full(5, NO_CLUSTER), np.arange(5))
+    assert np.all(labels == -1) and len(run_cluster_ids) == 0
+
+
+def test_largest_temporal_run():
+    # cluster 0: runs of 4 and 3 rows; cluster 1: one run of 3 rows and 4 outliers
+    cluster_ids = np.array([0] * 7 + [1] * 7, dtype=np.float64)
+    days = np.array([0, 0, 1, 1, 20, 20, 21, 0, 1, 1, 10, 20, 30, 40], dtype=np.float64)
+    labels, run_cluster_ids = temporal_dbscan_1d(cluster_ids, days, eps=1, min_samples=3)
+    keep = largest_temporal_run(labels, cluster_ids, run_cluster_ids)
+    assert keep.tolist() == [True] * 4 + [False] * 10
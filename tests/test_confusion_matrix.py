@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+import torch
+from sklearn.metrics import accuracy_score, confusion_matrix, precision_recall_fscore_support
+
+from ConfusionMatrix import ConfusionMatrixAccumulator
+
+
+def accumulate(y_true, y_predict, num_classes, batch_size=97):
+    accumulator = ConfusionMatrixAccumulator(num_classes)
+    for start in range(0, len(y_true), batch_size):
+        accumulator.update(torch.as_tensor(y_true[start:start + batch_size]),
+                           torch.as_tensor(y_predict[start:start + batch_size]))
+    return accumulator
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_metrics_match_sklearn(seed):
+    rng = np.random.default_rng(seed)
+    num_classes = 5
+    y_true = rng.integers(0, num_classes, 1000)
+    # a good classifier which never predicts class 4, and class 3 never occurs
+    y_true[y_true == 3] = 0
+    y_predict = np.where(rng.random(1000) < 0.7, y_true, rng.integers(0, 3, 1000))
+    accumulator = accumulate(y_true, y_predict, num_classes)
+    metrics = accumulator.compute()
+
+    labels = list(range(num_classes))
+    assert np.array_equal(accumulator.confusion_matrix.numpy(), confusion_matrix(y_true, y_predict, labels=labels))
+    assert metrics["accuracy"] == pytest.approx(accuracy_score(y_true, y_predict))
+    assert metrics["total"] == 1000
+    for average in ["macro", "micro", "weighted"]:
+        precision, recall, f1, _ = precision_recall_fscore_support(y_true, y_predict, average=average, zero_division=0)
+        assert metrics[f"{average}_precision"] == pytest.approx(precision)
+        assert metrics[f"{average}_recall"] == pytest.approx(recall)
+        assert metrics[f"{average}_f1"] == pytest.approx(f1)
+    precision, recall, f1, support = precision_recall_fscore_support(y_true, y_predict, labels=labels, zero_division=0)
+    for i in labels:
+        per_class = metrics["per_class"][str(i)]
+        assert per_class["precision"] == pytest.approx(precision[i])
+        assert per_class["recall"] == pytest.approx(recall[i])
+        assert per_class["f1"] == pytest.approx(f1[i])
+        assert per_class["support"] == support[i]
+
+
+def test_scores_are_reduced_to_labels():
+    scores = torch.tensor([[0.1, 0.9], [0.8, 0.2], [0.3, 0.7]])
+    accumulator = ConfusionMatrixAccumulator(2)
+    assert accumulator.update(torch.tensor([1, 1, 1]), scores).tolist() == [1, 0, 1]
+    assert accumulator.confusion_matrix.tolist() == [[0, 0], [1, 2]]
+    accumulator.reset()
+    assert accumulator.compute()["total"] == 0
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from LengthBucketing import LengthBucketBatchSampler, padding_ratio
+
+
+def random_lengths(n=1003, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(3, 60, n), rng.integers(3, 60, n)
+
+
+def assert_covers_every_pair_once(batches, n):
+    indices = np.concatenate(batches)
+    assert len(indices) == n
+    assert np.array_equal(np.sort(indices), np.arange(n))
+
+
+@pytest.mark.parametrize("shuffle", [True, False])
+def test_batch_size_batches_cover_every_pair_once(shuffle):
+    lengths_a, lengths_b = random_lengths()
+    sampler = LengthBucketBatchSampler(lengths_a, lengths_b, batch_size=32, bucket_size=200, shuffle=shuffle)
+    for _ in range(3):
+        batches = list(sampler)
+        assert_covers_every_pair_once(batches, len(lengths_a))
+        assert max(map(len, batches)) == 32
+
+
+def test_len_matches_the_batches_of_the_epoch():
+    lengths_a, lengths_b = random_lengths()
+    sampler = LengthBucketBatchSampler(lengths_a, lengths_b, max_tokens=2000, bucket_size=300)
+    for epoch in range(3):
+        sampler.set_epoch(epoch)
+        n_batches = len(sampler)
+        assert len(list(sampler)) == n_batches
+
+
+def test_max_tokens_batches_cover_every_pair_once_within_the_budget():
+    lengths_a, lengths_b = random_lengths()
+    sampler = LengthBucketBatchSampler(lengths_a, lengths_b, max_tokens=2000, bucket_size=300)
+    for _ in range(3):
+        batches = list(sampler)
+        assert_covers_every_pair_once(batches, len(lengths_a))
+        for batch in batches:
+            padded = len(batch) * (lengths_a[batch].max() + lengths_b[batch].max())
+            assert padded <= 2000 or len(batch) == 1
+
+
+def test_epochs_differ_and_are_reproducible():
+    lengths_a, lengths_b = random_lengths()
+    first = LengthBucketBatchSampler(lengths_a, lengths_b, batch_size=32, seed=3)
+    second = LengthBucketBatchSampler(lengths_a, lengths_b, batch_size=32, seed=3)
+    epoch_0, epoch_1 = list(first), list(first)
+    assert [list(batch) for batch in epoch_0] != [list(batch) for batch in epoch_1]
+    assert list(second) == epoch_0
+
+
+def test_bucketing_reduces_padding():
+    lengths_a, lengths_b = random_lengths(5000)
+    sampler = LengthBucketBatchSampler(lengths_a, lengths_b, batch_size=32)
+    list(sampler)
+    order = np.random.default_rng(0).permutation(len(lengths_a))
+    shuffled = np.split(order, np.arange(32, len(order), 32))
+    assert sampler.padding_ratio < padding_ratio(shuffled, lengths_a, lengths_b)
+
+
+def test_needs_batch_size_or_max_tokens():
+    with pytest.raises(ValueError):
+        LengthBucketBatchSampler([1], [1])
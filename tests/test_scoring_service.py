@@ -0,0 +1,73 @@
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip("sentence_transformers")
+
+from ScoringService import MicroBatcher, ServiceOverloaded  # noqa: E402
+
+
+def echo_score(pairs):
+    """Label = first sentence of the pair, probabilities = the pair's own numbers."""
+    labels = np.array([a for a, _ in pairs], dtype=object)
+    probabilities = np.array([[float(a.split("-")[1]), float(b.split("-")[1])] for a, b in pairs])
+    return labels, probabilities
+
+
+def make_pairs(request, n):
+    return [[f"{request}-{i}", f"{request}b-{i + 0.5}"] for i in range(n)]
+
+
+async def submit_all(batcher, requests):
+    task = batcher.start()
+    try:
+        return await asyncio.gather(*[batcher.submit(pairs) for pairs in requests], return_exceptions=True)
+    finally:
+        task.cancel()
+
+
+def test_every_request_gets_its_own_results():
+    requests = [make_pairs(f"r{r}", n) for r, n in enumerate([1, 5, 3, 40, 1, 17, 2])]
+    batcher = MicroBatcher(echo_score, max_batch_pairs=16, max_wait_ms=20)
+    results = asyncio.run(submit_all(batcher, requests))
+    for pairs, (labels, probabilities) in zip(requests, results):
+        assert labels.tolist() == [a for a, _ in pairs]
+        assert probabilities.tolist() == [[i, i + 0.5] for i in range(len(pairs))]
+    # concurrent requests are scored together, no pair is scored twice
+    assert len(batcher.batch_sizes) < len(requests)
+    assert sum(batcher.batch_sizes) == sum(map(len, requests))
+    assert batcher.pending_pairs == 0
+
+
+def test_scoring_errors_reach_every_request_of_the_batch():
+    def failing_score(pairs):
+        raise RuntimeError("model failed")
+
+    batcher = MicroBatcher(failing_score, max_batch_pairs=64, max_wait_ms=20)
+    results = asyncio.run(submit_all(batcher, [make_pairs("a", 2), make_pairs("b", 3)]))
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert batcher.pending_pairs == 0
+
+
+def test_requests_are_rejected_while_overloaded():
+    release = threading.Event()
+
+    def blocking_score(pairs):
+        release.wait(5)
+        return echo_score(pairs)
+
+    async def overload():
+        batcher = MicroBatcher(blocking_score, max_batch_pairs=4, max_wait_ms=1, max_pending_pairs=10)
+        task = batcher.start()
+        first = asyncio.ensure_future(batcher.submit(make_pairs("a", 8)))
+        await asyncio.sleep(0.05)
+        with pytest.raises(ServiceOverloaded):
+            await batcher.submit(make_pairs("b", 3))
+        release.set()
+        labels, _ = await first
+        task.cancel()
+        return labels
+
+    assert len(asyncio.run(overload())) == 8
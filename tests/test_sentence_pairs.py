@@ -0,0 +1,59 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from SentencePairs import SentencePairs, save_sentence_pairs
+
+
+LABEL2INT = {"different_event": 0, "same_event": 1, "earlier": 2}
+
+
+def sentence_table():
+    return pd.DataFrame({"sentence": ["Storm hits the coast", "Sturm über Köln", "", "Storm hits the coast",
+                                      "Hurricane warning 🌀", "never paired"],
+                         "event": ["e1", "e2", "e3", "e1", "e4", "e5"],
+                         "time": [20200101, 20200102, 20200103, 20200104, 20200105, 20200106],
+                         "url": ["u1", "u2", "u3", "u4", "u5", "u6"]})
+
+
+def saved_pairs(path):
+    table = sentence_table()
+    a = np.array([0, 1, 2, 3, 4, 0])
+    b = np.array([3, 4, 1, 0, 2, 1])
+    labels = np.array([1, 0, 2, 1, 0, 2])
+    return table, a, b, labels, SentencePairs(save_sentence_pairs(path, table, a, b, labels, LABEL2INT))
+
+
+def test_round_trip(tmp_path):
+    table, a, b, labels, pairs = saved_pairs(tmp_path)
+    assert len(pairs) == len(labels)
+    frame = pairs.to_frame()
+    for side, rows in [("a", a), ("b", b)]:
+        for col in ["sentence", "event", "time", "url"]:
+            assert frame[f"{col}_{side}"].tolist() == table[col].values[rows].tolist()
+    int2label = {i: label for label, i in LABEL2INT.items()}
+    assert frame["labels"].tolist() == [int2label[label] for label in labels]
+    assert pairs[1] == (("Sturm über Köln", "Hurricane warning 🌀"), 0)
+    assert [pairs[i][0] for i in range(len(pairs))] == list(zip(table["sentence"].values[a],
+                                                               table["sentence"].values[b]))
+
+
+def test_strings_are_interned(tmp_path):
+    _, _, _, _, pairs = saved_pairs(tmp_path)
+    sentences = pairs.sentences
+    # the unpaired row is dropped, the duplicated title is stored once
+    assert len(sentences) == 5
+    assert pairs.num_unique_sentences == 4
+    assert sorted(sentences.unique()) == sorted(["Storm hits the coast", "Sturm über Köln", "", "Hurricane warning 🌀"])
+    assert list(sentences) == np.asarray(sentences).tolist() == sentences[:].tolist()
+    assert sentences[np.array([0, 0, 2])].tolist() == [sentences[0], sentences[0], sentences[2]]
+
+
+def test_sentence_fingerprint_changes_with_the_sentences(tmp_path):
+    table, a, b, labels, pairs = saved_pairs(Path(tmp_path, "first"))
+    _, _, _, _, same = saved_pairs(Path(tmp_path, "second"))
+    assert pairs.sentence_fingerprint == same.sentence_fingerprint
+    table.loc[1, "sentence"] = "Sturm über Bonn"
+    changed = SentencePairs(save_sentence_pairs(Path(tmp_path, "third"), table, a, b, labels, LABEL2INT))
+    assert changed.sentence_fingerprint != pairs.sentence_fingerprint
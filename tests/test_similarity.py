@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from similarity import blocked_cosine_topk, community_detection, quantize_embeddings
+
+
+def clustered_embeddings(n_clusters=12, per_cluster=25, n_noise=200, dim=32, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_clusters, dim))
+    members = np.repeat(centers, per_cluster, axis=0) + 0.35 * rng.normal(size=(n_clusters * per_cluster, dim))
+    embeddings = np.concatenate([members, rng.normal(size=(n_noise, dim))])
+    return embeddings[rng.permutation(len(embeddings))].astype(np.float32)
+
+
+def dense_scores(embeddings):
+    embeddings = embeddings[0:len(embeddings)].astype(np.float64)
+    return embeddings @ embeddings.T
+
+
+def reference_communities(scores, threshold, min_community_size):
+    # sentence_transformers.util.community_detection on the full score matrix
+    neighbours = [np.nonzero(row >= threshold)[0] for row in scores]
+    candidates = sorted([row for row in neighbours if len(row) >= min_community_size], key=len, reverse=True)
+    communities, extracted = [], set()
+    for community in candidates:
+        community = [i for i in sorted(community) if i not in extracted]
+        if len(community) >= min_community_size:
+            communities.append(community)
+            extracted.update(community)
+    return sorted(communities, key=len, reverse=True)
+
+
+@pytest.mark.parametrize("precision", ["float32", "float16", "int8"])
+def test_blocked_cosine_topk_matches_dense_scores(precision):
+    embeddings = quantize_embeddings(clustered_embeddings(), precision)
+    scores = dense_scores(embeddings)
+    similarities = blocked_cosine_topk(embeddings, threshold=0.6, block_size=64)
+    rows, cols = np.nonzero(scores >= 0.6)
+    assert similarities.nnz == len(rows)
+    np.testing.assert_allclose(similarities[rows, cols].A1, scores[rows, cols], atol=1e-5)
+
+
+def test_blocked_cosine_topk_keeps_top_k_per_row():
+    embeddings = quantize_embeddings(clustered_embeddings(), "float32")
+    scores = dense_scores(embeddings)
+    similarities = blocked_cosine_topk(embeddings, threshold=0.6, top_k=5, block_size=64)
+    for i in range(len(scores)):
+        row = similarities.getrow(i)
+        expected = np.sort(scores[i][scores[i] >= 0.6])[::-1][:5]
+        np.testing.assert_allclose(np.sort(row.data)[::-1], expected, atol=1e-5)
+
+
+def test_int8_embeddings_are_close_to_float32():
+    embeddings = clustered_embeddings()
+    reference = dense_scores(quantize_embeddings(embeddings, "float32"))
+    int8 = quantize_embeddings(embeddings, "int8")
+    assert int8.nbytes < embeddings.nbytes / 3
+    assert np.abs(dense_scores(int8) - reference).max() < 0.02
+
+
+@pytest.mark.parametrize("precision", ["float32", "float16", "int8"])
+@pytest.mark.parametrize("block_size", [64, 2048])
+def test_community_detection_matches_reference(precision, block_size):
+    embeddings = quantize_embeddings(clustered_embeddings(), precision)
+    communities = community_detection(embeddings, threshold=0.6, min_community_size=10, block_size=block_size)
+    expected = reference_communities(dense_scores(embeddings), 0.6, 10)
+    assert len(communities) > 0
+    assert communities == expected
+
+
+def test_community_detection_weights_count_rows():
+    embeddings = quantize_embeddings(clustered_embeddings(), "float32")
+    # every row twice: the same communities as weight 2 on the deduplicated rows
+    doubled = community_detection(np.repeat(embeddings, 2, axis=0), threshold=0.6, min_community_size=20)
+    weighted = community_detection(embeddings, threshold=0.6, min_community_size=20,
+                                   weights=np.full(len(embeddings), 2))
+    assert sorted(sorted(set(i // 2 for i in community)) for community in doubled) == sorted(weighted)
+
+
+def test_community_detection_top_k_and_threads():
+    embeddings = quantize_embeddings(clustered_embeddings(), "float16")
+    exact = community_detection(embeddings, threshold=0.6, min_community_size=10, block_size=64)
+    largest = max(map(len, exact))
+    # a bound above the largest community keeps the result exact
+    assert community_detection(embeddings, threshold=0.6, min_community_size=10, block_size=64,
+                               top_k=largest + 5) == exact
+    assert community_detection(embeddings, threshold=0.6, min_community_size=10, block_size=64, n_jobs=4) == exact
+    with pytest.raises(ValueError):
+        community_detection(embeddings, threshold=0.6, min_community_size=10, top_k=5)
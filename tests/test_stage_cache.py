@@ -0,0 +1,63 @@
+import pandas as pd
+
+from stage_cache import PipelineRunner, Stage
+
+
+calls = []
+
+
+def scale(df, factor=1):
+    calls.append("scaled")
+    return df.assign(value=df["value"] * factor)
+
+
+def scale_and_shift(df, factor=1):
+    calls.append("scaled")
+    return df.assign(value=df["value"] * factor + 1)
+
+
+def total(df):
+    calls.append("total")
+    return pd.DataFrame({"total": [df["value"].sum()]})
+
+
+def run(cache_dir, source, factor=2, scale_func=scale, code=None):
+    calls.clear()
+    stages = [Stage("scaled", scale_func, inputs=["source"], params={"factor": factor}, code=code),
+              Stage("total", total, inputs=["scaled"])]
+    return PipelineRunner(stages, cache_dir).run({"source": source}, targets=["total"])["total"]
+
+
+def test_unchanged_pipeline_is_cached(tmp_path):
+    source = pd.DataFrame({"value": [1, 2, 3]})
+    assert run(tmp_path, source)["total"].tolist() == [12]
+    assert calls == ["scaled", "total"]
+    assert run(tmp_path, source)["total"].tolist() == [12]
+    assert calls == []
+
+
+def test_changed_params_rerun_the_stage_and_downstream(tmp_path):
+    source = pd.DataFrame({"value": [1, 2, 3]})
+    run(tmp_path, source)
+    assert run(tmp_path, source, factor=3)["total"].tolist() == [18]
+    assert calls == ["scaled", "total"]
+    # the earlier parameters are still cached
+    assert run(tmp_path, source)["total"].tolist() == [12]
+    assert calls == []
+
+
+def test_changed_source_reruns(tmp_path):
+    run(tmp_path, pd.DataFrame({"value": [1, 2, 3]}))
+    assert run(tmp_path, pd.DataFrame({"value": [1, 2, 4]}))["total"].tolist() == [14]
+    assert calls == ["scaled", "total"]
+
+
+def test_changed_code_reruns(tmp_path):
+    source = pd.DataFrame({"value": [1, 2, 3]})
+    run(tmp_path, source)
+    assert run(tmp_path, source, scale_func=scale_and_shift)["total"].tolist() == [15]
+    assert calls == ["scaled", "total"]
+    # a changed helper listed in code invalidates the stage as well
+    run(tmp_path, source, code=[total])
+    assert calls == ["scaled", "total"]
+
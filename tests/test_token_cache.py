@@ -0,0 +1,68 @@
+import numpy as np
+
+from TokenCache import TokenCache
+
+
+class WhitespaceTokenizer(object):
+    """Token id = length of the word + 10, with [CLS]=1 and [SEP]=2."""
+    pad_token_id = 0
+    name_or_path = "whitespace"
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, sentences, truncation=True, max_length=None):
+        self.calls += 1
+        input_ids = [[1] + [len(word) + 10 for word in sentence.split()] + [2] for sentence in sentences]
+        return {"input_ids": [ids[:max_length - 1] + [2] if len(ids) > max_length else ids for ids in input_ids]}
+
+
+SENTENCES = ["Storm hits the coast", "Flooding", "A very long title about a storm and its aftermath"]
+
+
+def test_build_and_pad(tmp_path):
+    tokenizer = WhitespaceTokenizer()
+    cache = TokenCache.build(tmp_path, SENTENCES, tokenizer, max_seq_length=8, batch_size=2)
+    assert cache.lengths.tolist() == [6, 3, 8]
+    features = cache.pad([1, 0])
+    assert features["input_ids"].tolist() == [[1, 18, 2, 0, 0, 0], [1, 15, 14, 13, 15, 2]]
+    assert features["attention_mask"].sum(dim=1).tolist() == [3, 6]
+
+
+def test_unchanged_sentences_are_not_tokenised_again(tmp_path):
+    tokenizer = WhitespaceTokenizer()
+    TokenCache.build(tmp_path, SENTENCES, tokenizer, max_seq_length=8)
+    calls = tokenizer.calls
+    TokenCache.build(tmp_path, SENTENCES, tokenizer, max_seq_length=8)
+    assert tokenizer.calls == calls
+
+
+def test_changed_sentences_invalidate_the_cache(tmp_path):
+    tokenizer = WhitespaceTokenizer()
+    TokenCache.build(tmp_path, SENTENCES, tokenizer, max_seq_length=8)
+    # a regenerated table: same size, different content
+    changed = ["Storm hits the coast", "Flooding in the valley", SENTENCES[2]]
+    cache = TokenCache.build(tmp_path, changed, tokenizer, max_seq_length=8)
+    assert cache.lengths.tolist() == [6, 6, 8]
+    # more rows
+    cache = TokenCache.build(tmp_path, changed + ["Hail"], tokenizer, max_seq_length=8)
+    assert cache.lengths.tolist() == [6, 6, 8, 3]
+
+
+def test_fingerprint_selects_the_cache(tmp_path):
+    tokenizer = WhitespaceTokenizer()
+    TokenCache.build(tmp_path, SENTENCES, tokenizer, max_seq_length=8, fingerprint="v1")
+    calls = tokenizer.calls
+    TokenCache.build(tmp_path, SENTENCES, tokenizer, max_seq_length=8, fingerprint="v1")
+    assert tokenizer.calls == calls
+    TokenCache.build(tmp_path, SENTENCES, tokenizer, max_seq_length=8, fingerprint="v2")
+    assert tokenizer.calls > calls
+
+
+def test_open_cache_survives_a_rebuild(tmp_path):
+    tokenizer = WhitespaceTokenizer()
+    cache = TokenCache.build(tmp_path, SENTENCES, tokenizer, max_seq_length=8)
+    lengths = np.array(cache.lengths)
+    TokenCache.build(tmp_path, ["Hail"] * 3, tokenizer, max_seq_length=8)
+    # the memory-mapped arrays of the old cache still hold the old tokens
+    assert np.array_equal(cache.lengths, lengths)